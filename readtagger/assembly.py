@@ -0,0 +1,315 @@
+"""Assemble small sets of reads in-process and choose between cached assemblies, in-process assembly and cap3."""
+from collections import Counter
+from hashlib import md5
+
+import six
+from edlib import align
+
+from .assembly_cache import ASSEMBLY_CACHE
+from .cap3 import (
+    BaseAssembly,
+    Cap3Assembly,
+    Contig
+)
+from .utils import revcom
+
+IN_PROCESS_MAX_READS = 30
+# If in-process assembly is enabled, read sets up to this size are assembled in-process, larger sets are assembled by cap3
+IN_PROCESS_MAX_READ_LENGTH = 1000
+# Long (and usually noisy) reads are always assembled by cap3
+KMER_SIZE = 15
+MIN_SHARED_KMERS = 2
+# Reads need to share this many k-mers on the same diagonal before an overlap is verified
+MIN_OVERLAP = 40
+MAX_ERROR_RATE = 0.1
+VALID_NUCLEOTIDES = frozenset('ACGTN')
+MIN_NOVEL_KMER_FRACTION = 0.5
+# Reads that contribute at least this fraction of new k-mers are preferred when downsampling
+
+
+def named_sequences(sequences):
+    """
+    Return a list of (name, sequence) tuples for a dictionary, list or string of sequences.
+
+    Names are assigned in the same way as `fasta_io.write_sequences` does.
+
+    >>> named_sequences({'a': 'ATGC'})
+    [('a', 'ATGC')]
+    >>> named_sequences(['ATGC', 'GGCC'])
+    [('0', 'ATGC'), ('1', 'GGCC')]
+    >>> named_sequences('ATGC')
+    [('0', 'ATGC')]
+    """
+    if isinstance(sequences, dict):
+        items = sequences.items()
+    elif isinstance(sequences, six.string_types):
+        items = [(0, sequences)]
+    else:
+        items = enumerate(sequences)
+    return [(str(name), sequence) for name, sequence in items]
+
+
+def kmer_positions(sequence, k=KMER_SIZE):
+    """Return a dictionary of the first position of each k-mer in `sequence`."""
+    positions = {}
+    for i in range(len(sequence) - k + 1):
+        positions.setdefault(sequence[i:i + k], i)
+    return positions
+
+
+def best_diagonal(kmers, sequence, k=KMER_SIZE):
+    """Return the offset of `sequence` relative to the sequence indexed in `kmers` that is supported by most shared k-mers."""
+    votes = Counter()
+    for i in range(len(sequence) - k + 1):
+        position = kmers.get(sequence[i:i + k])
+        if position is not None:
+            votes[position - i] += 1
+    if votes:
+        diagonal, count = max(votes.items(), key=lambda item: (item[1], -abs(item[0])))
+        if count >= MIN_SHARED_KMERS:
+            return diagonal
+
+
+def _verified(query, target, mode):
+    """Return the end of the alignment of `query` in `target` if the alignment is long and similar enough."""
+    if len(query) < MIN_OVERLAP:
+        return None
+    result = align(query, target, mode=mode, task='locations', k=int(len(query) * MAX_ERROR_RATE))
+    if result['editDistance'] == -1:
+        return None
+    return result['locations'][0][1]
+
+
+def extend_contig(contig, kmers, read):
+    """
+    Return `contig` extended by `read`, or None if `read` does not overlap `contig`.
+
+    >>> contig = 'TAGTTGTAAGCGATTCTTAACTTACCTACCTACATATATATACTTACGTATTTTACTATT'
+    >>> read = 'CGATTCTTAACTTACCTACCTACATATATATACTTACGTATTTTACTATTCGAGTCGAACA'
+    >>> extend_contig(contig, kmer_positions(contig), read)
+    'TAGTTGTAAGCGATTCTTAACTTACCTACCTACATATATATACTTACGTATTTTACTATTCGAGTCGAACA'
+    >>> extend_contig(contig, kmer_positions(contig), 'CGAGTCGAACAAATGATCCGTCGTTTGACTAAGATCAACGCCTTTAAAGAAGTTTCAGAA') is None
+    True
+    """
+    diagonal = best_diagonal(kmers, read)
+    if diagonal is None:
+        return None
+    if diagonal >= 0:
+        if diagonal + len(read) <= len(contig):
+            # read is contained in contig
+            slack = int(len(read) * MAX_ERROR_RATE) + 1
+            end = _verified(read, contig[max(diagonal - slack, 0):diagonal + len(read) + slack], mode='HW')
+            return contig if end is not None else None
+        # read extends contig to the right
+        end = _verified(contig[diagonal:], read, mode='SHW')
+        return contig + read[end + 1:] if end is not None else None
+    if len(contig) - diagonal <= len(read):
+        # contig is contained in read
+        slack = int(len(contig) * MAX_ERROR_RATE) + 1
+        end = _verified(contig, read[max(-diagonal - slack, 0):len(contig) - diagonal + slack], mode='HW')
+        return read if end is not None else None
+    # read extends contig to the left
+    end = _verified(read[-diagonal:], contig, mode='SHW')
+    return read + contig[end + 1:] if end is not None else None
+
+
+class OverlapAssembly(BaseAssembly):
+    """Assemble reads in-process by greedily extending contigs with overlapping reads."""
+
+    requires_input_file = False
+
+    def __init__(self, sequences, shm_dir=None):
+        """
+        Asssemble sequences into contigs.
+
+        Contigs are seeded with the longest unassembled read and extended with reads (or their reverse complement)
+        that overlap the contig by at least `MIN_OVERLAP` nucleotides with an error rate of at most `MAX_ERROR_RATE`.
+        Like cap3 only contigs of at least 2 reads are reported.
+
+        >>> read1 = 'TAGTTGTAAGCGATTCTTAACTTACCTACCTACATATATATACTTACGTATTTTACTATT'
+        >>> read2 = 'CGAGTCGAACAAATGATCCGTCGTTTGACTAAGATCAACGCCTTTAAAGAAGTTTCAGAA'
+        >>> read3 = 'TACCTACCTACATATATATACTTACGTATTTTACTATTCGAGTCGAACAAATGATCCGTC'
+        >>> read4 = 'CGATTCTTAACTTACCTACCTACATATATATACTTACGTATTTTACTATTCGAGTCGAACA'
+        >>> sequences = {'read1': read1, 'read2': read2, 'read3': read3, 'read4': read4}
+        >>> assembly = OverlapAssembly(sequences)
+        >>> len(assembly.contigs)
+        1
+        >>> sorted(assembly.contig_read_names[0])  # read2 overlaps the contig by only 22 nucleotides
+        ['read1', 'read3', 'read4']
+        >>> assembly.contigs[0].sequence == read1 + read3[38:]
+        True
+        """
+        super(OverlapAssembly, self).__init__(sequences=sequences, shm_dir=shm_dir)
+
+    def assemble(self):
+        """Assemble sequences."""
+        reads = sorted(named_sequences(self.sequences), key=lambda read: (-len(read[1]), read[0]))
+        contigs = []
+        while reads:
+            name, sequence = reads.pop(0)
+            read_names = [name]
+            extended = True
+            while extended:
+                extended = False
+                kmers = kmer_positions(sequence)
+                for i, (read_name, read_sequence) in enumerate(reads):
+                    new_sequence = extend_contig(sequence, kmers, read_sequence)
+                    if new_sequence is None:
+                        new_sequence = extend_contig(sequence, kmers, revcom(read_sequence))
+                    if new_sequence is not None:
+                        sequence = new_sequence
+                        read_names.append(read_name)
+                        del reads[i]
+                        extended = True
+                        break
+            if len(read_names) > 1:
+                contigs.append(Contig(name="Contig%d" % (len(contigs) + 1), sequence=sequence, read_names=read_names))
+        return contigs
+
+
+def can_assemble_in_process(sequences, max_reads=IN_PROCESS_MAX_READS, max_read_length=IN_PROCESS_MAX_READ_LENGTH):
+    """Return whether `sequences` is a small set of short reads that can be assembled by OverlapAssembly."""
+    reads = named_sequences(sequences)
+    return (0 < len(reads) <= max_reads and
+            all(len(sequence) <= max_read_length and VALID_NUCLEOTIDES.issuperset(sequence) for _, sequence in reads))
+
+
+def _sequence_hash(read):
+    return md5(read[1].encode('utf-8')).hexdigest(), read[0]
+
+
+def downsample_sequences(sequences, target_reads, keep=()):
+    """
+    Return at most `target_reads` of `sequences` as a dictionary of name to sequence.
+
+    Identical sequences are only kept once. Reads with names in `keep` (e.g split reads) are selected first,
+    followed by reads that add new k-mers to the selected reads. Remaining reads are taken in an order
+    determined by a hash of their sequence, so that the same input always produces the same selection.
+
+    >>> reads = {'split': 'A' * 20, 'a': 'C' * 20, 'b': 'C' * 20, 'c': 'A' * 19}
+    >>> sorted(downsample_sequences(reads, target_reads=2, keep={'split'}))
+    ['a', 'split']
+    >>> len(downsample_sequences(reads, target_reads=10))
+    3
+    """
+    keep = {str(name) for name in keep}
+    unique_reads = {}
+    for name, sequence in sorted(named_sequences(sequences), key=lambda read: (read[0] not in keep, read[0])):
+        unique_reads.setdefault(sequence, name)
+    reads = [(name, sequence) for sequence, name in unique_reads.items()]
+    if len(reads) <= target_reads:
+        return dict(reads)
+    selected = sorted((read for read in reads if read[0] in keep), key=_sequence_hash)[:target_reads]
+    candidates = sorted((read for read in reads if read[0] not in keep), key=_sequence_hash)
+    selected_kmers = set()
+    for _, sequence in selected:
+        selected_kmers.update(kmer_positions(sequence))
+    remaining = []
+    for name, sequence in candidates:
+        if len(selected) >= target_reads:
+            break
+        kmers = set(kmer_positions(sequence))
+        if kmers and len(kmers - selected_kmers) >= MIN_NOVEL_KMER_FRACTION * len(kmers):
+            selected.append((name, sequence))
+            selected_kmers.update(kmers)
+        else:
+            remaining.append((name, sequence))
+    selected.extend(remaining[:target_reads - len(selected)])
+    return dict(selected)
+
+
+class CachedAssembly(BaseAssembly):
+    """Provide contigs of an assembly retrieved from an AssemblyCache."""
+
+    requires_input_file = False
+
+    def __init__(self, sequences, cached_contigs):
+        """Build contigs from `cached_contigs`, a list of (sequence, read names) tuples, read names may be None."""
+        self.cached_contigs = cached_contigs
+        super(CachedAssembly, self).__init__(sequences=sequences, shm_dir=None)
+
+    def assemble(self):
+        """Return cached contigs."""
+        return [Contig(name="Contig%d" % (i + 1), sequence=sequence, read_names=read_names)
+                for i, (sequence, read_names) in enumerate(self.cached_contigs)]
+
+
+def assemble_sequences(sequences, shm_dir=None, read_names=False, cache=ASSEMBLY_CACHE, target_reads=None, keep=(), process_limiter=None,
+                       in_process=False):
+    """
+    Assemble `sequences` with cap3, or in-process if `in_process` is True and there are few short reads to assemble.
+
+    OverlapAssembly requires longer and more similar overlaps than cap3, so its contigs can differ from those of cap3.
+    Set `read_names` to True if the names of reads in each contig are needed.
+    If `target_reads` is given, larger read sets are downsampled and reads with names in `keep` are always assembled.
+    Assemblies of identical sequences are retrieved from `cache`.
+    If `process_limiter` is given, cap3 waits for a free slot of this ProcessLimiter.
+
+    >>> from readtagger.assembly_cache import AssemblyCache
+    >>> cache = AssemblyCache()
+    >>> reads = {'read1': 'TAGTTGTAAGCGATTCTTAACTTACCTACCTACATATATATACTTACGTATTTTACTATT',
+    ...          'read4': 'CGATTCTTAACTTACCTACCTACATATATATACTTACGTATTTTACTATTCGAGTCGAACA'}
+    >>> type(assemble_sequences(reads, cache=cache, in_process=True)).__name__
+    'OverlapAssembly'
+    >>> assembly = assemble_sequences({'a': reads['read4'], 'b': reads['read1']}, read_names=True, cache=cache, in_process=True)
+    >>> type(assembly).__name__, sorted(assembly.contig_read_names[0])
+    ('CachedAssembly', ['a', 'b'])
+    """
+    if target_reads and len(named_sequences(sequences)) > target_reads:
+        sequences = downsample_sequences(sequences, target_reads=target_reads, keep=keep)
+    if in_process and can_assemble_in_process(sequences):
+        assembly_class, kwargs = OverlapAssembly, {}
+    else:
+        assembly_class, kwargs = Cap3Assembly, {'read_names': read_names, 'process_limiter': process_limiter}
+    reads = sorted(named_sequences(sequences), key=lambda read: (read[1], read[0]))
+    key = cache.key(assembly_class.__name__, [sequence for _, sequence in reads])
+    cached_contigs = cache.get(key)
+    if cached_contigs is not None and not (read_names and any(indices is None for _, indices in cached_contigs)):
+        return CachedAssembly(sequences, [(sequence, None if indices is None else [reads[i][0] for i in indices])
+                                          for sequence, indices in cached_contigs])
+    assembly = assembly_class(sequences, shm_dir=shm_dir, **kwargs)
+    read_index = {name: i for i, (name, _) in enumerate(reads)}
+    contig_read_names = [names or [] for names in assembly.contig_read_names]
+    if not assembly.failed and all(name in read_index for names in contig_read_names for name in names):
+        cache.set(key, [(contig.sequence, None if contig.read_names is None else [read_index[name] for name in contig.read_names])
+                        for contig in assembly.contigs])
+    return assembly
+
+
+class Assembler(object):
+    """
+    Assemble reads with the same settings.
+
+    Assemblies are retrieved from and stored in the AssemblyCache `cache`, read sets with more than `target_reads` reads
+    are downsampled if `target_reads` is given, and cap3 processes wait for free slots of `process_limiter` if it is given.
+    Small read sets are assembled in-process if `in_process` is True.
+
+    >>> from readtagger.assembly_cache import AssemblyCache
+    >>> assembler = Assembler(cache=AssemblyCache(), target_reads=2, in_process=True)
+    >>> reads = {'read1': 'TAGTTGTAAGCGATTCTTAACTTACCTACCTACATATATATACTTACGTATTTTACTATT',
+    ...          'read4': 'CGATTCTTAACTTACCTACCTACATATATATACTTACGTATTTTACTATTCGAGTCGAACA'}
+    >>> len(assembler.assemble(reads).contigs)
+    1
+    """
+
+    def __init__(self, cache=ASSEMBLY_CACHE, target_reads=None, process_limiter=None, in_process=False):
+        """Initialize Assembler instance."""
+        self.cache = cache
+        self.target_reads = target_reads
+        self.process_limiter = process_limiter
+        self.in_process = in_process
+
+    def assemble(self, sequences, shm_dir=None, read_names=False, keep=()):
+        """Assemble `sequences` using `assemble_sequences`."""
+        return assemble_sequences(sequences,
+                                  shm_dir=shm_dir,
+                                  read_names=read_names,
+                                  cache=self.cache,
+                                  target_reads=self.target_reads,
+                                  keep=keep,
+                                  process_limiter=self.process_limiter,
+                                  in_process=self.in_process)
+
+
+DEFAULT_ASSEMBLER = Assembler()
+# Used by clusters that have not been given an Assembler
@@ -0,0 +1,135 @@
+"""Cache assembled contigs by the content of the assembled reads."""
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from hashlib import md5
+
+logger = logging.getLogger(__name__)
+
+WRITE_BATCH_SIZE = 100
+# Assemblies are written to the database in batches of this size
+DATABASE_TIMEOUT = 10
+# Seconds to wait for a lock on the database before giving up on a read or write
+
+
+class AssemblyCache(object):
+    """
+    Store contig sequences and read-to-contig membership of assemblies.
+
+    Assemblies are identified by the name of the assembler and the sorted sequences of the assembled reads.
+    Membership is stored as indices into the sorted sequences (or None if it has not been determined),
+    so that a cached assembly can be reused for reads with different names.
+    An AssemblyCache instance can be shared between threads.
+    The most recently used `maxsize` assemblies are kept in memory, if `path` is given all assemblies
+    are also stored in an SQLite database at `path` and reused across runs.
+    Writes to the database are batched, call `flush` or `close` to write pending assemblies.
+    The database can be shared between processes. If it can't be read or written (e.g. because it is locked for longer
+    than DATABASE_TIMEOUT seconds) the assembly is treated as not cached.
+
+    >>> cache = AssemblyCache(maxsize=1)
+    >>> key = cache.key('OverlapAssembly', ['ATGC', 'GCTA'])
+    >>> cache.get(key) is None
+    True
+    >>> cache.set(key, [('ATGCTA', [0, 1])])
+    >>> cache.get(key)
+    [('ATGCTA', [0, 1])]
+    >>> cache.set(cache.key('OverlapAssembly', ['ATGC']), [])
+    >>> cache.get(key) is None
+    True
+    """
+
+    def __init__(self, maxsize=10000, path=None):
+        """Initialize AssemblyCache instance."""
+        self.maxsize = maxsize
+        self.path = path
+        self._memory = OrderedDict()
+        self._connection = None
+        self._pid = None
+        self._pending = []
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def key(assembler, sequences):
+        """Return a key for assembling `sequences` (sorted) with `assembler`."""
+        digest = md5(assembler.encode('utf-8'))
+        for sequence in sequences:
+            digest.update(b'\n')
+            digest.update(sequence.encode('utf-8'))
+        return digest.hexdigest()
+
+    @property
+    def connection(self):
+        """Return a connection to the database at self.path, reconnecting in forked processes."""
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = None
+            connection = sqlite3.connect(self.path, timeout=DATABASE_TIMEOUT, check_same_thread=False)
+            # Readers don't block the writer in WAL mode, and transactions are only synced at checkpoints
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS assemblies (key TEXT PRIMARY KEY, contigs TEXT)')
+            connection.commit()
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, key):
+        """Return cached contigs as list of (sequence, read indices) tuples or None if `key` is not cached."""
+        with self._lock:
+            contigs = self._memory.pop(key, None)
+            if contigs is None and self.path:
+                try:
+                    row = self.connection.execute('SELECT contigs FROM assemblies WHERE key = ?', (key,)).fetchone()
+                except sqlite3.DatabaseError as e:
+                    logger.warning("Could not read assembly from '%s' (%s)", self.path, e)
+                    row = None
+                if row:
+                    contigs = [(sequence, indices) for sequence, indices in json.loads(row[0])]
+            if contigs is not None:
+                self._remember(key, contigs)
+            return contigs
+
+    def set(self, key, contigs):
+        """Cache contigs, a list of (sequence, read indices) tuples."""
+        with self._lock:
+            self._remember(key, contigs)
+            if self.path:
+                self._pending.append((key, json.dumps(contigs)))
+                if len(self._pending) >= WRITE_BATCH_SIZE:
+                    self.flush()
+
+    def flush(self):
+        """Write pending assemblies to the database, pending assemblies are discarded if the database can't be written."""
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            try:
+                with self.connection:
+                    self.connection.executemany('INSERT OR REPLACE INTO assemblies VALUES (?, ?)', pending)
+            except sqlite3.DatabaseError as e:
+                logger.warning("Could not write %d assemblies to '%s' (%s)", len(pending), self.path, e)
+
+    def close(self):
+        """Write pending assemblies and close the connection to the database."""
+        with self._lock:
+            self.flush()
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+    def _remember(self, key, contigs):
+        self._memory[key] = contigs
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        """Remove all assemblies held in memory."""
+        with self._lock:
+            self._memory.clear()
+
+
+ASSEMBLY_CACHE = AssemblyCache()
+# Default in-memory cache, shared by all assemblies of a process that don't use a database
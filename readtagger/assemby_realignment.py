@@ -1,9 +1,10 @@
 import pysam
 
+from .assembly import DEFAULT_ASSEMBLER
 from .bam_io import index_bam
 from .bwa import SimpleAligner
-from .cap3 import Cap3Assembly
 from .cigar import alternative_alignment_cigar_is_better
+from .compact_read import CompactRead
 from .readtagger import SamTagProcessor
 
 
@@ -14,47 +15,95 @@ class AssemblyRealigner(object):
                  input_alignment_file,
                  genome_bwa_index,
                  transposon_bwa_index,
-                 tmp_dir=None):  # Make that configurable ...
-        """Assemble reads and align contigs in a cluster to improve breakpoints."""
+                 tmp_dir=None,  # Make that configurable ...
+                 assembler=None,
+                 process_limiter=None):
+        """
+        Assemble reads and align contigs in a cluster to improve breakpoints.
+
+        Reads are assembled by `assembler`, bwa waits for free slots of `process_limiter` if it is given.
+        """
         self.input_alignment_file = input_alignment_file
         self.reference_genome_index = genome_bwa_index
         self.transposon_index = transposon_bwa_index
-        self.genome_aligner = SimpleAligner(bwa_index=genome_bwa_index, tmp_dir=tmp_dir)
-        self.transposon_aligner = SimpleAligner(bwa_index=transposon_bwa_index, tmp_dir=tmp_dir)
+        self.assembler = assembler or DEFAULT_ASSEMBLER
+        self.genome_aligner = SimpleAligner(bwa_index=genome_bwa_index, tmp_dir=tmp_dir, process_limiter=process_limiter)
+        self.transposon_aligner = SimpleAligner(bwa_index=transposon_bwa_index, tmp_dir=tmp_dir, process_limiter=process_limiter)
 
     def collect_reads(self, cluster):
         """Collect reads that could be useful for determining a clusters breakpoint via assembly."""
-        informative_reads = []
+        return self.realign_clusters([cluster])[0]
+
+    def realign_clusters(self, clusters, executor=None):
+        """
+        Assemble reads for all `clusters` and realign contigs of all clusters in one genome and one transposon alignment.
+
+        If `executor` is given the reads of different clusters are assembled concurrently.
+        Returns a list with the informative contigs of each cluster, named as if each cluster had been realigned separately.
+        """
+        read_sets = {}
+        index_bam(self.input_alignment_file)  # Should not be necessary, but tests fail without this :(
+        with pysam.AlignmentFile(self.input_alignment_file) as reader:
+            for index, cluster in enumerate(clusters):
+                if cluster.abnormal:
+                    continue
+                reads = self.informative_sequences(cluster, reader)
+                if 0 < len(reads) < 500:
+                    read_sets[index] = reads
+        indices = sorted(read_sets)
+        map_function = executor.map if executor else map
+        contig_sequences = {}
+        contig_names = {}
+        for index, assembly in zip(indices, map_function(self.assembler.assemble, [read_sets[index] for index in indices])):
+            for i, contig in enumerate(assembly.contigs):
+                key = "%d|%d" % (index, i)
+                contig_sequences[key] = contig.sequence
+                contig_names[key] = str(i)
+        informative_reads = [[] for _ in clusters]
+        for key, read in self._realign_contigs(contig_sequences, contig_names=contig_names):
+            informative_reads[int(key.split('|')[0])].append(read)
+        return informative_reads
+
+    def informative_sequences(self, cluster, reader):
+        """Return sequences and mate sequences of reads in `reader` that overlap `cluster` but are not part of `cluster`."""
+        reads = {}
         if len(cluster.orientation_switches) > 1:
             # For now only use this strategy to refine potential TSDs,
             # may be interesting for improving insertions with single-sided evidence as well.
             start = cluster.min
             end = cluster.max
-            reads = {}
-            index_bam(self.input_alignment_file)  # Should not be necessary, but tests fail without this :(
-            with pysam.AlignmentFile(self.input_alignment_file) as reader:
-                for r in reader.fetch(tid=cluster.tid, start=start, end=end):
-                    if r.query_name not in cluster.read_index and r.has_tag('MS') and not r.is_duplicate:
-                        qname = r.query_name
-                        if r.is_read1:
-                            current_qname = "%s.1" % qname
-                            other_qname = "%s.2" % qname
-                        else:
-                            current_qname = "%s.2" % qname
-                            other_qname = "%s.1" % qname
-                        reads[current_qname] = r.query_sequence
-                        reads[other_qname] = r.get_tag('MS')
-            if 0 < len(reads) < 500:
-                informative_reads = self.assemble_reads(reads)
-        return informative_reads
+            for r in reader.fetch(tid=cluster.tid, start=start, end=end):
+                if r.query_name not in cluster.read_index and r.has_tag('MS') and not r.is_duplicate:
+                    qname = r.query_name
+                    if r.is_read1:
+                        current_qname = "%s.1" % qname
+                        other_qname = "%s.2" % qname
+                    else:
+                        current_qname = "%s.2" % qname
+                        other_qname = "%s.1" % qname
+                    reads[current_qname] = r.query_sequence
+                    reads[other_qname] = r.get_tag('MS')
+        return reads
 
     def assemble_reads(self, reads):
         """Assemble potentially informative reads, align and set tags for contigs."""
-        assembly = Cap3Assembly(reads)
-        contig_sequences = {i: contig.sequence for i, contig in enumerate(assembly.contigs)}
+        assembly = self.assembler.assemble(reads)
+        return self.realign_contigs({i: contig.sequence for i, contig in enumerate(assembly.contigs)})
+
+    def realign_contigs(self, contig_sequences):
+        """Align contigs to genome and transposons and set tags for contigs that align better to a transposon."""
+        return [read for _, read in self._realign_contigs(contig_sequences)]
+
+    def _realign_contigs(self, contig_sequences, contig_names=None):
+        """
+        Yield tuples of key in `contig_sequences` and tagged contig for contigs that align better to a transposon.
+
+        If `contig_names` is given, contigs are renamed to the name of their key in `contig_names`.
+        """
+        if not contig_sequences:
+            return
         genome_aligned_contigs, genome_header = self.genome_aligner.align_contigs(contig_sequences)
         transposon_aligned_contigs, transposon_header = self.transposon_aligner.align_contigs(contig_sequences)
-        informative_reads = []
         if transposon_aligned_contigs and genome_aligned_contigs:
             transposon_tags = SamTagProcessor(source_bam=transposon_aligned_contigs, header=transposon_header, tag_mate=False)
             for gc in genome_aligned_contigs:
@@ -63,8 +112,11 @@ class AssemblyRealigner(object):
                     if alternative_alignment_cigar_is_better(current_cigar=gc.cigar,
                                                              alternative_cigar=tag.cigar,
                                                              same_orientation=gc.is_reverse == tag.is_reverse):
+                        key = gc.query_name
+                        if contig_names:
+                            gc.query_name = contig_names[key]
                         gc.set_tag('AD', str(tag))
                         gc.set_tag('AR', str(tag.reference_name()))
                         gc.set_tag('AC', gc.query_name)
-                        informative_reads.append(gc)
-        return informative_reads
+                        # Contigs are not part of the input alignment file, so we keep the full segment
+                        yield key, CompactRead(gc, keep_segment=True)
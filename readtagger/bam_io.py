@@ -3,11 +3,20 @@ import logging
 import os
 import shutil
 import tempfile
+import threading
+from heapq import (
+    heappop,
+    heappush
+)
 import pysam
 import compare_reads
 
 logger = logging.getLogger(__name__)
 
+SHARED_READER_PATH = None
+# Set in worker processes by `share_readers`, readers of this path stay open and are reused
+_SHARED_READERS = {}
+
 
 def is_file_coordinate_sorted(path, reads_to_check=1000):
     """Determine if first 1000 reads are coordinate sorted."""
@@ -141,6 +150,62 @@ def merge_bam(bam_collection, output_path, template_bam=None, sort_order=None, t
     return output_path
 
 
+def merge_sorted_bam(bam_collection, output_path, threads=1, remove_inputs=True):
+    """
+    Merge coordinate sorted BAM files into a coordinate sorted BAM file at `output_path`.
+
+    Files are only opened once the merged output reaches their first read,
+    so that files of disjoint regions are effectively concatenated without opening all files at once.
+    Input files are removed after merging if `remove_inputs` is True.
+    """
+    bam_collection = [bam for bam in bam_collection if os.path.exists(bam)]
+    if not bam_collection:
+        return None
+    with pysam.AlignmentFile(bam_collection[0]) as template:
+        header = template.header.to_dict()
+    header.setdefault('HD', {'VN': '1.0'})['SO'] = 'coordinate'
+    pending = []
+    for index, path in enumerate(bam_collection):
+        with pysam.AlignmentFile(path) as f:
+            first_read = next(f, None)
+        if first_read is not None:
+            pending.append((coordinate_sort_key(first_read), index, path))
+    pending.sort(reverse=True)
+    heap = []
+    with pysam.AlignmentFile(output_path, mode='wb', header=header, threads=threads) as out:
+        while heap or pending:
+            if pending and (not heap or pending[-1][0] <= heap[0][0]):
+                # The next file starts before the lowest read we have seen so far
+                _, index, path = pending.pop()
+                f = pysam.AlignmentFile(path)
+                reads = iter(f)
+                r = next(reads)
+            else:
+                _, index, r, f, reads = heappop(heap)
+                out.write(r)
+                r = next(reads, None)
+            if r is None:
+                f.close()
+            else:
+                heappush(heap, (coordinate_sort_key(r), index, r, f, reads))
+    if remove_inputs:
+        for bam in bam_collection:
+            try:
+                os.remove(bam)
+            except OSError:
+                pass
+    return output_path
+
+
+def coordinate_sort_key(r):
+    """
+    Return a key that sorts reads (or CompactRead instances) in the order of a coordinate sorted BAM file.
+
+    Unmapped reads without position have a tid of -1 and belong at the end of the file.
+    """
+    return (r.tid if r.tid >= 0 else float('inf'), r.reference_start)
+
+
 def sort_bam(inpath, output, sort_order, threads=1, cram=False, reference_fasta=None):
     """
     Sort bam file at inpath using sort_order and write output to `output`.
@@ -181,9 +246,7 @@ def split_locations_between_clusters(bamfile, self_tag='AD', other_tag='BD', dis
     limit_start = None
     limit_end = None
     if region:
-        region = region.split(':')
-        limit_chrom = region[0]
-        limit_start, limit_end = [int(i) for i in region[1].split('-')]
+        limit_chrom, limit_start, limit_end = parse_region(region)
     with pysam.AlignmentFile(bamfile) as f:
         name_length = [(chrom['SN'], chrom['LN']) for chrom in f.header['SQ']]
         chunks = []
@@ -207,6 +270,119 @@ def split_locations_between_clusters(bamfile, self_tag='AD', other_tag='BD', dis
     return chunks
 
 
+def merge_intervals(intervals):
+    """
+    Merge sorted 1-based, closed (chrom, start, end) `intervals` that overlap or touch.
+
+    >>> merge_intervals([('2L', 100, 200), ('2L', 201, 300), ('2L', 250, 400), ('2L', 402, 500), ('3R', 10, 20)])
+    [('2L', 100, 400), ('2L', 402, 500), ('3R', 10, 20)]
+    """
+    merged = []
+    for chrom, start, end in intervals:
+        if merged and merged[-1][0] == chrom and start <= merged[-1][2] + 1:
+            merged[-1] = (chrom, merged[-1][1], max(end, merged[-1][2]))
+        else:
+            merged.append((chrom, start, end))
+    return merged
+
+
+def regions_from_bed(path, bamfile):
+    """
+    Return regions for the intervals in the BED file at `path`, merging intervals that overlap or touch.
+
+    Regions are returned in the reference order of `bamfile`, intervals on references not present in `bamfile`
+    and empty intervals are skipped.
+    """
+    with pysam.AlignmentFile(bamfile) as f:
+        reference_order = {name: tid for tid, name in enumerate(f.references)}
+    intervals = []
+    with open(path) as bed:
+        for line in bed:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.split('\t')
+            chrom, start, end = fields[0], int(fields[1]), int(fields[2])
+            if chrom not in reference_order:
+                logger.warning("Skipping interval on reference '%s', it is not present in '%s'", chrom, bamfile)
+                continue
+            if end <= start:
+                logger.warning("Skipping empty interval '%s:%s-%s' in '%s'", chrom, start, end, path)
+                continue
+            # BED intervals are 0-based and half-open, regions are 1-based and closed
+            intervals.append((chrom, start + 1, end))
+    intervals.sort(key=lambda interval: (reference_order[interval[0]], interval[1], interval[2]))
+    merged = merge_intervals(intervals)
+    logger.info("Merged %d intervals in '%s' into %d regions", len(intervals), path, len(merged))
+    return ["%s:%s-%s" % interval for interval in merged]
+
+
+def fetch_with_offsets(alignment_file, *args, **kwargs):
+    """
+    Fetch reads from `alignment_file` and yield tuples of (virtual_offset, read).
+
+    The virtual offset is the position of the file after reading the previous read,
+    which is the start of the current read unless the fetch iterator moved to a different chunk.
+    The offset of the first read is `None`.
+    """
+    virtual_offset = None
+    for r in alignment_file.fetch(*args, **kwargs):
+        yield virtual_offset, r
+        virtual_offset = alignment_file.tell()
+
+
+def parse_region(region):
+    """
+    Return a tuple of reference name, start and end for `region`.
+
+    Start and end are None if `region` spans the whole reference.
+
+    >>> parse_region('3R:13,373,000-13374000')
+    ('3R', 13373000, 13374000)
+    >>> parse_region('chrUn_KN707606v1_decoy')
+    ('chrUn_KN707606v1_decoy', None, None)
+    """
+    if ':' not in region:
+        return region, None, None
+    chrom, interval = region.rsplit(':', 1)
+    start, end = [int(i.replace(',', '')) for i in interval.split('-')]
+    return chrom, start, end
+
+
+def pad_region(region, padding):
+    """
+    Extend `region` by `padding` nucleotides on both sides.
+
+    >>> pad_region('3R:13373000-13374000', 500)
+    '3R:13372500-13374500'
+    >>> pad_region('3R:100-200', 500)
+    '3R:1-700'
+    >>> pad_region('3R', 500)
+    '3R'
+    """
+    chrom, start, end = parse_region(region)
+    if start is None:
+        return region
+    return "%s:%s-%s" % (chrom, max(start - padding, 1), end + padding)
+
+
+def write_region_buffer(input_path, region, output_path, padding=0):
+    """
+    Copy reads overlapping `region` (extended by `padding`) from `input_path` to an indexed BAM file at `output_path`.
+
+    The copy can be read repeatedly by later stages,
+    so that the (potentially remote) input file is only read once per region.
+    """
+    index_bam(input_path)
+    reads = 0
+    with pysam.AlignmentFile(input_path) as f, pysam.AlignmentFile(output_path, mode='wb', template=f) as out:
+        for r in f.fetch(region=pad_region(region, padding)):
+            out.write(r)
+            reads += 1
+    index_bam(output_path)
+    logger.info("Buffered %d reads of region '%s' in '%s'", reads, region, output_path)
+    return output_path
+
+
 def find_end(f, chrom, end, self_tag, other_tag, padding=5000):
     """Find a position where the distance between tags is high and we can split safely."""
     min_end = end - padding
@@ -270,6 +446,20 @@ class BamAlignmentWriter(object):
         self.close()
 
 
+def share_readers(path):
+    """
+    Keep readers of the alignment file at `path` open in this process and reuse them.
+
+    Each thread gets its own reader, readers of a previously shared path are closed.
+    """
+    global SHARED_READER_PATH
+    if path != SHARED_READER_PATH:
+        for af in _SHARED_READERS.values():
+            af.close()
+        _SHARED_READERS.clear()
+        SHARED_READER_PATH = path
+
+
 class BamAlignmentReader(object):
     """Wraps pysam.AlignmentFile with sambamba for reading if input file is a bam file."""
 
@@ -301,10 +491,20 @@ class BamAlignmentReader(object):
 
     def close(self):
         """Close filehandles and subprocess safely."""
-        self.af.close()
+        if self.path != SHARED_READER_PATH:
+            self.af.close()
 
     def __enter__(self):
         """Provide context handler entry."""
+        if self.path == SHARED_READER_PATH:
+            key = threading.current_thread().ident
+            self.af = _SHARED_READERS.get(key)
+            if self.af is None:
+                self.af = _SHARED_READERS[key] = pysam.AlignmentFile(self.path, threads=self.threads - 1)
+            else:
+                # Start at the first read, like a newly opened reader
+                self.af.reset()
+            return self.af
         self.af = pysam.AlignmentFile(self.path, threads=self.threads - 1)
         return self.af
 
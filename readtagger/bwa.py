@@ -9,6 +9,7 @@ except ImportError:
     from backports.tempfile import TemporaryDirectory
 
 from .fasta_io import write_sequences
+from .process_limit import external_process_slots
 
 logger = logging.getLogger(__name__)
 
@@ -42,11 +43,12 @@ class Description(object):
 class Bwa(object):
     """Hold alignment data and methods."""
 
-    def __init__(self, input_path, bwa_index=None, reference_fasta=None, threads=1, describe_alignment=True):
+    def __init__(self, input_path, bwa_index=None, reference_fasta=None, threads=1, describe_alignment=True, process_limiter=None):
         """
         BWA object for `sequences`.
 
-        Align sequences in fastq/fasta file `input_path` to bwa_index or construct a new index using reference_fasta
+        Align sequences in fastq/fasta file `input_path` to bwa_index or construct a new index using reference_fasta.
+        If `process_limiter` is given, bwa waits for free slots of this ProcessLimiter.
 
         >>> from tests.helpers import roo_seq
         >>> with TemporaryDirectory(prefix='bwa_doctest') as tempdir:
@@ -64,6 +66,7 @@ class Bwa(object):
         self.reference_fasta = reference_fasta
         self.threads = threads
         self.describe_alignment = describe_alignment
+        self.process_limiter = process_limiter
         self.bwa_run = self.run()
         if self.describe_alignment:
             self.clusters = self.reads_to_clusters()
@@ -74,15 +77,16 @@ class Bwa(object):
         with TemporaryDirectory(prefix='BWA') as temp_dir:
             temp_dir = str(temp_dir)
             if not self.bwa_index:
-                self.bwa_index, _ = make_bwa_index(self.reference_fasta, dir=temp_dir)
-            proc = subprocess.Popen(['bwa', 'mem', '-B9', '-O16', '-L5', '-Y', '-t', str(self.threads), self.bwa_index, self.input_path],
-                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-            f = pysam.AlignmentFile(proc.stdout)
-            self.header = f.header
-            reads = [r for r in f]
-            proc.stdout.close()
-            wait_and_get_return_code(proc)
-            proc.stderr.close()
+                self.bwa_index, _ = make_bwa_index(self.reference_fasta, dir=temp_dir, process_limiter=self.process_limiter)
+            with external_process_slots(self.threads, limiter=self.process_limiter) as threads:
+                proc = subprocess.Popen(['bwa', 'mem', '-B9', '-O16', '-L5', '-Y', '-t', str(threads), self.bwa_index, self.input_path],
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+                f = pysam.AlignmentFile(proc.stdout)
+                self.header = f.header
+                reads = [r for r in f]
+                proc.stdout.close()
+                wait_and_get_return_code(proc)
+                proc.stderr.close()
             return reads
 
     def reads_to_clusters(self):
@@ -185,12 +189,13 @@ class Bwa(object):
 class SimpleAligner(object):
     """Perform simple alignments, e.g to see if a read is contained in a contig."""
 
-    def __init__(self, reference_sequences=None, bwa_index=None, tmp_dir=None):
+    def __init__(self, reference_sequences=None, bwa_index=None, tmp_dir=None, process_limiter=None):
         """Perform simple alignments, e.g to see if a read is contained in a contig."""
         self.tmp_dir = tmp_dir
+        self.process_limiter = process_limiter
         if not bwa_index:
             self.reference_fasta = write_sequences(reference_sequences)
-            self.index, self.return_code = make_bwa_index(self.reference_fasta)
+            self.index, self.return_code = make_bwa_index(self.reference_fasta, process_limiter=process_limiter)
         else:
             self.index = bwa_index
 
@@ -204,13 +209,13 @@ class SimpleAligner(object):
     def align(self, sequence):
         """Return contig numbers with valid alignments for sequence."""
         sequences = write_sequences(sequence, tmp_dir=self.tmp_dir)
-        aligned_reads = Bwa(input_path=sequences, bwa_index=self.index, describe_alignment=False)
+        aligned_reads = Bwa(input_path=sequences, bwa_index=self.index, describe_alignment=False, process_limiter=self.process_limiter)
         return set(r.tid for r in aligned_reads.bwa_run if not r.is_unmapped)
 
     def align_contigs(self, contigs):
         """Align contigs and return aligned results and header."""
         sequences = write_sequences(contigs, tmp_dir=self.tmp_dir)
-        bwa_result = Bwa(input_path=sequences, bwa_index=self.index, describe_alignment=False)
+        bwa_result = Bwa(input_path=sequences, bwa_index=self.index, describe_alignment=False, process_limiter=self.process_limiter)
         return bwa_result.bwa_run, bwa_result.header
 
     def cleanup_index(self):
@@ -229,17 +234,18 @@ def cleanup_index(index_path):
             pass
 
 
-def make_bwa_index(reference_fasta, dir='.'):
+def make_bwa_index(reference_fasta, dir='.', process_limiter=None):
     """Make a bwa index for reference_fasta and return path to the index's basename."""
     fasta_basename = os.path.basename(reference_fasta)
     target_fasta = os.path.abspath(os.path.join(dir, fasta_basename))
     if not os.path.exists(target_fasta):
         os.symlink(os.path.abspath(reference_fasta), target_fasta)
     args = ['bwa', 'index', target_fasta]
-    return_code = wait_and_get_return_code(subprocess.Popen(args,
-                                                            env=os.environ.copy(),
-                                                            close_fds=True,
-                                                            stderr=subprocess.PIPE))
+    with external_process_slots(limiter=process_limiter):
+        return_code = wait_and_get_return_code(subprocess.Popen(args,
+                                                                env=os.environ.copy(),
+                                                                close_fds=True,
+                                                                stderr=subprocess.PIPE))
     return target_fasta, return_code
 
 
@@ -3,8 +3,8 @@ import os
 import subprocess
 import abc
 
-from Bio.Sequencing import Ace
 from .fasta_io import write_sequences
+from .process_limit import external_process_slots
 
 # compatible with Python 2 *and* 3:
 ABC = abc.ABCMeta('ABC', (object,), {'__slots__': ()})
@@ -16,34 +16,125 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 
+class Contig(object):
+    """Hold the sequence of a contig and the names of the reads assembled into the contig."""
+
+    __slots__ = ('name', 'sequence', 'read_names')
+
+    def __init__(self, name, sequence, read_names):
+        """Initialize Contig instance."""
+        self.name = name
+        self.sequence = sequence
+        self.read_names = read_names
+
+    def __repr__(self):
+        """
+        Represent contig by name and number of reads, if the names of its reads are known.
+
+        >>> Contig('Contig1', 'ACGT', ['read1', 'read2'])
+        Contig(Contig1, 2 reads)
+        >>> Contig('Contig1', 'ACGT', None)
+        Contig(Contig1)
+        """
+        if self.read_names is None:
+            return "Contig(%s)" % self.name
+        return "Contig(%s, %d reads)" % (self.name, len(self.read_names))
+
+
 class BaseAssembly(ABC):
     """Provide Base Class for Assembly modules."""
 
+    requires_input_file = True
+    # Whether sequences need to be written to a fasta file in `input_dir` before calling `assemble`
+    failed = False
+    # Set to True if the assembler failed, failed assemblies are not cached
+
     def __init__(self, sequences, shm_dir):
         """Run assembly."""
         self.sequences = sequences
-        with TemporaryDirectory(prefix="%s" % type(self).__name__, dir=shm_dir) as self.input_dir:
-            self.input_path = os.path.join(self.input_dir, 'multialign.fa')
-            self.write_sequences()
+        if self.requires_input_file:
+            with TemporaryDirectory(prefix="%s" % type(self).__name__, dir=shm_dir) as self.input_dir:
+                self.input_path = os.path.join(self.input_dir, 'multialign.fa')
+                self.write_sequences()
+                self.contigs = self.assemble()
+        else:
             self.contigs = self.assemble()
 
     @abc.abstractmethod
     def assemble(self):
         """Must return contigs."""
 
+    @property
+    def contig_read_names(self):
+        """Return a list with the names of the reads in each contig, or None for contigs without read names."""
+        return [contig.read_names for contig in self.contigs]
+
     def write_sequences(self):
         """Take sequences and write them out to a temporary file for cap3."""
         write_sequences(sequences=self.sequences, output_path=self.input_path)
 
 
+def read_contig_sequences(path):
+    r"""
+    Return a list of (name, sequence) tuples for contigs in the cap3 `.cap.contigs` fasta file at `path`.
+
+    >>> import tempfile
+    >>> fd, path = tempfile.mkstemp()
+    >>> with open(path, 'w') as out:
+    ...     _ = out.write('>Contig1\nATGC\nATGC\n>Contig2\nGGCC\n')
+    >>> read_contig_sequences(path)
+    [('Contig1', 'ATGCATGC'), ('Contig2', 'GGCC')]
+    >>> os.close(fd)
+    >>> os.remove(path)
+    """
+    contigs = []
+    with open(path) as fasta:
+        for line in fasta:
+            line = line.strip()
+            if line.startswith('>'):
+                contigs.append((line[1:].split()[0], []))
+            elif line:
+                contigs[-1][1].append(line)
+    return [(name, "".join(sequence)) for name, sequence in contigs]
+
+
+def read_contig_read_names(path):
+    r"""
+    Return a dictionary of contig name to the names of reads in the contig for the ACE file at `path`.
+
+    Only the `CO` and `RD` lines of the ACE file are inspected.
+
+    >>> import tempfile
+    >>> fd, path = tempfile.mkstemp()
+    >>> with open(path, 'w') as out:
+    ...     _ = out.write('AS 1 2\n\nCO Contig1 8 2 1 U\nATGCATGC\n\nRD read1 4 0 0\nATGC\n\nRD read2 4 0 0\nATGC\n')
+    >>> read_contig_read_names(path)
+    {'Contig1': ['read1', 'read2']}
+    >>> os.close(fd)
+    >>> os.remove(path)
+    """
+    read_names = {}
+    with open(path) as ace:
+        for line in ace:
+            if line.startswith('CO '):
+                current_contig = read_names.setdefault(line.split()[1], [])
+            elif line.startswith('RD '):
+                current_contig.append(line.split()[1])
+    return read_names
+
+
 class Cap3Assembly(BaseAssembly):
     """A class that holds reads of a cluster and assembles them using cap3."""
 
     seq_limit = 800
 
-    def __init__(self, sequences, shm_dir=None):
+    def __init__(self, sequences, shm_dir=None, read_names=False, process_limiter=None):
         """Asssemble sequences into contigs.
 
+        Contig sequences are read from the `.cap.contigs` output of cap3.
+        The ACE file is only read if `read_names` is True, in which case contigs list the names of their reads.
+        If `process_limiter` is given, cap3 waits for a free slot of this ProcessLimiter.
+
         :param sequences: dictionary with query_name as key and read sequence as value
         :type sequences: dictionary
 
@@ -58,6 +149,8 @@ class Cap3Assembly(BaseAssembly):
         >>> len(Cap3Assembly(too_many_reads).contigs)
         0
         """
+        self.read_names = read_names
+        self.process_limiter = process_limiter
         super(Cap3Assembly, self).__init__(sequences=sequences, shm_dir=shm_dir)
 
     def assemble(self):
@@ -67,12 +160,16 @@ class Cap3Assembly(BaseAssembly):
                 args = ['cap3', self.input_path, '-p', '75', '-s', '500', '-z', '2']
                 try:
                     # Use check call to ignore stdout of cap3
-                    subprocess.check_call(args, stdout=DEVNULL, close_fds=True)
+                    with external_process_slots(limiter=self.process_limiter):
+                        subprocess.check_call(args, stdout=DEVNULL, close_fds=True)
                 except subprocess.CalledProcessError as e:
                     logger.error("An error occured while attempting to assemble reads: "
                                  "%s\n The problematic sequences are: %s", e, self.sequences)
-                    return Ace.ACEFileRecord().contigs
-            return Ace.read(open(os.path.join(self.input_dir, 'multialign.fa.cap.ace'))).contigs
+                    self.failed = True
+                    return []
+            contig_sequences = read_contig_sequences("%s.cap.contigs" % self.input_path)
+            contig_read_names = read_contig_read_names("%s.cap.ace" % self.input_path) if self.read_names else {}
+            return [Contig(name=name, sequence=sequence, read_names=contig_read_names.get(name)) for name, sequence in contig_sequences]
         else:
             # We return an empty record if there are too many sequences to assemble
-            return Ace.ACEFileRecord().contigs
+            return []
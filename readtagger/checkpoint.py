@@ -0,0 +1,118 @@
+"""Keep track of regions that have been processed completely, so that interrupted runs can be resumed."""
+import json
+import logging
+import os
+import re
+from hashlib import md5
+
+import pysam
+
+from .bam_io import pad_region
+from .tag_index import TAGS
+
+logger = logging.getLogger(__name__)
+
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+# Number of bytes at the start and at the end of the input file that are included in the input checksum
+MANIFEST_NAME = 'manifest.jsonl'
+
+
+def input_checksum(path):
+    """Return a checksum of the size and the first and last CHECKSUM_CHUNK_SIZE bytes of the file at `path`."""
+    size = os.path.getsize(path)
+    digest = md5(str(size).encode('utf-8'))
+    with open(path, 'rb') as f:
+        digest.update(f.read(CHECKSUM_CHUNK_SIZE))
+        f.seek(max(size - CHECKSUM_CHUNK_SIZE, 0))
+        digest.update(f.read(CHECKSUM_CHUNK_SIZE))
+    return digest.hexdigest()
+
+
+def parameters_hash(kwds, exclude=()):
+    """
+    Return a hash of all parameters in `kwds` except the keys in `exclude`.
+
+    >>> parameters_hash({'min_mapq': 4, 'region': '2L'}, exclude=('region',)) == parameters_hash({'min_mapq': 4})
+    True
+    """
+    parameters = {k: v for k, v in kwds.items() if k not in exclude}
+    return md5(json.dumps(parameters, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def tagged_reads_fingerprint(input_path, region, padding=0):
+    """
+    Return a hash of positions and tag values of all reads with an AD or BD tag in `region` (extended by `padding`).
+
+    The fingerprint of a region changes if its reads are tagged differently, e.g. after tagging with an updated transposon library.
+    """
+    digest = md5()
+    with pysam.AlignmentFile(input_path) as f:
+        for r in f.fetch(region=pad_region(region, padding)):
+            tags = [(tag, r.get_tag(tag)) for tag in TAGS if r.has_tag(tag)]
+            if tags:
+                digest.update(("%s\t%d\t%d\t%s\t%s\n" % (r.query_name, r.flag, r.reference_start, r.cigarstring, tags)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def region_file_prefix(region):
+    """
+    Return a string that can be used as part of a filename for `region`.
+
+    >>> region_file_prefix('2L:1-1000001')
+    '2L_1-1000001_d9358b17'
+    """
+    safe_region = re.sub(r'[^\w.-]', '_', region)
+    return "%s_%s" % (safe_region, md5(region.encode('utf-8')).hexdigest()[:8])
+
+
+class RegionManifest(object):
+    """
+    Record regions that have been processed completely in a manifest file in `work_dir`.
+
+    A region is complete if it has been processed with identical `parameters` for an input with identical `checksum`,
+    and if all outputs recorded for the region still exist.
+    A region of a different input is also complete if the recorded fingerprint of the tagged reads in the region is unchanged.
+    """
+
+    def __init__(self, work_dir, parameters, checksum):
+        """Initialize RegionManifest instance."""
+        self.path = os.path.join(work_dir, MANIFEST_NAME)
+        self.parameters = parameters
+        self.checksum = checksum
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as manifest:
+                for line in manifest:
+                    if line.strip():
+                        entry = json.loads(line)
+                        # Later entries replace earlier entries for the same region
+                        self.entries[entry['region']] = entry
+
+    def is_complete(self, region):
+        """Return whether `region` has been processed completely for the current input."""
+        entry = self.entries.get(region)
+        return bool(entry and entry['checksum'] == self.checksum and self._is_reusable(entry))
+
+    def recorded_fingerprint(self, region):
+        """
+        Return the fingerprint recorded for `region` if it has been processed completely for a different input.
+
+        The outputs of `region` can be reused if the fingerprint of the current input is unchanged.
+        """
+        entry = self.entries.get(region)
+        if entry and entry['checksum'] != self.checksum and self._is_reusable(entry):
+            return entry.get('fingerprint')
+
+    def _is_reusable(self, entry):
+        return entry['parameters'] == self.parameters and all(os.path.exists(path) for path in entry['outputs'].values())
+
+    def record(self, region, outputs, fingerprint=None):
+        """Record that `region` has been processed completely and written `outputs`, a dictionary of output paths."""
+        entry = {'region': region,
+                 'parameters': self.parameters,
+                 'checksum': self.checksum,
+                 'fingerprint': fingerprint,
+                 'outputs': {key: path for key, path in outputs.items() if path and os.path.exists(path)}}
+        with open(self.path, 'a') as manifest:
+            manifest.write("%s\n" % json.dumps(entry, sort_keys=True))
+        self.entries[region] = entry
@@ -3,6 +3,17 @@ import click
 from readtagger.findcluster import ClusterManager
 from readtagger import VERSION
 import multiprocessing_logging
+from readtagger.shards import parse_shard
+
+
+def validate_shard(ctx, param, value):
+    """Validate shards specified as number/count."""
+    if value:
+        try:
+            parse_shard(value)
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+    return value
 
 
 @click.command()
@@ -23,10 +34,12 @@ import multiprocessing_logging
                    'Reads will have an additional "CD" tag to indicate the cluster number',
               type=click.Path(exists=False))
 @click.option('--output_gff',
-              help='Write out GFF file with cluster information to this path.',
+              help='Write out GFF file with cluster information to this path. '
+                   'If the path ends with .gz the file is bgzip compressed and indexed with tabix.',
               type=click.Path(exists=False))
 @click.option('--output_vcf',
-              help='Write out VCF file with cluster information to this path.',
+              help='Write out VCF file with cluster information to this path. '
+                   'If the path ends with .gz the file is bgzip compressed and indexed with tabix.',
               type=click.Path(exists=False))
 @click.option('--output_fasta',
               help='Write out supporting evidence for clusters to this path.',
@@ -59,6 +72,66 @@ import multiprocessing_logging
               help='Genome BWA index to align clipped reads to',
               default=None,
               required=False)
+@click.option('--tag_index',
+              help='Only inspect reads listed in this index when finding clusters. '
+                   'The index can be created using the `index_tagged_reads` command.',
+              default=None,
+              type=click.Path(exists=True))
+@click.option('--remove_supplementary_without_primary/--no-remove_supplementary_without_primary',
+              help='Ignore supplementary alignments whose primary alignment is not present in the input file.',
+              default=False)
+@click.option('--buffer_region/--no-buffer_region',
+              help='Copy the reads of each region into a local temporary file that is read by all stages. '
+                   'Reduces I/O if the input file is on a slow or network filesystem.',
+              default=False)
+@click.option('--assembly_cache',
+              help='Store assembled contigs in an SQLite database at this path and reuse them in later runs.',
+              default=None,
+              type=click.Path(exists=False))
+@click.option('--assembly_target_reads',
+              help='Downsample reads supporting an insertion to this many reads before assembling them. '
+                   'Split reads are kept preferentially, followed by reads that add new sequence. '
+                   'By default reads are not downsampled, and cap3 does not assemble sets of 800 or more reads.',
+              default=None,
+              type=click.IntRange(2, 799))
+@click.option('--in_process_assembly/--no-in_process_assembly',
+              help='Assemble small sets of short reads in-process instead of calling cap3. '
+                   'Faster, but requires longer and more similar overlaps than cap3, so contigs can differ.',
+              default=False)
+@click.option('--regions_bed',
+              help='Only find clusters in the intervals of this BED file instead of the whole input file or --region. '
+                   'Overlapping or adjacent intervals are merged.',
+              default=None,
+              type=click.Path(exists=True))
+@click.option('--decoy_regions',
+              help='Append regions that are skipped because of an abnormally high cluster density to this file, '
+                   'and skip regions listed in this file for the same sample without reading them.',
+              default=None,
+              type=click.Path(exists=False))
+@click.option('--profile_report',
+              help='Write wall time, CPU time, memory usage and read, cluster and external process counts '
+                   'of each stage and region to this path as JSON.',
+              default=None,
+              type=click.Path(exists=False))
+@click.option('--work_dir',
+              help='Keep the outputs of each completed region in this directory and record them in a manifest. '
+                   'Rerunning with the same directory, input and parameters only processes missing or failed regions.',
+              default=None,
+              type=click.Path(file_okay=False))
+@click.option('--incremental/--no-incremental',
+              help='Reuse outputs in --work_dir of regions whose reads with AD or BD tags are unchanged, '
+                   'e.g. after tagging the input again with an updated transposon library.',
+              default=False)
+@click.option('--plan',
+              help='Write the regions that are processed separately to this file and exit. '
+                   'If --shard is given, process the regions listed in this file instead.',
+              default=None,
+              type=click.Path())
+@click.option('--shard',
+              help='Only process every n-th region, starting with region number i, specified as i/n. '
+                   'Outputs of all shards can be merged with the `merge_findcluster_shards` command.',
+              default=None,
+              callback=validate_shard)
 @click.option('--min_mapq',
               help="Only consider reads with MAPQ equal to or higher than this setting.",
               default=4,
@@ -0,0 +1,34 @@
+import click
+from readtagger.tag_index import (
+    MIN_MAPQ,
+    write_tag_index
+)
+from readtagger import VERSION
+
+
+@click.command()
+@click.option('-i',
+              '--input_path',
+              help='Index reads with an AD or BD tag and softclipped reads in this coordinate sorted BAM file.',
+              required=True,
+              type=click.Path(exists=True))
+@click.option('-o',
+              '--output_path',
+              help='Write index to this path. Default is to append ".tag_index" to input_path.',
+              default=None,
+              type=click.Path(exists=False))
+@click.option('--min_mapq',
+              help='Only index reads with MAPQ equal to or higher than this setting. '
+                   'The index is ignored by findcluster runs with a lower --min_mapq.',
+              default=MIN_MAPQ,
+              type=click.IntRange(0, 60))
+@click.option('--include_duplicates/--no-include_duplicates',
+              help='Index reads marked as duplicates. The index is ignored by findcluster runs with --include_duplicates otherwise.',
+              default=False)
+@click.version_option(version=VERSION)
+def index_tagged_reads(**kwargs):
+    """Index reads that findcluster needs to inspect."""
+    tag_index = write_tag_index(**kwargs)
+    fraction = 100.0 * tag_index.indexed_reads / max(tag_index.total_reads, 1)
+    click.echo("Indexed %d of %d reads (%.1f%%)" % (tag_index.indexed_reads, tag_index.total_reads, fraction))
+    click.echo(tag_index.path)
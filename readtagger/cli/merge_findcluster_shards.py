@@ -0,0 +1,58 @@
+import click
+
+from readtagger.findcluster import merge_region_files
+from readtagger.utils import files_need_csi_index
+from readtagger import VERSION
+
+EXTENSIONS = {'.bam': 'bam_files',
+              '.gff': 'gff_files',
+              '.gff3': 'gff_files',
+              '.vcf': 'vcf_files',
+              '.fa': 'fasta_files',
+              '.fasta': 'fasta_files'}
+COMPRESSED_EXTENSIONS = ('.gff', '.gff3', '.vcf')
+# Outputs findcluster can bgzip compress
+
+
+@click.command()
+@click.argument('input_files', nargs=-1, type=click.Path(exists=True), required=True)
+@click.option('--output_bam',
+              help='Merge BAM files of all shards into this path.',
+              type=click.Path(exists=False))
+@click.option('--output_gff',
+              help='Merge GFF files of all shards into this path. '
+                   'If the path ends with .gz the file is bgzip compressed and indexed with tabix.',
+              type=click.Path(exists=False))
+@click.option('--output_vcf',
+              help='Merge VCF files of all shards into this path. '
+                   'If the path ends with .gz the file is bgzip compressed and indexed with tabix.',
+              type=click.Path(exists=False))
+@click.option('--output_fasta',
+              help='Merge FASTA files of all shards into this path.',
+              type=click.Path(exists=False))
+@click.option('--csi_index/--no-csi_index',
+              help='Index compressed outputs with a CSI index, which is required for references longer than 2^29 nucleotides. '
+                   'By default a CSI index is used if a reference in the BAM or VCF inputs is that long.',
+              default=None)
+@click.option('-t',
+              '--threads',
+              help='Threads to use for compressing the merged BAM file', default=1, type=click.IntRange(1, 100))
+@click.version_option(version=VERSION)
+def merge_findcluster_shards(**kwds):
+    """
+    Merge the outputs of findcluster runs with the --shard option.
+
+    The type of each input file is determined by its extension (.bam, .gff, .vcf or .fasta),
+    GFF and VCF files may be bgzip compressed (.gff.gz or .vcf.gz).
+    """
+    files = {key: [] for key in EXTENSIONS.values()}
+    for path in kwds.pop('input_files'):
+        name = path[:-3] if path.endswith('.gz') else path
+        extension = "." + name.rsplit('.', 1)[-1]
+        if extension not in EXTENSIONS or (name != path and extension not in COMPRESSED_EXTENSIONS):
+            raise click.BadParameter("Can't determine the type of '%s'" % path, param_hint='input_files')
+        files[EXTENSIONS[extension]].append(path)
+    csi = kwds.pop('csi_index')
+    if csi is None:
+        csi = files_need_csi_index(bam_files=files['bam_files'], vcf_files=files['vcf_files'])
+    merge_region_files(remove_inputs=False, csi=csi, **dict(files, **kwds))
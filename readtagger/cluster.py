@@ -1,5 +1,6 @@
 from collections import (
     defaultdict,
+    deque,
     OrderedDict
 )
 from hashlib import md5
@@ -12,7 +13,9 @@ from .edlib_align import (
     multiple_sequences_overlap,
     sequences_overlap
 )
-from .cap3 import Cap3Assembly
+from .assembly import DEFAULT_ASSEMBLER
+from .bam_io import fetch_with_offsets
+from .compact_read import CompactRead
 from .genotype import Genotype
 from .instance_lru import instance_method_lru_cache
 from .tagcluster import TagCluster
@@ -28,6 +31,8 @@ MIN_VALID_ISIZE_FOR_NON_PROPER_PAIR = 700
 # of an isize that is too big, which can happen with deletions.
 MAX_COLLECT_EVIDENCE = 10000
 # maximum amount of evidence to consider
+EVIDENCE_WINDOW_PADDING = 500
+# reads up to this distance from a cluster are considered when collecting evidence
 
 
 class BaseCluster(list):
@@ -157,15 +162,22 @@ class Cluster(BaseCluster):
     ])
     source = "findcluster"
 
-    def __init__(self, shm_dir, max_proper_size=0):
-        """Initialize Cluster instance."""
+    def __init__(self, shm_dir, max_proper_size=0, assembler=None):
+        """Initialize Cluster instance, reads of this cluster and of clusters split from it are assembled by `assembler`."""
         super(Cluster, self).__init__()
         self.insert_reference_name = None
         self.max_proper_size = max_proper_size
         self.shm_dir = shm_dir
+        self.assembler = assembler or DEFAULT_ASSEMBLER
         self._cannot_join_d = {}
         self.abnormal = False
         self.softclip_clusters = []
+        self.capped = False
+        self.capped_reads = 0
+        self.capped_max = 0
+        self.capped_last_start = None
+        self._support_read_names = None
+        self._support_reads = 0
 
     @property
     def evidence_spanning_insertion(self):
@@ -277,7 +289,41 @@ class Cluster(BaseCluster):
     @property
     def max(self):
         """Return reference end of last read added to cluster."""
-        return max((r.reference_end for r in self))
+        end = max((r.reference_end for r in self))
+        if self.capped_reads:
+            return max(end, self.capped_max)
+        return end
+
+    @property
+    def last_start(self):
+        """Return the reference start of the last read that has been added to this cluster."""
+        if self.capped_reads:
+            return self.capped_last_start
+        return self[-1].reference_start
+
+    def add_read(self, r, max_clustersupport=None):
+        """
+        Append read `r`, unless more than `max_clustersupport` reads support this cluster.
+
+        Such clusters are removed by `ClusterFinder.clean_clusters`, so we only keep track of the number of further reads
+        and of the cluster boundaries. Whether further reads are compatible with the cluster is then determined
+        based on the reads present when the cluster reached `max_clustersupport`.
+        """
+        if self.capped:
+            self.capped_reads += 1
+            self.capped_max = max(self.capped_max, r.reference_end)
+            self.capped_last_start = r.reference_start
+            return
+        self.append(r)
+        if max_clustersupport is not None and len(self) > max_clustersupport:
+            if self._support_read_names is None or self._support_reads != len(self) - 1:
+                # Build the index once (or again if reads have been added without `add_read`), then keep it up to date
+                self._support_read_names = self.read_index
+            elif not r.has_tag('AC'):
+                self._support_read_names.add(r.query_name)
+            self._support_reads = len(self)
+            if len(self._support_read_names) > max_clustersupport:
+                self.capped = True
 
     def overlaps(self, r, strict=False):
         """Determine if r overlaps the current cluster."""
@@ -324,10 +370,9 @@ class Cluster(BaseCluster):
         """Return all orientation switches in this cluster."""
         return [next(group[1]) for group in groupby(self.orientation_vector, key=lambda x: x[0])]
 
-    def refine_members(self, assembly_realigner):
-        """Try to recover more reads that support a specific insertion."""
-        if assembly_realigner and not self.abnormal:
-            informative_reads = assembly_realigner.collect_reads(self)
+    def refine_members(self, informative_reads):
+        """Add reads that support a specific insertion, e.g contigs returned by `AssemblyRealigner.realign_clusters`."""
+        if not self.abnormal:
             for read in informative_reads:
                 if self.read_is_compatible(read, strict=True):
                     self.append(read)
@@ -337,7 +382,7 @@ class Cluster(BaseCluster):
         for other_cluster in self.reachable(all_clusters=all_clusters):
             if not self.abnormal and self.can_join(other_cluster, max_distance=self.max_proper_size):
                 if self.clustertag.tsd.is_valid or other_cluster.clustertag.tsd.is_valid:
-                    check = Cluster(shm_dir=self.shm_dir)
+                    check = Cluster(shm_dir=self.shm_dir, assembler=self.assembler)
                     check.extend(self + other_cluster)
                     if not check.clustertag.tsd.is_valid:
                         continue
@@ -384,7 +429,7 @@ class Cluster(BaseCluster):
 
     def _make_new_clusters(self, count=2):
         """Return a set of new clusters."""
-        return [Cluster(shm_dir=self.shm_dir, max_proper_size=self.max_proper_size) for _ in range(count)]
+        return [Cluster(shm_dir=self.shm_dir, max_proper_size=self.max_proper_size, assembler=self.assembler) for _ in range(count)]
 
     @staticmethod
     def _mark_clusters_incompatible(*clusters):
@@ -413,13 +458,13 @@ class Cluster(BaseCluster):
                     five_p_reads_to_to_discard.add(support_read)
         new_clusters = [self]
         if three_p_reads_to_to_discard:
-            new_three_p_cluster = Cluster(shm_dir=self.shm_dir, max_proper_size=self.max_proper_size)
+            new_three_p_cluster = Cluster(shm_dir=self.shm_dir, max_proper_size=self.max_proper_size, assembler=self.assembler)
             for read in three_p_reads_to_to_discard:
                 new_three_p_cluster.append(read)
                 self.remove(read)
             new_clusters.append(new_three_p_cluster)
         if five_p_reads_to_to_discard:
-            new_five_p_cluster = Cluster(shm_dir=self.shm_dir, max_proper_size=self.max_proper_size)
+            new_five_p_cluster = Cluster(shm_dir=self.shm_dir, max_proper_size=self.max_proper_size, assembler=self.assembler)
             for read in five_p_reads_to_to_discard:
                 new_five_p_cluster.append(read)
                 if read not in three_p_reads_to_to_discard:
@@ -441,16 +486,16 @@ class Cluster(BaseCluster):
         all_reads = {}
         all_reads.update(self.clustertag.left_sequences)
         all_reads.update(self.clustertag.right_sequences)
-        assembly = Cap3Assembly(all_reads)
+        assembly = self.assembler.assemble(all_reads, read_names=True, keep=self.clustertag.split_read_names)
         contigs = assembly.contigs
         contig_reads = []
         cluster_a_contigs = set()
         # Establish a list of contigs and their readnames,
         # And classify whether contigs belong to cluster a or cluster b.
-        for index, contig in enumerate(contigs):
+        for index, read_names in enumerate(assembly.contig_read_names):
             contig_reads.append(set())
-            for read in contig.reads:
-                readname = read.rd.name.rstrip('.1').rstrip('.2')
+            for read_name in read_names:
+                readname = read_name.rstrip('.1').rstrip('.2')
                 if readname in putative_cluster_a.read_index:
                     cluster_a_contigs.add(index)
                 contig_reads[index].add(readname)
@@ -468,9 +513,9 @@ class Cluster(BaseCluster):
                 # Because if they don't, they should probably be ignored and treated as a separate insertion.
                 sequences_to_align = [r.get_tag('MS') for r in switch_reads if r.has_tag('MS')]
                 if sequences_to_align and not multiple_sequences_overlap(queries=sequences_to_align, targets=contig_sequences):
-                    putative_cluster_a = Cluster(shm_dir=self.shm_dir, max_proper_size=self.max_proper_size)
+                    putative_cluster_a = Cluster(shm_dir=self.shm_dir, max_proper_size=self.max_proper_size, assembler=self.assembler)
                     putative_cluster_a.extend(switch_reads)
-                    putative_cluster_b = Cluster(shm_dir=self.shm_dir, max_proper_size=self.max_proper_size)
+                    putative_cluster_b = Cluster(shm_dir=self.shm_dir, max_proper_size=self.max_proper_size, assembler=self.assembler)
                     putative_cluster_b.extend(r for r in self if r.query_name not in putative_cluster_a.read_index)
                     return putative_cluster_a, putative_cluster_b
             reads_to_remove = set()
@@ -504,7 +549,7 @@ class Cluster(BaseCluster):
 
     @instance_method_lru_cache(maxsize=10000)
     def _get_clustertag(self):
-        return TagCluster(self, shm_dir=self.shm_dir)
+        return TagCluster(self, shm_dir=self.shm_dir, assembler=self.assembler)
 
     def can_join(self, other_cluster, max_distance=1500):
         """
@@ -778,37 +823,102 @@ class Cluster(BaseCluster):
         return self.start, self.end, bp_sequences, single_breakpoint
 
 
-def collect_evidence(cluster, alignment_file):
-    """Count all reads that point against evidence for a transposon insertion."""
-    chromosome = cluster.reference_name
-    start = cluster.start
-    end = cluster.end
-    min_start = start - 500
+def evidence_window(cluster):
+    """Return chromosome, start and end of the region in which reads are counted as evidence for `cluster`."""
+    min_start = cluster.start - EVIDENCE_WINDOW_PADDING
     if min_start < 0:
         # Avoid pysam error for negative start coordinates
         min_start = 0
-    max_end = end + 500
-    start, end, bp_sequence, single_breakpoint = cluster.serialize()
-    reads = alignment_file.fetch(chromosome, min_start, max_end)
-    for i, r in enumerate(reads):
-        if i <= MAX_COLLECT_EVIDENCE:
-            if not r.is_duplicate \
-                and r.mapq > 0 \
-                and (r.is_proper_pair or
-                     r.next_reference_name == r.reference_name == chromosome and
-                     MIN_VALID_ISIZE_FOR_NON_PROPER_PAIR > abs(r.isize) < MAX_VALID_ISIZE):
-                add_to_clusters(cluster, r, start, end, bp_sequence, single_breakpoint)
+    return cluster.reference_name, min_start, cluster.end + EVIDENCE_WINDOW_PADDING
+
+
+def is_evidence_candidate(r, chromosome):
+    """Return whether read `r` can be counted as evidence for or against an insertion on `chromosome`."""
+    return not r.is_duplicate \
+        and r.mapq > 0 \
+        and (r.is_proper_pair or
+             r.next_reference_name == r.reference_name == chromosome and
+             MIN_VALID_ISIZE_FOR_NON_PROPER_PAIR > abs(r.isize) < MAX_VALID_ISIZE)
+
+
+def finalize_evidence(cluster):
+    """Remove reads that support `cluster` from the evidence against it and count the remaining fragments."""
     cluster.evidence_against = {r for r in cluster.evidence_against if r.query_name not in cluster.read_index}
     cluster.nref = len(set(r.query_name for r in cluster.evidence_against))
 
 
-def add_to_clusters(cluster, r, start, end, bp_sequence, single_breakpoint):
+def collect_evidence(cluster, alignment_file):
+    """Count all reads that point against evidence for a transposon insertion."""
+    chromosome, min_start, max_end = evidence_window(cluster)
+    start, end, bp_sequence, single_breakpoint = cluster.serialize()
+    reads = fetch_with_offsets(alignment_file, chromosome, min_start, max_end)
+    for i, (virtual_offset, r) in enumerate(reads):
+        if i <= MAX_COLLECT_EVIDENCE:
+            if is_evidence_candidate(r, chromosome):
+                add_to_clusters(cluster, r, start, end, bp_sequence, single_breakpoint, virtual_offset=virtual_offset)
+    finalize_evidence(cluster)
+
+
+def collect_evidence_for_clusters(clusters, alignment_file):
+    """
+    Count reads that point against evidence for a transposon insertion for all `clusters` in a single pass.
+
+    The evidence windows of all clusters are merged into blocks of overlapping windows,
+    each block is fetched once and every read is passed on to all windows that overlap the read.
+    Contrary to `collect_evidence` the number of reads per cluster is not capped.
+    """
+    windows = defaultdict(list)
+    for cluster in clusters:
+        chromosome, min_start, max_end = evidence_window(cluster)
+        windows[chromosome].append((min_start, max_end, cluster, cluster.serialize()))
+    for chromosome, chromosome_windows in windows.items():
+        chromosome_windows.sort(key=lambda window: window[0])
+        for block_start, block_end, block_windows in merge_windows(chromosome_windows):
+            pending = deque(block_windows)
+            active = []
+            for virtual_offset, r in fetch_with_offsets(alignment_file, chromosome, block_start, block_end):
+                reference_start = r.reference_start
+                reference_end = r.reference_end or reference_start + 1
+                while pending and pending[0][0] < reference_end:
+                    active.append(pending.popleft())
+                active = [window for window in active if window[1] > reference_start]
+                if is_evidence_candidate(r, chromosome):
+                    for min_start, _, cluster, (start, end, bp_sequence, single_breakpoint) in active:
+                        if reference_end > min_start:
+                            add_to_clusters(cluster, r, start, end, bp_sequence, single_breakpoint, virtual_offset=virtual_offset)
+    for cluster in clusters:
+        finalize_evidence(cluster)
+
+
+def merge_windows(windows):
+    """
+    Merge overlapping windows sorted by start and yield tuples of (start, end, windows in block).
+
+    >>> [(start, end, len(w)) for start, end, w in merge_windows([(0, 10, 'a'), (5, 20, 'b'), (20, 30, 'c'), (25, 26, 'd')])]
+    [(0, 20, 2), (20, 30, 2)]
+    """
+    block = []
+    block_start = block_end = None
+    for window in windows:
+        if block and window[0] >= block_end:
+            yield block_start, block_end, block
+            block = []
+        if not block:
+            block_start, block_end = window[0], window[1]
+        block.append(window)
+        block_end = max(block_end, window[1])
+    if block:
+        yield block_start, block_end, block
+
+
+def add_to_clusters(cluster, r, start, end, bp_sequence, single_breakpoint, virtual_offset=None):
     """
     Count reads overlapping a cluster.
 
     If a read r overlaps a cluster region,
     but does not show evidence for an insertion it will be counted.
     Once a read name has been seen it will not be counted again.
+    Reads are added to the cluster as CompactRead instances.
     """
     reference_start = r.reference_start
     reference_end = r.reference_end
@@ -826,9 +936,9 @@ def add_to_clusters(cluster, r, start, end, bp_sequence, single_breakpoint):
                 evidence = evidence_for(read=r, breakpoint_sequences=bp_sequence)
                 if evidence:
                     if evidence == 'five_p':
-                        cluster.evidence_for_five_p.add(r)
+                        cluster.evidence_for_five_p.add(CompactRead(r, virtual_offset=virtual_offset))
                     else:
-                        cluster.evidence_for_three_p.add(r)
+                        cluster.evidence_for_three_p.add(CompactRead(r, virtual_offset=virtual_offset))
                     return
         if single_breakpoint:
             # We only know where one of the breakpoints is, so we ask if any reads overlap that breakpoint
@@ -838,7 +948,7 @@ def add_to_clusters(cluster, r, start, end, bp_sequence, single_breakpoint):
             # only by mate pairs. In that instance it might be more accurate to sample the coverage at the breakpoint
             # boundaries, and assume that  nalt / coverage estimates the AF.
             if (min_start + 1 < single_breakpoint < max_end - 1):
-                cluster.evidence_against.add(r)
+                cluster.evidence_against.add(CompactRead(r, virtual_offset=virtual_offset))
         elif end - start < 50:
             if min_start + 1 < start < max_end - 1 and min_start + 1 < end < max_end - 1:
                 # A read is only incompatible if it overlaps both ends
@@ -846,14 +956,14 @@ def add_to_clusters(cluster, r, start, end, bp_sequence, single_breakpoint):
                 # to avoid dealing with reads with a single mismatch at the start/end,
                 # which wouldn't be soft-clipped. This shouldn't introduce any bias since we also can't assign these
                 # reads to an insertion, so we simple ignore them.
-                cluster.evidence_against.add(r)
+                cluster.evidence_against.add(CompactRead(r, virtual_offset=virtual_offset))
         else:
             # We were not able to narrow down the insertion breakpoints.
             # We can estimate the insertion frequency by looking at how many reads overlap
             # start and end of the insertion. This isn't very precise, but insertions without
             # exact start/end are probably low in frequency anyways.
             if (min_start + 1 < start < max_end - 1) or (min_start + 1 < end < max_end - 1):
-                cluster.evidence_against.add(r)
+                cluster.evidence_against.add(CompactRead(r, virtual_offset=virtual_offset))
 
 
 def evidence_for(read, breakpoint_sequences):
@@ -2,12 +2,20 @@ import logging
 import os
 from itertools import chain
 from cached_property import cached_property
+from six import StringIO
 
 from .gff_io import (
-    sort_gff,
-    write_gff_cluster
+    write_gff_cluster,
+    write_gff_records
+)
+from .utils import (
+    needs_csi_index,
+    tabix_output
+)
+from .vcf_io import (
+    vcf_lines,
+    write_vcf
 )
-from .vcf_io import write_vcf
 
 logger = logging.getLogger(__name__)
 
@@ -30,21 +38,26 @@ class SampleNameMixin(object):
 class ToOutput(object):
     """Provides logic for writing clusters and softclip clusters."""
 
-    def to_output(self, output_path, write_func, sort_func):
-        """Write clusters as GFF file."""
+    def to_output(self, output_path, write_func, preset):
+        """
+        Write clusters in coordinate order using `write_func`.
+
+        If `output_path` ends with `.gz` the output is bgzip compressed and indexed with tabix using `preset`.
+        """
         logger.info("Writing clusters of GFF (%s)", self.region or 0)
         if output_path:
-            if hasattr(self, 'softclip_finder'):
-                clusters = chain(self.clusters, self.softclip_finder.clusters)
-            else:
-                clusters = self.clusters
-            write_func(clusters=clusters,
-                       header=self.header,
-                       output_path=output_path,
-                       sample_name=self.sample_name,
-                       threads=self.threads)
-            if self.threads < 2:
-                sort_func(input_path=output_path, output_path=output_path)
+            with tabix_output(output_path, preset=preset, csi=needs_csi_index(self.header)) as path:
+                write_func(clusters=self.output_clusters(),
+                           header=self.header,
+                           output_path=path,
+                           sample_name=self.sample_name,
+                           threads=self.threads)
+
+    def output_clusters(self):
+        """Return an iterable of all clusters and softclip clusters."""
+        if hasattr(self, 'softclip_finder'):
+            return chain(self.clusters, self.softclip_finder.clusters)
+        return self.clusters
 
 
 class ToGffMixin(ToOutput):
@@ -52,7 +65,17 @@ class ToGffMixin(ToOutput):
 
     def to_gff(self, output_path):
         """Write clusters as GFF file."""
-        self.to_output(output_path, write_func=write_gff_cluster, sort_func=sort_gff)
+        self.to_output(output_path, write_func=write_gff_cluster, preset='gff')
+
+    def gff_lines(self):
+        """Return clusters as GFF lines, including header lines."""
+        out_handle = StringIO()
+        write_gff_records(clusters=self.output_clusters(),
+                          header=self.header,
+                          out_handle=out_handle,
+                          sample_name=self.sample_name,
+                          threads=self.threads)
+        return out_handle.getvalue().splitlines(True)
 
 
 class ToVcfMixin(ToOutput):
@@ -60,4 +83,8 @@ class ToVcfMixin(ToOutput):
 
     def to_vcf(self, output_path):
         """Write clusters as VCF file."""
-        self.to_output(output_path=output_path, write_func=write_vcf, sort_func=sort_gff)
+        self.to_output(output_path=output_path, write_func=write_vcf, preset='vcf')
+
+    def vcf_lines(self):
+        """Return clusters as VCF lines, without header lines."""
+        return vcf_lines(clusters=self.output_clusters(), header=self.header, sample_name=self.sample_name)
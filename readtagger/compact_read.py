@@ -0,0 +1,226 @@
+"""Lightweight stand-ins for pysam.AlignedSegment objects held in clusters."""
+import copy
+
+CLUSTER_TAGS = ('AD', 'BD', 'AC')
+# Tags that are required for clustering, MS is only kept for reads with a BD tag.
+
+FLAGS = {
+    'is_paired': 0x1,
+    'is_proper_pair': 0x2,
+    'is_unmapped': 0x4,
+    'mate_is_unmapped': 0x8,
+    'is_reverse': 0x10,
+    'mate_is_reverse': 0x20,
+    'is_read1': 0x40,
+    'is_read2': 0x80,
+    'is_secondary': 0x100,
+    'is_qcfail': 0x200,
+    'is_duplicate': 0x400,
+    'is_supplementary': 0x800,
+}
+
+
+def _flag_property(name, bit):
+    return property(lambda self: bool(self.flag & bit), doc="Return whether %s is set in the FLAG field." % name)
+
+
+class CompactRead(object):
+    """
+    Keep the fields of a pysam.AlignedSegment that are needed for clustering.
+
+    Sequence and MS tag are only kept if they are used for assembling the insert sequence,
+    i.e the sequence is kept for reads with an AD tag and the MS tag for reads with a BD tag.
+    The BGZF virtual offset of the read is used to retrieve the full alignment via `rehydrate`,
+    reads that do not come from the input alignment file (e.g assembled contigs) keep the full `segment`.
+    """
+
+    __slots__ = ('query_name',
+                 'flag',
+                 'tid',
+                 'reference_name',
+                 'reference_start',
+                 'reference_end',
+                 'mapping_quality',
+                 'cigar',
+                 'query_length',
+                 'query_alignment_start',
+                 'query_alignment_end',
+                 'next_reference_start',
+                 'template_length',
+                 'query_sequence',
+                 'tags',
+                 'virtual_offset',
+                 'segment')
+
+    def __init__(self, segment, virtual_offset=None, keep_segment=False):
+        """
+        Copy clustering attributes from `segment`.
+
+        >>> import pysam
+        >>> header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': 'chr1', 'LN': 1000}]})
+        >>> r = pysam.AlignedSegment(header)
+        >>> r.query_name = 'read1'
+        >>> r.flag = 83
+        >>> r.reference_id = 0
+        >>> r.reference_start = 100
+        >>> r.cigarstring = '10S20M'
+        >>> r.query_sequence = 'A' * 30
+        >>> r.set_tag('BD', 'R:rover,POS:1,QSTART:0,QEND:30,CIGAR:30M,S:S,MQ:60')
+        >>> r.set_tag('MS', 'C' * 30)
+        >>> r.set_tag('NM', 0)
+        >>> compact = CompactRead(r)
+        >>> compact.reference_end, compact.is_reverse, compact.is_read1, compact.qstart
+        (120, True, True, 10)
+        >>> compact.get_tag('MS') == 'C' * 30, compact.has_tag('NM'), compact.query_sequence is None
+        (True, False, True)
+        >>> compact == CompactRead(r)
+        True
+        """
+        self.query_name = segment.query_name
+        self.flag = segment.flag
+        self.tid = segment.tid
+        self.reference_name = segment.reference_name
+        self.reference_start = segment.reference_start
+        self.reference_end = segment.reference_end
+        self.mapping_quality = segment.mapping_quality
+        self.cigar = segment.cigartuples
+        self.query_length = segment.query_length
+        self.query_alignment_start = segment.query_alignment_start
+        self.query_alignment_end = segment.query_alignment_end
+        self.next_reference_start = segment.next_reference_start
+        self.template_length = segment.template_length
+        tags = [(tag, segment.get_tag(tag)) for tag in CLUSTER_TAGS if segment.has_tag(tag)]
+        if segment.has_tag('BD') and segment.has_tag('MS'):
+            tags.append(('MS', segment.get_tag('MS')))
+        self.tags = tuple(tags)
+        self.query_sequence = segment.query_sequence if segment.has_tag('AD') else None
+        self.virtual_offset = virtual_offset
+        self.segment = segment if keep_segment else None
+
+    is_paired = _flag_property('is_paired', FLAGS['is_paired'])
+    is_proper_pair = _flag_property('is_proper_pair', FLAGS['is_proper_pair'])
+    is_unmapped = _flag_property('is_unmapped', FLAGS['is_unmapped'])
+    mate_is_unmapped = _flag_property('mate_is_unmapped', FLAGS['mate_is_unmapped'])
+    is_reverse = _flag_property('is_reverse', FLAGS['is_reverse'])
+    mate_is_reverse = _flag_property('mate_is_reverse', FLAGS['mate_is_reverse'])
+    is_read1 = _flag_property('is_read1', FLAGS['is_read1'])
+    is_read2 = _flag_property('is_read2', FLAGS['is_read2'])
+    is_secondary = _flag_property('is_secondary', FLAGS['is_secondary'])
+    is_qcfail = _flag_property('is_qcfail', FLAGS['is_qcfail'])
+    is_duplicate = _flag_property('is_duplicate', FLAGS['is_duplicate'])
+    is_supplementary = _flag_property('is_supplementary', FLAGS['is_supplementary'])
+
+    @property
+    def key(self):
+        """Return attributes that identify the alignment in the input file."""
+        return segment_key(self)
+
+    def __hash__(self):
+        """Delegate to key."""
+        return hash(self.key)
+
+    def __eq__(self, other):
+        """Define equality as identical keys."""
+        return self.key == getattr(other, 'key', None)
+
+    def __ne__(self, other):
+        """Define not equal as not equal."""
+        return not self == other
+
+    def __repr__(self):
+        """Represent read by its key."""
+        return "CompactRead(%s, flag=%s, tid=%s, reference_start=%s)" % self.key
+
+    @property
+    def pos(self):
+        """Return reference start."""
+        return self.reference_start
+
+    @property
+    def mapq(self):
+        """Return mapping quality."""
+        return self.mapping_quality
+
+    @property
+    def qstart(self):
+        """Return query alignment start."""
+        return self.query_alignment_start
+
+    @property
+    def qend(self):
+        """Return query alignment end."""
+        return self.query_alignment_end
+
+    @property
+    def seq(self):
+        """Return query sequence, if it has been kept."""
+        return self.query_sequence
+
+    @property
+    def reference_length(self):
+        """Return aligned length on the reference."""
+        return self.reference_end - self.reference_start
+
+    @property
+    def alen(self):
+        """Return aligned length on the reference."""
+        return self.reference_length
+
+    @property
+    def isize(self):
+        """Return template length."""
+        return self.template_length
+
+    @property
+    def cigartuples(self):
+        """Return cigar as tuples."""
+        return self.cigar
+
+    def has_tag(self, tag):
+        """Return whether tag has been kept for this read."""
+        return any(t == tag for t, _ in self.tags)
+
+    def get_tag(self, tag):
+        """Return value of tag, raise KeyError if tag has not been kept for this read."""
+        for t, value in self.tags:
+            if t == tag:
+                return value
+        raise KeyError("tag '%s' not present" % tag)
+
+    def rehydrate(self, alignment_file):
+        """
+        Return the full pysam.AlignedSegment for this read.
+
+        Seeks to the recorded virtual offset if available, and falls back to
+        fetching the start position of the read if the read at the offset does not match.
+        """
+        if self.segment is not None:
+            return self.segment
+        if self.virtual_offset is not None:
+            alignment_file.seek(self.virtual_offset)
+            r = next(alignment_file, None)
+            if r is not None and segment_key(r) == self.key:
+                return r
+        for r in alignment_file.fetch(tid=self.tid, start=self.reference_start, end=self.reference_start + 1):
+            if segment_key(r) == self.key:
+                return r
+        raise ValueError("Could not find %s in %s" % (self, alignment_file.filename))
+
+
+def segment_key(segment):
+    """Return attributes that identify an alignment in an alignment file."""
+    return segment.query_name, segment.flag, segment.tid, segment.reference_start
+
+
+def rehydrate(reads, alignment_file, copy_segments=False):
+    """
+    Yield full pysam.AlignedSegment objects for `reads`.
+
+    Reads that keep their segment in memory return the same object every time they are rehydrated.
+    Specify `copy_segments=True` to get a copy of these segments, so that their tags can be modified independently.
+    """
+    for read in reads:
+        segment = read.rehydrate(alignment_file)
+        if copy_segments and segment is read.segment:
+            segment = copy.copy(segment)
+        yield segment
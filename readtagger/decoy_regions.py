@@ -0,0 +1,61 @@
+"""Remember regions that have been skipped as decoys, so that later runs can skip them without reading any reads."""
+import logging
+import os
+
+from .bam_io import parse_region
+
+logger = logging.getLogger(__name__)
+
+
+def region_contains(outer, inner):
+    """
+    Return whether region `outer` contains region `inner`.
+
+    >>> region_contains('3R', '3R:100-200')
+    True
+    >>> region_contains('3R:1-150', '3R:100-200')
+    False
+    >>> region_contains('3R:100-200', '3R')
+    False
+    """
+    outer_chrom, outer_start, outer_end = parse_region(outer)
+    inner_chrom, inner_start, inner_end = parse_region(inner)
+    if outer_chrom != inner_chrom:
+        return False
+    if outer_start is None:
+        return True
+    if inner_start is None:
+        return False
+    return outer_start <= inner_start and inner_end <= outer_end
+
+
+def read_decoy_regions(path, sample_name):
+    """
+    Return the regions of `sample_name` listed in the file at `path`.
+
+    Each line of the file contains a region and the name of the sample in which the region has been detected as a decoy.
+    """
+    if not os.path.exists(path):
+        return []
+    regions = []
+    with open(path) as lines:
+        for line in lines:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 2:
+                raise ValueError("Line '%s' of '%s' does not consist of a region and a sample name" % (line.rstrip('\n'), path))
+            if fields[1] == sample_name:
+                regions.append(fields[0])
+    return regions
+
+
+def is_decoy_region(path, region, sample_name):
+    """Return whether `region` is contained in a region of `sample_name` listed in the file at `path`."""
+    return any(region_contains(decoy_region, region) for decoy_region in read_decoy_regions(path, sample_name))
+
+
+def record_decoy_region(path, region, sample_name):
+    """Append `region` of `sample_name` to the file at `path`."""
+    logger.info("Recording decoy region '%s' of sample '%s' in '%s'", region, sample_name, path)
+    # A single write of a short line in append mode does not interleave with writes of other worker processes
+    with open(path, 'a') as regions:
+        regions.write("%s\t%s\n" % (region, sample_name))
@@ -13,7 +13,9 @@ SCAN_SOFT_CLIP_REGION = 15
 
 
 def get_tabix_file(path, preset='gff'):
-    """Return a TabixFile instance for a file at `path`."""
+    """Return a TabixFile instance for a file at `path`, which is compressed and indexed unless this has been done already."""
+    if path.endswith('.gz') and (os.path.exists("%s.tbi" % path) or os.path.exists("%s.csi" % path)):
+        return pysam.TabixFile(path)
     if not os.path.exists("%s.gz.tbi" % path):
         pysam.tabix_index(path, preset=preset, keep_original=True)
     tabix_file = pysam.TabixFile("%s.gz" % path)
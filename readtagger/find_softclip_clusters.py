@@ -1,8 +1,16 @@
 import logging
+from bisect import (
+    bisect_left,
+    bisect_right
+)
 from hashlib import md5
 
-from .bam_io import BamAlignmentReader as Reader
+from .bam_io import (
+    BamAlignmentReader as Reader,
+    fetch_with_offsets
+)
 from .cluster import BaseCluster
+from .compact_read import CompactRead
 from .cluster_base import (
     SampleNameMixin,
     ToGffMixin
@@ -12,6 +20,9 @@ from .tag_softclip import get_softclipped_portion
 
 logger = logging.getLogger(__name__)
 
+MIN_CLIP_LENGTH = 2
+# Reads need to be clipped by at least this many nucleotides to be added to a SoftClipCluster
+
 
 class SoftClipCluster(BaseCluster):
     """A cluster that groups reads with the same soft clipping position."""
@@ -110,6 +121,7 @@ class SoftClipClusterFinder(SampleNameMixin, ToGffMixin):
         self.min_mapq = min_mapq
         self.header = None
         self.clusters = []
+        self._clip_positions = None
         if input_path:
             self.find_clusters()
             self.merge_clusters()
@@ -120,14 +132,19 @@ class SoftClipClusterFinder(SampleNameMixin, ToGffMixin):
         logger.info("Finding clusters of softclipped reads (%s)" % self.region or 0)
         with Reader(self.input_path, index=True, sort_order='coordinate') as reader:
             self.header = reader.header
-            for r in reader.fetch(region=self.region):
+            for virtual_offset, r in fetch_with_offsets(reader, region=self.region):
                 if not r.is_duplicate and r.mapping_quality >= self.min_mapq:
-                    self.add_read(r=r)
+                    self.add_read(r=r, virtual_offset=virtual_offset)
         logger.info("Found %d clusters (%s)", len(self.clusters), self.region or 0)
 
-    def add_read(self, r):
-        """Add a clipped read."""
-        softclipped_portions = get_softclipped_portion(read=r, min_clip_length=2)
+    def add_read(self, r, virtual_offset=None):
+        """
+        Add a clipped read.
+
+        The read is stored as a CompactRead, which is returned if the read is clipped.
+        """
+        record = None
+        softclipped_portions = get_softclipped_portion(read=r, min_clip_length=MIN_CLIP_LENGTH)
         for read, start, end in softclipped_portions:
             if start == 0:
                 clip_position = r.reference_start
@@ -146,7 +163,10 @@ class SoftClipClusterFinder(SampleNameMixin, ToGffMixin):
             if not cluster.read_is_compatible(clip_position, clip_type=clip_type):
                 cluster = SoftClipCluster(clip_position=clip_position, clip_type=clip_type)
                 self.clusters.append(cluster)
-            cluster.append(read=r, seq=seq)
+            if record is None:
+                record = CompactRead(r, virtual_offset=virtual_offset)
+            cluster.append(read=record, seq=seq)
+        return record
 
     def merge_clusters(self):
         """Merge clusters with same cluster_type and same `clip_type`."""
@@ -167,4 +187,17 @@ class SoftClipClusterFinder(SampleNameMixin, ToGffMixin):
                                                                          sequence=i,
                                                                          start=cluster.start)
             cluster.set_id("SOFTCLIP_%s" % md5(unique_string.encode()).hexdigest())
+        self._clip_positions = None
         logger.info("Found %s clusters after merging clusters", len(self.clusters))
+
+    def clusters_near(self, position, window):
+        """
+        Return clusters with a clip position that is less than `window` nucleotides away from `position`.
+
+        Clusters must be sorted by clip position, which is the case after calling `merge_clusters`.
+        """
+        if self._clip_positions is None:
+            self._clip_positions = [c.clip_position for c in self.clusters]
+        start = bisect_right(self._clip_positions, position - window)
+        end = bisect_left(self._clip_positions, position + window)
+        return self.clusters[start:end]
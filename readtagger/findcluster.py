@@ -1,37 +1,95 @@
 import logging
+import multiprocessing
 import os
+from collections import deque
+from heapq import (
+    heappop,
+    heappush
+)
+from itertools import (
+    chain,
+    count
+)
 
 from concurrent.futures import (
-    as_completed,
+    FIRST_COMPLETED,
     wait,
     ThreadPoolExecutor,
     ProcessPoolExecutor
 )
 
+from .assembly import Assembler
+from .assembly_cache import (
+    ASSEMBLY_CACHE,
+    AssemblyCache
+)
 from .assemby_realignment import AssemblyRealigner
 from .bam_io import (
     BamAlignmentReader as Reader,
     BamAlignmentWriter as Writer,
-    merge_bam,
-    sort_bam,
-    split_locations_between_clusters
+    coordinate_sort_key,
+    fetch_with_offsets,
+    index_bam,
+    merge_sorted_bam,
+    regions_from_bed,
+    share_readers,
+    split_locations_between_clusters,
+    write_region_buffer
 )
 from .bwa import (
     Bwa,
     make_bwa_index
 )
 from .cluster import Cluster
-from .cluster import collect_evidence
+from .cluster import (
+    collect_evidence_for_clusters,
+    EVIDENCE_WINDOW_PADDING
+)
 from .cluster_base import (
     SampleNameMixin,
     ToGffMixin,
     ToVcfMixin
 )
+from .checkpoint import (
+    input_checksum,
+    parameters_hash,
+    region_file_prefix,
+    RegionManifest,
+    tagged_reads_fingerprint,
+)
 from .cigar import aligned_segment_corresponds_to_transposable_element
+from .compact_read import (
+    CompactRead,
+    rehydrate
+)
+from .decoy_regions import (
+    is_decoy_region,
+    record_decoy_region
+)
 from .fasta_io import merge_fasta
 from .find_softclip_clusters import SoftClipClusterFinder
 from .gff_io import merge_gff_files
+from .process_limit import ProcessLimiter
+from .profile_report import (
+    merge_profile_reports,
+    StageProfile
+)
 from .readtagger import get_max_proper_pair_size
+from .region_output import RegionOutputWriter
+from .shards import (
+    parse_shard,
+    read_plan,
+    shard_regions,
+    write_plan
+)
+from .tag_index import (
+    fetch_indexed_reads,
+    tag_index_is_current
+)
+from .utils import (
+    needs_csi_index,
+    tabix_output
+)
 from .vcf_io import merge_vcf_files
 from .verify import discard_supplementary
 try:
@@ -41,18 +99,49 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+REGION_BUFFER_PADDING = 10000
+# Reads this far beyond the region (plus the maximum proper pair size) are buffered, clusters extend beyond the reads in a region.
+DECOY_CLUSTER_DENSITY = 0.1
+# Regions with more clusters per nucleotide are skipped as probable decoys if skip_decoy is True
+DECOY_WINDOW_CLUSTERS = 100
+# Finding clusters in a region stops early if this many consecutive clusters exceed DECOY_CLUSTER_DENSITY
+CHECKPOINT_EXCLUDED_PARAMETERS = ('input_path', 'output_bam', 'output_gff', 'output_vcf', 'output_fasta', 'profile_report',
+                                  'region', 'threads', 'shm_dir', 'assembly_cache')
+# Parameters that don't change the results of a region and therefore don't invalidate regions in the work_dir manifest
+TASKS_PER_WORKER = 4
+# Regions of a BED file are grouped into this many tasks per worker process
+SUBMITTED_TASKS_PER_WORKER = 2
+# Tasks per worker process that are submitted beyond the earliest task whose streamed records have not been written
+REGION_OUTPUTS = [('output_bam', '.bam'), ('output_gff', '.gff'), ('output_vcf', '.vcf'), ('output_fasta', '.fasta'),
+                  ('profile_report', '.profile.json')]
+
 
-class ClusterManager(object):
+class ClusterManager(SampleNameMixin):
     """Coordinate multiple ClusterFinder objects when running in multiprocessing mode."""
 
     def __init__(self, **kwds):
         """Decide if passing kwds on to ClusterFinder or if splitting input file is required."""
+        self.input_path = kwds['input_path']
+        self._sample_name = kwds.get('sample_name')
         if kwds.get('max_proper_pair_size', 0) == 0:
             kwds['max_proper_pair_size'] = get_max_proper_pair_size(kwds['input_path'])
-        if kwds['threads'] > 1:
+        self.work_dir = kwds.pop('work_dir', None)
+        self.incremental = kwds.pop('incremental', False)
+        self.regions_bed = kwds.pop('regions_bed', None)
+        self.plan = kwds.pop('plan', None)
+        shard = kwds.pop('shard', None)
+        self.shard = parse_shard(shard) if shard else None
+        if self.incremental and not self.work_dir:
+            logger.warning("Incremental mode requires a work_dir, processing all regions.")
+            self.incremental = False
+        if self.plan and not self.shard:
+            # Only write the regions that shards are going to process
+            self.kwds = kwds
+            write_plan(self.regions(), self.plan)
+        elif kwds['threads'] > 1 or self.work_dir or self.regions_bed or self.shard:
             self.threads = kwds['threads']
             # this is ugly, but each ClusterFinder instance should be able to use an additional thread
-            kwds['threads'] = 2
+            kwds['threads'] = min(2, self.threads)
             self.kwds = kwds
             self.process_list = []
             self.process()
@@ -62,57 +151,213 @@ class ClusterManager(object):
 
     def process(self):
         """Process input bam in chunks."""
-        with TemporaryDirectory(prefix='ClusterManager_') as tempdir:
-            executor = ProcessPoolExecutor(max_workers=self.threads)
-            futures = []
-            chunks = split_locations_between_clusters(self.kwds['input_path'], region=self.kwds.get('region'))
-            if self.kwds['transposon_reference_fasta'] and not self.kwds['transposon_bwa_index']:
-                self.kwds['transposon_bwa_index'], _ = make_bwa_index(self.kwds['transposon_reference_fasta'], dir=tempdir)
-            if self.kwds['genome_reference_fasta'] and not self.kwds['genome_bwa_index']:
-                self.kwds['genome_bwa_index'], _ = make_bwa_index(self.kwds['genome_reference_fasta'], dir=tempdir)
-            for i, region in enumerate(chunks):
-                kwds = self.kwds.copy()
-                kwds['region'] = region
-                for key, ext in [('output_bam', '.bam'), ('output_gff', '.gff'), ('output_vcf', '.vcf'), ('output_fasta', '.fasta')]:
-                    kwds[key] = os.path.join(tempdir, "%d%s" % (i, ext))
-                self.process_list.append(kwds)
-                futures.append(executor.submit(wrapper, kwds))
-            for f in as_completed(fs=futures):
-                e = f.exception()
-                if e is not None:
-                    if isinstance(e, RuntimeError):
-                        logger.error("Runtime error occured: %s", e)
-                    else:
-                        logger.error("Shutting down futures, an Exception occured.")
-                        wait_for_running_futures = []
-                        for rf in futures[::-1]:
-                            if rf.cancel():
-                                wait_for_running_futures.append(rf)
-                        wait(wait_for_running_futures)
-                        raise f.exception()
+        manifest = None
+        if self.work_dir:
+            if not os.path.exists(self.work_dir):
+                os.makedirs(self.work_dir)
+            # The sample name may be inferred from the input filename and is written to all outputs
+            parameters = dict(self.kwds, sample_name=self.sample_name)
+            manifest = RegionManifest(self.work_dir,
+                                      parameters=parameters_hash(parameters, exclude=CHECKPOINT_EXCLUDED_PARAMETERS),
+                                      checksum=input_checksum(self.input_path))
+        # Manager is only a context manager on python 3
+        manager = multiprocessing.Manager()
+        try:
+            with TemporaryDirectory(prefix='ClusterManager_') as tempdir:
+                # cap3 and bwa processes of all workers share the thread budget
+                self.kwds['process_limiter'] = ProcessLimiter.from_manager(manager, size=self.threads)
+                executor = ProcessPoolExecutor(max_workers=self.threads)
+                future_regions = {}
+                region_index = {}
+                pending = []
+                if self.kwds.get('remove_supplementary_without_primary'):
+                    self._remove_supplementary_without_primary(tempdir)
+                chunks = read_plan(self.plan) if self.plan else self.regions()
+                if self.shard:
+                    chunks = shard_regions(chunks, *self.shard)
+                    logger.info("Processing %d regions of shard %d/%d", len(chunks), *self.shard)
+                if self.kwds['transposon_reference_fasta'] and not self.kwds['transposon_bwa_index']:
+                    self.kwds['transposon_bwa_index'], _ = make_bwa_index(self.kwds['transposon_reference_fasta'], dir=tempdir)
+                if self.kwds['genome_reference_fasta'] and not self.kwds['genome_bwa_index']:
+                    self.kwds['genome_bwa_index'], _ = make_bwa_index(self.kwds['genome_reference_fasta'], dir=tempdir)
+                # Without a work_dir, workers return their records and this process writes them to the final outputs
+                self.stream_outputs = not manifest
+                writer = self._region_output_writer(chunks)
+                for i, region in enumerate(chunks):
+                    kwds = self.kwds.copy()
+                    kwds['region'] = region
+                    kwds['stream_outputs'] = self.stream_outputs
+                    for key, ext in REGION_OUTPUTS:
+                        if key != 'profile_report' or self.kwds.get('profile_report'):
+                            if manifest:
+                                kwds[key] = os.path.join(self.work_dir, "%s%s" % (region_file_prefix(region), ext))
+                            elif key in ('output_fasta', 'profile_report'):
+                                # Contigs are always assembled and aligned, the final FASTA output is streamed as well
+                                kwds[key] = os.path.join(tempdir, "%d%s" % (i, ext))
+                    if self.incremental:
+                        # Workers compare fingerprints of regions that have been processed for a different input
+                        kwds['fingerprint_padding'] = self.kwds['max_proper_pair_size'] + REGION_BUFFER_PADDING
+                        kwds['expected_fingerprint'] = manifest.recorded_fingerprint(region)
+                    self.process_list.append(kwds)
+                    region_index[region] = i
+                    if manifest and manifest.is_complete(region):
+                        logger.info("Reusing outputs of region '%s' in '%s'", region, self.work_dir)
+                        continue
+                    pending.append(kwds)
+                # Many small regions of a BED file are processed in fewer tasks, each reusing its worker's open reader
+                batch_size = max(1, -(-len(pending) // (self.threads * TASKS_PER_WORKER))) if self.regions_bed else 1
+                batches = deque(pending[start:start + batch_size] for start in range(0, len(pending), batch_size))
+                # Streamed records of regions that complete before earlier regions are held back in memory,
+                # so only a limited number of batches beyond the earliest unfinished batch is submitted.
+                max_submitted = self.threads * SUBMITTED_TASKS_PER_WORKER if self.stream_outputs else len(batches)
+                submitted = deque()
+                running = set()
+                with writer:
+                    while batches or running:
+                        while batches and len(submitted) < max_submitted:
+                            batch = batches.popleft()
+                            future = executor.submit(wrapper, batch)
+                            future_regions[future] = batch
+                            submitted.append(future)
+                            running.add(future)
+                        done, running = wait(running, return_when=FIRST_COMPLETED)
+                        for f in done:
+                            e = f.exception()
+                            if e is None:
+                                for kwds, (records, fingerprint) in zip(future_regions.pop(f), f.result()):
+                                    if records is None:
+                                        logger.info("Reusing outputs of region '%s' with unchanged tags in '%s'", kwds['region'], self.work_dir)
+                                        writer.add(region_index[kwds['region']], {})
+                                        continue
+                                    writer.add(region_index[kwds['region']], records)
+                                    if manifest:
+                                        manifest.record(kwds['region'],
+                                                        outputs={key: kwds.get(key) for key, _ in REGION_OUTPUTS},
+                                                        fingerprint=fingerprint)
+                            else:
+                                for kwds in future_regions.pop(f):
+                                    writer.add(region_index[kwds['region']], {})
+                                if isinstance(e, RuntimeError):
+                                    logger.error("Runtime error occured: %s", e)
+                                else:
+                                    logger.error("Shutting down futures, an Exception occured.")
+                                    for rf in running:
+                                        rf.cancel()
+                                    wait(running)
+                                    raise e
+                        while submitted and submitted[0].done():
+                            submitted.popleft()
                 executor.shutdown()
-            self.merge_outputs()
+                self.merge_outputs()
+        finally:
+            manager.shutdown()
+
+    def regions(self):
+        """Return the regions that are processed by separate ClusterFinder instances, in coordinate order."""
+        if self.regions_bed:
+            return regions_from_bed(self.regions_bed, bamfile=self.kwds['input_path'])
+        return split_locations_between_clusters(self.kwds['input_path'], region=self.kwds.get('region'))
+
+    def _remove_supplementary_without_primary(self, tempdir):
+        """Remove supplementary reads without primary alignments once for all ClusterFinder instances."""
+        output_path = os.path.join(tempdir, 'clean.bam')
+        discard_supplementary(input_path=self.kwds['input_path'], output_path=output_path)
+        index_bam(output_path)
+        # The sample name would otherwise be inferred from the filtered file
+        self.kwds['sample_name'] = self.sample_name
+        self.kwds['input_path'] = output_path
+        self.kwds['remove_supplementary_without_primary'] = False
+
+    @property
+    def csi_index(self):
+        """Return whether compressed outputs need to be indexed with a CSI index."""
+        with Reader(self.input_path) as reader:
+            return needs_csi_index(reader.header)
+
+    def _region_output_writer(self, regions):
+        """Return a RegionOutputWriter for the outputs of `regions`, which only writes outputs if they are streamed."""
+        outputs = {}
+        if self.stream_outputs:
+            outputs = {key: self.kwds.get(key) for key in ('output_bam', 'output_gff', 'output_vcf', 'output_fasta')}
+        with Reader(self.kwds['input_path']) as reader:
+            header = reader.header
+        return RegionOutputWriter(regions,
+                                  header=header,
+                                  sample_name=self.sample_name,
+                                  padding=self.kwds['max_proper_pair_size'] + REGION_BUFFER_PADDING,
+                                  threads=min((8, self.threads)),
+                                  csi=needs_csi_index(header),
+                                  **outputs)
 
     def merge_outputs(self):
         """Merge outputs produced by working over smaller chunks with ClusterManager."""
-        output_bam = self.kwds.get('output_bam')
-        if output_bam:
-            bam_files = [kwd['output_bam'] for kwd in self.process_list if kwd['output_bam']]
-            merge_bam(bam_collection=bam_files, output_path=self.kwds['output_bam'], sort_order='coordinate', threads=min((8, self.threads)))
-        output_fasta = self.kwds.get('output_fasta')
-        if output_fasta:
-            merge_fasta(fasta_files=[kwd['output_fasta'] for kwd in self.process_list], output_path=output_fasta)
-        output_gff = self.kwds.get('output_gff')
-        if output_gff:
-            merge_gff_files([kwd['output_gff'] for kwd in self.process_list], output_gff)
-        output_vcf = self.kwds.get('output_vcf')
-        if output_vcf:
-            merge_vcf_files([kwd['output_vcf'] for kwd in self.process_list], output_vcf)
-
-
-def wrapper(kwds):
-    """Launch ClusterFinder instances."""
-    ClusterFinder(**kwds)
+        if not self.stream_outputs:
+            self._merge_region_files()
+        profile_report = self.kwds.get('profile_report')
+        if profile_report:
+            merge_profile_reports([kwd['profile_report'] for kwd in self.process_list], profile_report)
+
+    def _merge_region_files(self):
+        """Merge the BAM, FASTA, GFF and VCF files of all regions."""
+        merge_region_files(bam_files=[kwd['output_bam'] for kwd in self.process_list if kwd['output_bam']],
+                           gff_files=[kwd['output_gff'] for kwd in self.process_list],
+                           vcf_files=[kwd['output_vcf'] for kwd in self.process_list],
+                           fasta_files=[kwd['output_fasta'] for kwd in self.process_list],
+                           output_bam=self.kwds.get('output_bam'),
+                           output_gff=self.kwds.get('output_gff'),
+                           output_vcf=self.kwds.get('output_vcf'),
+                           output_fasta=self.kwds.get('output_fasta'),
+                           threads=min((8, self.threads)),
+                           csi=self.csi_index,
+                           # Outputs in work_dir are kept for later runs
+                           remove_inputs=not self.work_dir)
+
+
+def merge_region_files(bam_files=(), gff_files=(), vcf_files=(), fasta_files=(), output_bam=None, output_gff=None, output_vcf=None,
+                       output_fasta=None, threads=1, csi=False, remove_inputs=True):
+    """
+    Merge the outputs of regions or shards into `output_bam`, `output_gff`, `output_vcf` and `output_fasta`.
+
+    BAM, GFF and VCF files must be coordinate sorted and are merged in coordinate order, FASTA files are concatenated.
+    Compressed GFF and VCF outputs are indexed with tabix, using a CSI index if `csi` is True.
+    BAM files are removed after merging if `remove_inputs` is True.
+    """
+    if output_bam:
+        # Each file is coordinate sorted, so merging them preserves the order
+        merge_sorted_bam(bam_collection=bam_files, output_path=output_bam, threads=threads, remove_inputs=remove_inputs)
+    if output_fasta:
+        merge_fasta(fasta_files=fasta_files, output_path=output_fasta)
+    if output_gff:
+        with tabix_output(output_gff, preset='gff', csi=csi) as path:
+            merge_gff_files(gff_files, path)
+    if output_vcf:
+        with tabix_output(output_vcf, preset='vcf', csi=csi) as path:
+            merge_vcf_files(vcf_files, path)
+
+
+def wrapper(batch):
+    """
+    Launch ClusterFinder instances for a batch of regions of the same input file, reusing open readers.
+
+    Returns a tuple of the streamed records and the fingerprint of the tagged reads of each region.
+    """
+    share_readers(batch[0]['input_path'])
+    return [_process_region(**kwds) for kwds in batch]
+
+
+def _process_region(fingerprint_padding=None, expected_fingerprint=None, **kwds):
+    """
+    Launch a ClusterFinder instance and return a tuple of its streamed records and the fingerprint of the region.
+
+    The fingerprint is only calculated if `fingerprint_padding` is given. If it is equal to `expected_fingerprint`
+    the outputs of a previous run are reused and the returned records are None.
+    """
+    fingerprint = None
+    if fingerprint_padding is not None:
+        fingerprint = tagged_reads_fingerprint(kwds['input_path'], kwds['region'], padding=fingerprint_padding)
+        if fingerprint == expected_fingerprint:
+            return None, fingerprint
+    return ClusterFinder(**kwds).records, fingerprint
 
 
 class ClusterFinder(SampleNameMixin, ToGffMixin, ToVcfMixin):
@@ -137,7 +382,16 @@ class ClusterFinder(SampleNameMixin, ToGffMixin, ToVcfMixin):
                  remove_supplementary_without_primary=False,
                  region=None,
                  shm_dir=None,
-                 skip_decoy=True):
+                 skip_decoy=True,
+                 decoy_regions=None,
+                 tag_index=None,
+                 buffer_region=False,
+                 assembly_cache=None,
+                 assembly_target_reads=None,
+                 in_process_assembly=False,
+                 process_limiter=None,
+                 profile_report=None,
+                 stream_outputs=False):
         """
         Find readclusters in input_path file.
 
@@ -146,6 +400,21 @@ class ClusterFinder(SampleNameMixin, ToGffMixin, ToVcfMixin):
         the cluster will extend the cluster.
         The join_cluster method will then join clusters that overlap through their clipped sequences and cluster that can be assembled based on their proximity
         and the fact that they support the same same insertion (and can hence contribute to the same contig if assembled).
+        If `tag_index` points to an index written by `write_tag_index` only the reads listed in the index are inspected
+        when finding clusters.
+        If `buffer_region` is True the reads of `region` are copied once into a local file that is read by all subsequent stages.
+        If `assembly_cache` is a path, assemblies are stored in an SQLite database at this path and reused by later runs.
+        If `assembly_target_reads` is given, read sets with more reads are downsampled before assembly.
+        If `in_process_assembly` is True, small sets of short reads are assembled in-process instead of by cap3.
+        If `process_limiter` is given, cap3 and bwa processes wait for free slots of this ProcessLimiter.
+        If `skip_decoy` is True, finding clusters in `region` stops as soon as the density of the last DECOY_WINDOW_CLUSTERS clusters
+        exceeds DECOY_CLUSTER_DENSITY. Regions detected as decoys are appended to the file at `decoy_regions` together with the sample name,
+        and regions listed in this file for the same sample are skipped without reading them.
+        If `profile_report` is a path, wall time, CPU time, memory usage and read, cluster and external process counts
+        of each stage are written to this path as JSON.
+        If `stream_outputs` is True, the requested BAM, GFF, VCF and FASTA outputs are kept in `self.records` as lists of
+        SAM, GFF and VCF lines and FASTA sequences instead of being written to `output_bam`, `output_gff`, `output_vcf`
+        and `output_fasta`.
         """
         self._sample_name = sample_name
         self.shm_dir = shm_dir
@@ -164,41 +433,82 @@ class ClusterFinder(SampleNameMixin, ToGffMixin, ToVcfMixin):
         self.max_clustersupport = max_clustersupport
         self.max_proper_pair_size = max_proper_pair_size
         self.skip_decoy = skip_decoy
+        self.decoy_regions = decoy_regions
+        self.tag_index = tag_index
+        self.buffer_region = buffer_region
+        self.profile_report = profile_report
+        self.stream_outputs = stream_outputs
+        self.records = {}
+        self.profile = StageProfile(region=self.region)
+        self.inspected_reads = 0
+        self.process_limiter = process_limiter
+        self.assembler = Assembler(cache=AssemblyCache(path=assembly_cache) if assembly_cache else ASSEMBLY_CACHE,
+                                   target_reads=assembly_target_reads,
+                                   process_limiter=process_limiter,
+                                   in_process=in_process_assembly)
         self.softclip_finder = SoftClipClusterFinder(region=self.region,
                                                      min_mapq=self.min_mapq,
                                                      sample_name=self.sample_name)
         with TemporaryDirectory(prefix='ClusterFinder_') as self._tempdir:
+            if self.stream_outputs and self.output_fasta:
+                # BWA aligns the contigs in this file
+                self.output_fasta = os.path.join(self._tempdir, 'contigs.fasta')
             self.transposon_bwa_index, self.genome_bwa_index = self.setup_bwa_indexes()
             self.remove_supplementary_without_primary = remove_supplementary_without_primary
             self.threads = threads
             self.tp = ThreadPoolExecutor(threads)  # max threads
+            self._assemblies = []
+            self._bwa = None
+            self.is_decoy = False
+            with self.profile.stage('find_cluster') as stats:
+                self.clusters = self.find_cluster()
+                stats['reads'] = self.inspected_reads
+                stats['clusters'] = len(self.clusters)
+            # find_cluster may replace self.input_path with a filtered or buffered copy, which the realigner should read as well
             if self.genome_bwa_index and self.transposon_bwa_index:
                 self.assembly_realigner = AssemblyRealigner(input_alignment_file=self.input_path,
                                                             genome_bwa_index=self.genome_bwa_index,
-                                                            transposon_bwa_index=self.transposon_bwa_index)
+                                                            transposon_bwa_index=self.transposon_bwa_index,
+                                                            assembler=self.assembler,
+                                                            process_limiter=self.process_limiter)
             else:
                 self.assembly_realigner = None
-            self.is_decoy = False
-            self.clusters = self.find_cluster()
             if not self.is_decoy or not self.skip_decoy:
-                self.clean_clusters()
-                self.join_clusters()
-                self.annotate_softclip()
-                self.to_fasta()
-                self.align_bwa()
-                self.collect_evidence()
-                self.to_bam()
-                self.to_gff(output_path=self.output_gff)
-                self.to_vcf(output_path=self.output_vcf)
+                # Assemblies (cap3) and the BWA alignment run in the background, while the stages
+                # up to the next stage that needs their results continue in this thread
+                stages = [('clean_clusters', self.clean_clusters),
+                          ('join_clusters', self.join_clusters),
+                          ('assemble', self.assemble),
+                          ('annotate_softclip', self.annotate_softclip),
+                          ('to_fasta', self.to_fasta),
+                          ('align_bwa', self.align_bwa),
+                          ('collect_evidence', self.collect_evidence),
+                          ('annotate_bwa', self.annotate_bwa)]
+                if self.stream_outputs:
+                    stages.extend([('to_bam', lambda: self._keep_records('output_bam', self.bam_lines)),
+                                   ('to_gff', lambda: self._keep_records('output_gff', self.gff_lines)),
+                                   ('to_vcf', lambda: self._keep_records('output_vcf', self.vcf_lines))])
+                else:
+                    stages.extend([('to_bam', self.to_bam),
+                                   ('to_gff', lambda: self.to_gff(output_path=self.output_gff)),
+                                   ('to_vcf', lambda: self.to_vcf(output_path=self.output_vcf))])
+                for name, stage in stages:
+                    with self.profile.stage(name) as stats:
+                        stage()
+                        stats['clusters'] = len(self.clusters)
+        if assembly_cache:
+            self.assembler.cache.close()
+        if self.profile_report:
+            self.profile.write(self.profile_report)
 
     def setup_bwa_indexes(self):
         """Handle setting up BWA indexes."""
         transposon_bwa_index = self.transposon_bwa_index
         genome_bwa_index = self.genome_bwa_index
         if not transposon_bwa_index and self.transposon_reference_fasta:
-            transposon_bwa_index, _ = make_bwa_index(self.transposon_reference_fasta, dir=self._tempdir)
+            transposon_bwa_index, _ = make_bwa_index(self.transposon_reference_fasta, dir=self._tempdir, process_limiter=self.process_limiter)
         if not genome_bwa_index and self.genome_reference_fasta:
-            genome_bwa_index, _ = make_bwa_index(self.genome_reference_fasta, dir=self._tempdir)
+            genome_bwa_index, _ = make_bwa_index(self.genome_reference_fasta, dir=self._tempdir, process_limiter=self.process_limiter)
         return transposon_bwa_index, genome_bwa_index
 
     def _remove_supplementary_without_primary(self):
@@ -207,56 +517,103 @@ class ClusterFinder(SampleNameMixin, ToGffMixin, ToVcfMixin):
         discard_supplementary(input_path=self.input_path, output_path=output_path)
         self.input_path = output_path
 
+    def _buffer_region(self):
+        """Copy reads in and around self.region into a local file, so that the input file is read only once."""
+        output_path = os.path.join(self._tempdir, 'region.bam')
+        padding = self.max_proper_pair_size + EVIDENCE_WINDOW_PADDING + REGION_BUFFER_PADDING
+        write_region_buffer(input_path=self.input_path, region=self.region, output_path=output_path, padding=padding)
+        self.input_path = output_path
+
+    def _fetch_reads(self, reader):
+        """Return an iterator of (virtual_offset, read) tuples, using the tag index if available."""
+        if self.tag_index:
+            if self.remove_supplementary_without_primary or self.buffer_region:
+                logger.info("Not using tag index, offsets do not apply to filtered or buffered reads (%s)", self.region or 0)
+            elif tag_index_is_current(input_path=self.input_path,
+                                      index_path=self.tag_index,
+                                      min_mapq=self.min_mapq,
+                                      include_duplicates=self.include_duplicates):
+                return fetch_indexed_reads(reader, index_path=self.tag_index, region=self.region)
+        return fetch_with_offsets(reader, region=self.region)
+
     def find_cluster(self):
         """Find clusters by iterating over input_path and creating clusters if reads are disjointed."""
         logger.info("Finding clusters in region '%s'", self.region or 0)
+        if self.skip_decoy and self.decoy_regions and self.region and is_decoy_region(self.decoy_regions, self.region, self.sample_name):
+            logger.info("Skipping region '%s', it is listed in '%s'", self.region, self.decoy_regions)
+            self.is_decoy = True
+            return []
         if self.remove_supplementary_without_primary:
             self._remove_supplementary_without_primary()
+        if self.buffer_region:
+            if self.region:
+                self._buffer_region()
+            else:
+                logger.info("Not buffering reads, no region specified")
+                self.buffer_region = False
         clusters = []
         skip = None
         with Reader(self.input_path, region=self.region, index=True) as reader:
             self.header = reader.header
-            for r in reader.fetch(region=self.region):
+            for virtual_offset, r in self._fetch_reads(reader):
+                self.inspected_reads += 1
                 if not self.include_duplicates:
                     if r.is_duplicate:
                         continue
                 if not r.mapping_quality >= self.min_mapq or r.reference_start == skip:
                     continue
-                self.softclip_finder.add_read(r=r)
+                record = self.softclip_finder.add_read(r=r, virtual_offset=virtual_offset)
                 if not (r.has_tag('BD') or r.has_tag('AD')):
                     continue
                 if r.has_tag('AD') and not aligned_segment_corresponds_to_transposable_element(r):
                     continue
+                # Clusters hold a compact copy of the read, full reads are retrieved when writing the output BAM file
+                r = record or CompactRead(r, virtual_offset=virtual_offset)
                 if not clusters:
-                    cluster = Cluster(shm_dir=self.shm_dir, max_proper_size=self.max_proper_pair_size)
+                    cluster = Cluster(shm_dir=self.shm_dir, max_proper_size=self.max_proper_pair_size, assembler=self.assembler)
                     cluster.append(r)
                     clusters.append(cluster)
                     continue
                 if clusters[-1].read_is_compatible(r):
-                    clusters[-1].append(r)
-                elif len(clusters) >= 2 and r.reference_start == clusters[-1][-1].reference_start == clusters[-2][-1].reference_start:
+                    clusters[-1].add_read(r, max_clustersupport=self.max_clustersupport)
+                elif len(clusters) >= 2 and r.reference_start == clusters[-1].last_start == clusters[-2].last_start:
                     skip = r.reference_start
                     clusters[-1].abnormal = True
                     clusters[-2].abnormal = True
                     # Could be X:22,432,984-22,433,240, a huge accumulation of fragments with rover homology.
                 else:
-                    cluster = Cluster(shm_dir=self.shm_dir, max_proper_size=self.max_proper_pair_size)
+                    cluster = Cluster(shm_dir=self.shm_dir, max_proper_size=self.max_proper_pair_size, assembler=self.assembler)
                     cluster.append(r)
                     clusters.append(cluster)
+                    if self.skip_decoy and self.region and self._exceeds_decoy_density(clusters):
+                        # The region contains a pile of clusters that should only happen on decoys, no need to look any further
+                        self.is_decoy = True
+                        logger.info('Stopped finding clusters after %d clusters (%s)', len(clusters), self.region)
+                        break
         self.softclip_finder.merge_clusters()
         logger.info('Found %d cluster on first pass (%s)', len(clusters), self.region or 0)
         if clusters:
             minimum_start = clusters[0].min
             maximum_end = clusters[-1].max
             cluster_density = len(clusters) / float(maximum_end - minimum_start)
-            if cluster_density > 0.1:
+            if self.is_decoy or cluster_density > DECOY_CLUSTER_DENSITY:
                 # every 10th nt a cluster, that should only happen on decoys.
                 self.is_decoy = True
                 logger.info('Skipping region with abnormally high cluster density (%s), probably a decoy (%s)',
                             cluster_density,
                             self.region or 0)
+                if self.skip_decoy and self.decoy_regions and self.region:
+                    record_decoy_region(self.decoy_regions, self.region, self.sample_name)
         return clusters
 
+    @staticmethod
+    def _exceeds_decoy_density(clusters):
+        """Return whether the density of the last DECOY_WINDOW_CLUSTERS `clusters` exceeds DECOY_CLUSTER_DENSITY."""
+        if len(clusters) < DECOY_WINDOW_CLUSTERS:
+            return False
+        window = clusters[-1].min - clusters[-DECOY_WINDOW_CLUSTERS].min
+        return DECOY_WINDOW_CLUSTERS > DECOY_CLUSTER_DENSITY * window
+
     def clean_clusters(self):
         """Remove clusters that have more reads supporting an insertion than specified in self.max_clustersupport."""
         self.clusters = [c for c in self.clusters if not len(c.read_index) > self.max_clustersupport]
@@ -276,21 +633,24 @@ class ClusterFinder(SampleNameMixin, ToGffMixin, ToVcfMixin):
                 new_clusterlength = len(self.clusters)
         logger.info("Found %d cluster after first pass of cluster joining (%s).", new_clusterlength, self.region or 0)
         logger.info("Splitting cluster at polarity switches")
-        for index, cluster in enumerate(self.clusters):
-            new_clusters = cluster.split_cluster_at_polarity_switch()
-            self._add_new_clusters(new_clusters, index)
+        self._process_clusters(lambda cluster: cluster.split_cluster_at_polarity_switch())
         logger.info("After splitting at polarity switches we have %d cluster (was: %d) (%s)",
                     len(self.clusters),
                     new_clusterlength,
                     self.region or 0)
         logger.info("Checking cluster consistency (%s)", self.region or 0)
-        for index, cluster in enumerate(self.clusters):
-            new_clusters = cluster.check_cluster_consistency()
-            self._add_new_clusters(new_clusters, index)
+        self._process_clusters(lambda cluster: cluster.check_cluster_consistency())
         logger.info("After splitting inconsistent clusters we have %d cluster", len(self.clusters))
         logger.info("Last pass of joining cluster (%s)", self.region or 0)
+        informative_reads = {}
+        if self.assembly_realigner:
+            # Contigs of all clusters are aligned together. A cluster's contigs only depend on its own reads,
+            # which don't change before its turn in the loop below unless it is joined into a previous cluster.
+            realigned = self.assembly_realigner.realign_clusters(self.clusters, executor=self.tp)
+            informative_reads = {id(cluster): reads for cluster, reads in zip(self.clusters, realigned)}
         for cluster in self.clusters:
-            cluster.refine_members(self.assembly_realigner)
+            # Each cluster is refined right before it is joined, as if it had been realigned on its own
+            cluster.refine_members(informative_reads.get(id(cluster), []))
             cluster.join_adjacent(all_clusters=self.clusters)
         # We are done, we can give the clusters a numeric index, so that we can distribute the processing and recover the results
         for i, cluster in enumerate(self.clusters):
@@ -301,33 +661,55 @@ class ClusterFinder(SampleNameMixin, ToGffMixin, ToVcfMixin):
     def annotate_softclip(self):
         """Walk along all found clusters and annotate them with softclip clusters."""
         SEARCH_WINDOW = 300
-        softclip_idx = 0
+        softclip_reads = {}
+
+        def clusters_sharing_reads(cluster_reads, position):
+            """Yield softclip clusters near `position` that share reads with `cluster_reads`."""
+            for c in self.softclip_finder.clusters_near(position, SEARCH_WINDOW):
+                if c.id not in softclip_reads:
+                    softclip_reads[c.id] = set(c)
+                if not cluster_reads.isdisjoint(softclip_reads[c.id]):
+                    yield c
+
+        assemblies = {id(cluster): future for cluster, future in zip(self.clusters, self._assemblies)}
         for cluster in self.clusters:
+            if id(cluster) in assemblies:
+                # The assembly creates the cluster's clustertag, which must not be created again in this thread
+                assemblies[id(cluster)].result()
+            cluster_reads = None
             if cluster.clustertag.tsd.five_p_reads:
                 position = cluster.clustertag.tsd.five_p
                 if position:
-                    for i, c in enumerate(self.softclip_finder.clusters[softclip_idx:]):
-                        if position - SEARCH_WINDOW < c.clip_position < position + SEARCH_WINDOW:
-                            if set(cluster) & set(c):
-                                cluster.softclip_clusters.append(c.id)
-                        elif c.clip_position > position + SEARCH_WINDOW:
-                            softclip_idx = i - 100
-                            if softclip_idx < 0:
-                                softclip_idx = 0
-                            break
+                    cluster_reads = set(cluster)
+                    for c in clusters_sharing_reads(cluster_reads, position):
+                        cluster.softclip_clusters.append(c.id)
             if cluster.clustertag.tsd.three_p_reads:
                 position = cluster.clustertag.tsd.three_p
                 if position:
-                    for i, c in enumerate(self.softclip_finder.clusters[softclip_idx:]):
-                        if position - SEARCH_WINDOW < c.clip_position < position + SEARCH_WINDOW:
-                            if set(cluster) & set(c):
-                                cluster.softclip_clusters.append(c.id)
-                                c.mate_id = str(cluster.id)
-                        elif c.clip_position > position + SEARCH_WINDOW:
-                            softclip_idx = i - 100
-                            if softclip_idx < 0:
-                                softclip_idx = 0
-                            break
+                    cluster_reads = cluster_reads or set(cluster)
+                    for c in clusters_sharing_reads(cluster_reads, position):
+                        cluster.softclip_clusters.append(c.id)
+                        c.mate_id = str(cluster.id)
+
+    def _process_clusters(self, func):
+        """
+        Call `func` on all clusters using the thread pool and replace each cluster with the clusters returned by `func`.
+
+        The results are inserted in the order of the input clusters, and clusters that have been added to self.clusters
+        are processed again, as they would be when iterating over self.clusters while inserting new clusters.
+        """
+        pending = self.clusters
+        while pending:
+            futures = {id(cluster): self.tp.submit(func, cluster) for cluster in pending}
+            added = set()
+            # Insert from the end, so that the indices of clusters that have not been replaced yet remain valid
+            for index in reversed(range(len(self.clusters))):
+                future = futures.get(id(self.clusters[index]))
+                if future:
+                    new_clusters = [cluster for cluster in future.result() if cluster]
+                    added.update(id(cluster) for cluster in new_clusters[1:])
+                    self._add_new_clusters(new_clusters, index)
+            pending = [cluster for cluster in self.clusters if id(cluster) in added]
 
     def _add_new_clusters(self, new_clusters, index):
         current_index = index
@@ -342,35 +724,55 @@ class ClusterFinder(SampleNameMixin, ToGffMixin, ToVcfMixin):
     def collect_evidence(self):
         """Count reads that overlap cluster site but do not provide evidence for an insertion."""
         logger.info("Collecting evidence (%s)", self.region or 0)
+        self._create_contigs()
         with Reader(self.input_path, index=True) as alignment_file:
-            for cluster in self.clusters:
-                if not cluster.abnormal:
-                    collect_evidence(cluster, alignment_file)
+            collect_evidence_for_clusters([cluster for cluster in self.clusters if not cluster.abnormal], alignment_file)
+
+    def assemble(self):
+        """Start assembling contigs of all clusters in the background, if contigs are part of any output."""
+        if self.output_fasta or self.output_gff or self.output_vcf:
+            logger.info("Assembling contigs (%s)", self.region or 0)
+            # Joining clusters is complete, so the clusters and their reads no longer change
+            self._assemblies = [self.tp.submit(cluster._make_contigs) for cluster in self.clusters]
 
     def _create_contigs(self):
-        futures = []
-        for cluster in self.clusters:
-            futures.append(self.tp.submit(cluster._make_contigs))
-        wait(futures)
+        """Wait until the contigs of all clusters are assembled, raising exceptions that occured during the assembly."""
+        if not self._assemblies:
+            self.assemble()
+        for future in self._assemblies:
+            future.result()
+
+    def output_clusters(self):
+        """Return an iterable of all clusters and softclip clusters, once the contigs of all clusters are assembled."""
+        self._create_contigs()
+        return super(ClusterFinder, self).output_clusters()
 
     def to_fasta(self):
         """Write supporting sequences to fasta file for detailed analysis."""
         logger.info("Writing contig fasta (%s)", self.region or 0)
         if self.output_fasta:
             self._create_contigs()
+            sequences = [seq for cluster in self.clusters for seq in cluster.to_fasta()]
             with open(self.output_fasta, 'w') as out:
-                for cluster in self.clusters:
-                    for seq in cluster.to_fasta():
-                        out.write(seq)
+                out.writelines(sequences)
+            if self.stream_outputs:
+                self.records['output_fasta'] = sequences
 
     def align_bwa(self):
-        """Align cluster contigs or invidiual reads to a reference and write result into cluster."""
+        """Start aligning cluster contigs or invidiual reads to a reference in the background."""
         logger.info("Aligning reads with BWA to describe cluster (%s)", self.region or 0)
         if self.output_fasta and (self.transposon_reference_fasta or self.transposon_bwa_index):
-            bwa = Bwa(input_path=self.output_fasta,
-                      bwa_index=self.transposon_bwa_index,
-                      reference_fasta=self.transposon_reference_fasta,
-                      threads=self.threads)
+            self._bwa = self.tp.submit(Bwa,
+                                       input_path=self.output_fasta,
+                                       bwa_index=self.transposon_bwa_index,
+                                       reference_fasta=self.transposon_reference_fasta,
+                                       threads=self.threads,
+                                       process_limiter=self.process_limiter)
+
+    def annotate_bwa(self):
+        """Wait for the alignment started by `align_bwa` and write the result into clusters."""
+        if self._bwa:
+            bwa = self._bwa.result()
             for cluster in self.clusters:
                 description = bwa.description.get(cluster.id)
                 if description:
@@ -383,24 +785,59 @@ class ClusterFinder(SampleNameMixin, ToGffMixin, ToVcfMixin):
         """Write clusters of reads and include cluster number in CD tag."""
         logger.info("Writing clusters of reads (%s)", self.region or 0)
         if self.output_bam:
-            with Writer(self.output_bam, header=self.header) as writer:
-                for i, cluster in enumerate(self.clusters):
-                    for r in cluster:
-                        r.set_tag('CD', i)
-                        writer.write(r)
-                    for r in cluster.evidence_for_five_p:
-                        r.set_tag('CD', i)
-                        r.set_tag('XD', 5)
-                        writer.write(r)
-                    for r in cluster.evidence_for_three_p:
-                        r.set_tag('CD', i)
-                        r.set_tag('XD', 3)
-                        writer.write(r)
-                    for r in cluster.evidence_against:
-                        r.set_tag('DD', i)
-                        writer.write(r)
-            if self.threads < 2:
-                # Because the cluster splitting doesn't necessarily conserve order we need to sort again.
-                # We do this only if not using threads, since with multiple threads we split and merge at the end,
-                # so there we'd need to sort again anyway.
-                sort_bam(inpath=self.output_bam, output=self.output_bam, sort_order='coordinate', threads=self.threads)
+            with Writer(self.output_bam, header=self.header) as writer, Reader(self.input_path, index=True) as alignment_file:
+                for r in self._reads_in_coordinate_order(alignment_file):
+                    writer.write(r)
+
+    def bam_lines(self):
+        """Return reads of all clusters in coordinate order as SAM lines."""
+        with Reader(self.input_path, index=True) as alignment_file:
+            return [r.to_string() for r in self._reads_in_coordinate_order(alignment_file)]
+
+    def _keep_records(self, key, lines_func):
+        """Keep the lines returned by `lines_func` in self.records if output `key` is requested."""
+        if getattr(self, key):
+            self.records[key] = lines_func()
+
+    def _cluster_reads(self, i, cluster, alignment_file):
+        """Yield tagged reads of cluster number `i`."""
+        for r in rehydrate(cluster, alignment_file, copy_segments=True):
+            r.set_tag('CD', i)
+            yield r
+        for r in rehydrate(cluster.evidence_for_five_p, alignment_file, copy_segments=True):
+            r.set_tag('CD', i)
+            r.set_tag('XD', 5)
+            yield r
+        for r in rehydrate(cluster.evidence_for_three_p, alignment_file, copy_segments=True):
+            r.set_tag('CD', i)
+            r.set_tag('XD', 3)
+            yield r
+        for r in rehydrate(cluster.evidence_against, alignment_file, copy_segments=True):
+            r.set_tag('DD', i)
+            yield r
+
+    def _reads_in_coordinate_order(self, alignment_file):
+        """
+        Yield tagged reads of all clusters in coordinate order.
+
+        Clusters are approximately ordered by position, so we keep reads in a heap until no later cluster
+        can contain a read with a lower position. This avoids sorting the output file after writing it.
+        """
+        # lower_bounds[i] is the lowest position of any read in clusters i and following
+        lower_bounds = []
+        lower_bound = (float('inf'), float('inf'))
+        for cluster in reversed(self.clusters):
+            reads = chain(cluster, cluster.evidence_for_five_p, cluster.evidence_for_three_p, cluster.evidence_against)
+            lower_bound = min(chain([lower_bound], (coordinate_sort_key(r) for r in reads)))
+            lower_bounds.append(lower_bound)
+        lower_bounds.reverse()
+        heap = []
+        counter = count()
+        for i, cluster in enumerate(self.clusters):
+            while heap and heap[0][0] < lower_bounds[i]:
+                yield heappop(heap)[-1]
+            for r in self._cluster_reads(i, cluster, alignment_file):
+                # The counter keeps reads at the same position in the order in which they have been added
+                heappush(heap, (coordinate_sort_key(r), next(counter), r))
+        while heap:
+            yield heappop(heap)[-1]
@@ -8,40 +8,65 @@ from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from Bio.SeqFeature import SeqFeature, FeatureLocation
 
-from .utils import sort
+from .utils import (
+    data_lines,
+    merge_sorted_lines,
+    open_text
+)
 
 
 def write_gff_cluster(clusters, header, output_path, sample_name='sample', threads=1):
-    """Write clusters as GFF entries."""
+    """Write clusters as GFF entries, sorted by reference (in the order of `header`) and start."""
     with open(output_path, "w") as out_handle:
-        tp = ThreadPoolExecutor(threads)
-        futures = []
-        records = OrderedDict((tid, SeqRecord(Seq(""), sn)) for tid, sn in enumerate(header.references))
-        for i, cluster in enumerate(clusters):
-            if not cluster.exclude:
-                func = partial(get_feature, cluster, sample_name, i)
-                futures.append(tp.submit(func))
-        for future in futures:
-            tid, feature = future.result()
-            records[tid].features.append(feature)
-        GFF.write(records.values(), out_handle)
-        tp.shutdown(wait=True)
+        write_gff_records(clusters=clusters, header=header, out_handle=out_handle, sample_name=sample_name, threads=threads)
+
+
+def write_gff_records(clusters, header, out_handle, sample_name='sample', threads=1):
+    """Write clusters as GFF entries to the open file `out_handle`, sorted by reference (in the order of `header`) and start."""
+    tp = ThreadPoolExecutor(threads)
+    futures = []
+    records = OrderedDict((tid, SeqRecord(Seq(""), sn)) for tid, sn in enumerate(header.references))
+    for i, cluster in enumerate(clusters):
+        if not cluster.exclude:
+            func = partial(get_feature, cluster, sample_name, i)
+            futures.append(tp.submit(func))
+    for future in futures:
+        tid, feature = future.result()
+        records[tid].features.append(feature)
+    for record in records.values():
+        # Clusters and softclip clusters are each sorted by position, so this is mostly merging two sorted runs
+        record.features.sort(key=lambda feature: feature.location.start)
+    GFF.write(records.values(), out_handle)
+    tp.shutdown(wait=True)
 
 
 def merge_gff_files(gff_files, output_path, sort=True):
-    """Merge multiple GFF files."""
-    wrote_header = False
+    """
+    Merge multiple GFF files.
+
+    If `sort` is True the features of the coordinate sorted `gff_files` are merged in coordinate order,
+    with references ordered by their first appearance in `gff_files`. Otherwise features are concatenated.
+    """
+    gff_files = [gff_file for gff_file in gff_files if os.path.exists(gff_file)]
     with open(output_path, 'w') as gff_writer:
-        for output_piece in gff_files:
-            if os.path.exists(output_piece):
-                with open(output_piece) as piece:
-                    for line in piece:
-                        if line.startswith('#') and wrote_header:
-                            continue
-                        gff_writer.write(line)
-            wrote_header = True
-    if sort:
-        sort_gff(input_path=output_path, output_path=output_path)
+        if gff_files:
+            with open_text(gff_files[0]) as first_gff:
+                for line in first_gff:
+                    if not line.startswith('#'):
+                        break
+                    gff_writer.write(line)
+        if sort:
+            references = {}
+
+            def key(line):
+                fields = line.split('\t', 4)
+                return references.setdefault(fields[0], len(references)), int(fields[3])
+
+            merge_sorted_lines(gff_files, gff_writer, key=key)
+        else:
+            for gff_file in gff_files:
+                with open_text(gff_file) as piece:
+                    gff_writer.writelines(data_lines(piece))
 
 
 def get_feature(cluster, sample, i):
@@ -61,8 +86,3 @@ def get_feature(cluster, sample, i):
             subfeatures.append(SeqFeature(**args))
         feature.sub_features = subfeatures
     return cluster.tid, feature
-
-
-def sort_gff(input_path, output_path):
-    """Sort GFF file."""
-    return sort(input_path=input_path, output_path=output_path, sort_cmd="sort -k 1,1 -k4,4n")
@@ -0,0 +1,73 @@
+"""Limit the number of external processes (cap3, bwa) that run concurrently across worker processes."""
+from contextlib import contextmanager
+import threading
+
+
+class ProcessLimiter(object):
+    """
+    Hand out up to `size` slots for running external processes.
+
+    A slot corresponds to one thread of an external process. `semaphore` and `lock` can be
+    multiprocessing.Manager proxies, which allows sharing a ProcessLimiter between worker processes.
+
+    >>> limiter = ProcessLimiter(size=2)
+    >>> with limiter.slots(4) as threads:
+    ...     threads
+    2
+    """
+
+    def __init__(self, size, semaphore=None, lock=None):
+        """Initialize ProcessLimiter instance."""
+        self.size = size
+        self.semaphore = semaphore or threading.BoundedSemaphore(size)
+        self.lock = lock or threading.Lock()
+
+    @classmethod
+    def from_manager(cls, manager, size):
+        """Return a ProcessLimiter that can be shared with processes started after `manager`."""
+        return cls(size=size, semaphore=manager.BoundedSemaphore(size), lock=manager.Lock())
+
+    @contextmanager
+    def slots(self, threads=1):
+        """Block until `threads` slots are available and return the number of acquired slots, which is at most self.size."""
+        threads = max(1, min(threads, self.size))
+        # Acquiring multiple slots while holding the lock prevents two processes from waiting on each other's partial acquisitions
+        with self.lock:
+            for _ in range(threads):
+                self.semaphore.acquire()
+        try:
+            yield threads
+        finally:
+            for _ in range(threads):
+                self.semaphore.release()
+
+
+EXTERNAL_PROCESSES = 0
+# Number of external processes started in this process
+_EXTERNAL_PROCESSES_LOCK = threading.Lock()
+
+
+@contextmanager
+def external_process_slots(threads=1, limiter=None):
+    """
+    Wait for slots for an external process that runs with `threads` threads and return the number of threads it may use.
+
+    Slots are handed out by the ProcessLimiter `limiter`, the process can start immediately if `limiter` is None.
+
+    >>> with external_process_slots(3) as threads:
+    ...     threads
+    3
+    """
+    global EXTERNAL_PROCESSES
+    with _EXTERNAL_PROCESSES_LOCK:
+        EXTERNAL_PROCESSES += 1
+    if limiter is None:
+        yield threads
+    else:
+        with limiter.slots(threads) as threads:
+            yield threads
+
+
+def external_process_count():
+    """Return the number of external processes that have been started by this process."""
+    return EXTERNAL_PROCESSES
@@ -0,0 +1,124 @@
+"""Record wall time, CPU time and memory usage of the stages of ClusterFinder instances."""
+import json
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .process_limit import external_process_count
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+MAXIMUM_FIELDS = ('peak_rss_delta_kb',)
+# Fields that are aggregated by taking the maximum, all other numeric fields are summed up
+
+
+def peak_rss_kb():
+    """Return the peak resident set size of this process in kilobytes, or 0 if it can't be determined."""
+    if resource is None:
+        return 0
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # ru_maxrss is reported in bytes on macOS
+        return peak_rss // 1024
+    return peak_rss
+
+
+def _usage():
+    times = os.times()
+    return OrderedDict([('wall_time', time.time()),
+                        ('cpu_time', times[0] + times[1]),
+                        ('child_cpu_time', times[2] + times[3]),
+                        ('peak_rss_delta_kb', peak_rss_kb()),
+                        ('external_processes', external_process_count())])
+
+
+class StageProfile(object):
+    """
+    Collect statistics for the stages of a ClusterFinder instance working on `region`.
+
+    Each stage records wall time, CPU time of this process and of finished external processes, the increase of the peak
+    resident set size and the number of external processes started. Further counts can be added to the yielded dictionary.
+
+    >>> profile = StageProfile(region='3R:1-100')
+    >>> with profile.stage('find_cluster') as stats:
+    ...     stats['reads'] = 10
+    >>> profile.stages[0]['stage'], profile.stages[0]['reads'], profile.stages[0]['external_processes']
+    ('find_cluster', 10, 0)
+    """
+
+    def __init__(self, region=None):
+        """Initialize StageProfile instance."""
+        self.region = region
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        """Record statistics for stage `name`."""
+        stats = OrderedDict([('stage', name)])
+        before = _usage()
+        try:
+            yield stats
+        finally:
+            after = _usage()
+            for key, value in before.items():
+                stats[key] = after[key] - value
+            logger.debug("Stage '%s' took %.2f seconds (%s)", name, stats['wall_time'], self.region or 0)
+            self.stages.append(stats)
+
+    def to_dict(self):
+        """Return statistics of all stages."""
+        return OrderedDict([('region', self.region), ('stages', self.stages)])
+
+    def write(self, path):
+        """Write statistics of all stages as JSON to `path`."""
+        write_profile_report([self.to_dict()], path)
+
+
+def aggregate_stages(regions):
+    """
+    Aggregate statistics of stages with the same name over all `regions`.
+
+    >>> regions = [{'region': 'a', 'stages': [{'stage': 'to_bam', 'wall_time': 1.0, 'peak_rss_delta_kb': 10}]},
+    ...            {'region': 'b', 'stages': [{'stage': 'to_bam', 'wall_time': 2.0, 'peak_rss_delta_kb': 5}]}]
+    >>> stage = aggregate_stages(regions)[0]
+    >>> stage['stage'], stage['regions'], stage['wall_time'], stage['peak_rss_delta_kb']
+    ('to_bam', 2, 3.0, 10)
+    """
+    stages = OrderedDict()
+    for region in regions:
+        for stats in region['stages']:
+            total = stages.setdefault(stats['stage'], OrderedDict([('stage', stats['stage']), ('regions', 0)]))
+            total['regions'] += 1
+            for key, value in stats.items():
+                if key == 'stage':
+                    continue
+                if key in MAXIMUM_FIELDS:
+                    total[key] = max(total.get(key, value), value)
+                else:
+                    total[key] = total.get(key, 0) + value
+    return list(stages.values())
+
+
+def write_profile_report(regions, path):
+    """Write statistics of `regions` and their aggregate per stage as JSON to `path`."""
+    report = OrderedDict([('stages', aggregate_stages(regions)), ('regions', regions)])
+    with open(path, 'w') as out:
+        json.dump(report, out, indent=2)
+    return path
+
+
+def merge_profile_reports(paths, output_path):
+    """Merge the profile reports at `paths` into a single report at `output_path`."""
+    regions = []
+    for path in paths:
+        if os.path.exists(path):
+            with open(path) as report:
+                regions.extend(json.load(report, object_pairs_hook=OrderedDict)['regions'])
+    return write_profile_report(regions, output_path)
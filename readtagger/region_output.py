@@ -0,0 +1,127 @@
+"""Stream outputs of regions processed in worker processes into the final output files."""
+import logging
+import os
+from heapq import (
+    heappop,
+    heappush
+)
+
+import pysam
+
+from .bam_io import parse_region
+from .vcf_io import get_variant_header
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_COLUMNS = {'output_bam': (2, 3), 'output_gff': (0, 3), 'output_vcf': (0, 1)}
+# Columns of reference name and 1-based position in SAM, GFF and VCF lines
+
+
+class RegionOutputWriter(object):
+    """
+    Write records of `regions` to the final outputs as soon as the records of all previous regions have been added.
+
+    Records of a region are a dictionary of SAM, GFF and VCF lines and FASTA sequences, keyed by output name.
+    Records of a region can sort before records of the previous region if they are less than `padding` nucleotides
+    before the start of the region, so these records of the previous region are held back until the next region is added.
+    Compressed outputs are indexed with tabix (using a CSI index if `csi` is True) when the writer is closed.
+    If an exception is raised within the context, the incomplete outputs are removed.
+    Use this class with a contexthandler.
+    """
+
+    def __init__(self, regions, header, sample_name, output_bam=None, output_gff=None, output_vcf=None, output_fasta=None,
+                 padding=0, threads=1, csi=False):
+        """Initialize RegionOutputWriter instance."""
+        self.regions = regions
+        self.header = header
+        self.sample_name = sample_name
+        self.output_paths = {'output_bam': output_bam, 'output_gff': output_gff, 'output_vcf': output_vcf, 'output_fasta': output_fasta}
+        self.padding = padding
+        self.threads = threads
+        self.csi = csi
+        self.tids = {name: tid for tid, name in enumerate(header.references)}
+        self.pending = {}
+        self.next_index = 0
+        self.heaps = {key: [] for key in OUTPUT_COLUMNS}
+        self.counter = 0
+        self.outputs = {}
+        self.gff_header_written = False
+
+    def __enter__(self):
+        """Open all requested outputs."""
+        output_bam = self.output_paths['output_bam']
+        if output_bam:
+            header = self.header.to_dict()
+            header.setdefault('HD', {'VN': '1.0'})['SO'] = 'coordinate'
+            self.outputs['output_bam'] = pysam.AlignmentFile(output_bam, mode='wb', header=header, threads=self.threads)
+        for key in ('output_gff', 'output_vcf', 'output_fasta'):
+            if self.output_paths[key]:
+                self.outputs[key] = open(self._plain_path(self.output_paths[key]), 'w')
+        if 'output_vcf' in self.outputs:
+            self.outputs['output_vcf'].write(str(get_variant_header(self.header, self.sample_name)))
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Write held back records and close all outputs, remove all outputs if an exception occured."""
+        if type is None:
+            for key in self.heaps:
+                self._flush(key)
+        for output in self.outputs.values():
+            output.close()
+        if type is not None:
+            for key in self.outputs:
+                path = self.output_paths[key] if key == 'output_bam' else self._plain_path(self.output_paths[key])
+                if os.path.isfile(path):
+                    logger.warning("Removing incomplete output '%s'", path)
+                    os.remove(path)
+            return
+        for key, preset in (('output_gff', 'gff'), ('output_vcf', 'vcf')):
+            output_path = self.output_paths[key]
+            if output_path and output_path.endswith('.gz'):
+                pysam.tabix_index(self._plain_path(output_path), preset=preset, csi=self.csi, force=True)
+
+    @staticmethod
+    def _plain_path(output_path):
+        return output_path[:-3] if output_path.endswith('.gz') else output_path
+
+    def add(self, index, records):
+        """Add `records` of region number `index`, pass an empty dictionary for regions that failed or have no records."""
+        self.pending[index] = records
+        while self.next_index in self.pending:
+            self._write_region(self.pending.pop(self.next_index))
+            self.next_index += 1
+
+    def _write_region(self, records):
+        if 'output_fasta' in self.outputs:
+            self.outputs['output_fasta'].writelines(records.get('output_fasta', []))
+        for key, heap in self.heaps.items():
+            if key not in self.outputs:
+                continue
+            for line in records.get(key, []):
+                if line.startswith('#'):
+                    if key == 'output_gff' and not self.gff_header_written:
+                        self.outputs[key].write(line)
+                    continue
+                self.counter += 1
+                heappush(heap, (self._key(key, line), self.counter, line))
+            if key == 'output_gff' and records.get(key):
+                self.gff_header_written = True
+            if self.next_index + 1 < len(self.regions):
+                chrom, start, _ = parse_region(self.regions[self.next_index + 1])
+                self._flush(key, bound=(self.tids.get(chrom, float('inf')), (start or 1) - self.padding))
+
+    def _key(self, key, line):
+        reference_column, position_column = OUTPUT_COLUMNS[key]
+        fields = line.split('\t', position_column + 1)
+        # Unplaced reads have a reference name of '*' and belong at the end of the file
+        return self.tids.get(fields[reference_column], float('inf')), int(fields[position_column])
+
+    def _flush(self, key, bound=None):
+        heap = self.heaps[key]
+        output = self.outputs.get(key)
+        while heap and (bound is None or heap[0][0] < bound):
+            _, _, line = heappop(heap)
+            if key == 'output_bam':
+                output.write(pysam.AlignedSegment.fromstring(line, output.header))
+            else:
+                output.write(line)
@@ -0,0 +1,51 @@
+"""Split the regions of an input file into shards that can be processed independently, e.g. on different hosts."""
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def write_plan(regions, path):
+    """Write `regions` to the file at `path`, one region per line."""
+    with open(path, 'w') as plan:
+        for region in regions:
+            plan.write("%s\n" % region)
+    logger.info("Wrote %d regions to '%s'", len(regions), path)
+    return path
+
+
+def read_plan(path):
+    """Return the regions listed in the file at `path`, one region per line."""
+    with open(path) as plan:
+        return [line.strip() for line in plan if line.strip()]
+
+
+def parse_shard(shard):
+    """
+    Return a tuple of shard number and shard count for a shard specified as `number/count`.
+
+    >>> parse_shard('3/10')
+    (3, 10)
+    >>> parse_shard('11/10')
+    Traceback (most recent call last):
+    ...
+    ValueError: Shard must be specified as number/count with 1 <= number <= count, got '11/10'
+    """
+    try:
+        number, count = [int(i) for i in shard.split('/')]
+    except ValueError:
+        number = count = 0
+    if not 1 <= number <= count:
+        raise ValueError("Shard must be specified as number/count with 1 <= number <= count, got '%s'" % shard)
+    return number, count
+
+
+def shard_regions(regions, number, count):
+    """
+    Return the regions of shard `number` out of `count` shards.
+
+    Regions are distributed in turn, so that densely covered neighbouring regions end up in different shards.
+
+    >>> shard_regions(['2L:1-10', '2L:11-20', '2R:1-10', '3L:1-10', '3R:1-10'], 2, 2)
+    ['2L:11-20', '3L:1-10']
+    """
+    return regions[number - 1::count]
@@ -0,0 +1,109 @@
+"""Index positions and BGZF offsets of reads that are relevant for finding clusters."""
+import logging
+import os
+from collections import namedtuple
+
+import pysam
+
+from .find_softclip_clusters import MIN_CLIP_LENGTH
+from .tag_softclip import get_softclipped_portion
+
+logger = logging.getLogger(__name__)
+
+TAGS = ('AD', 'BD')
+MIN_MAPQ = 4
+# Default MAPQ below which reads are not indexed, which is also the default of findcluster
+
+TagIndex = namedtuple('TagIndex', 'path indexed_reads total_reads')
+
+
+def read_is_indexed(r, min_mapq=MIN_MAPQ, include_duplicates=False):
+    """
+    Return whether read `r` can contribute to a cluster or softclip cluster.
+
+    Like ClusterFinder.find_cluster, reads with a MAPQ below `min_mapq` and duplicates (unless `include_duplicates` is True)
+    are ignored. Reads need an AD or BD tag or need to be clipped by at least as many nucleotides as reads in a SoftClipCluster.
+    """
+    if r.mapping_quality < min_mapq or (r.is_duplicate and not include_duplicates):
+        return False
+    return any(r.has_tag(tag) for tag in TAGS) or bool(r.cigartuples and get_softclipped_portion(read=r, min_clip_length=MIN_CLIP_LENGTH))
+
+
+def write_tag_index(input_path, output_path=None, min_mapq=MIN_MAPQ, include_duplicates=False):
+    """
+    Write a tabix-indexed file of reads in `input_path` that have an AD or BD tag or that are softclipped.
+
+    Each line contains reference name, start, end and BGZF virtual offset of a read. `min_mapq` and `include_duplicates`
+    are recorded in the header of the index, so that the index is only used by runs that skip at least the same reads.
+    `input_path` must be coordinate sorted.
+    Returns a TagIndex with the path to the bgzipped index and the number of indexed and total reads.
+    """
+    output_path = output_path or "%s.tag_index" % input_path
+    if output_path.endswith('.gz'):
+        output_path = output_path[:-3]
+    indexed_reads = 0
+    total_reads = 0
+    with pysam.AlignmentFile(input_path) as f, open(output_path, 'w') as out:
+        out.write("#min_mapq=%d\tinclude_duplicates=%d\n" % (min_mapq, include_duplicates))
+        virtual_offset = f.tell()
+        for r in f:
+            total_reads += 1
+            if r.reference_id >= 0 and read_is_indexed(r, min_mapq=min_mapq, include_duplicates=include_duplicates):
+                indexed_reads += 1
+                reference_end = r.reference_end or r.reference_start + 1
+                out.write("%s\t%d\t%d\t%d\n" % (r.reference_name, r.reference_start, reference_end, virtual_offset))
+            virtual_offset = f.tell()
+    logger.info("Indexed %d of %d reads in '%s'", indexed_reads, total_reads, input_path)
+    path = pysam.tabix_index(output_path, seq_col=0, start_col=1, end_col=2, zerobased=True, force=True)
+    return TagIndex(path=path, indexed_reads=indexed_reads, total_reads=total_reads)
+
+
+def read_index_settings(index_path):
+    """
+    Return the `min_mapq` and `include_duplicates` settings of the index at `index_path`.
+
+    Indexes without settings include all reads.
+    """
+    settings = {'min_mapq': 0, 'include_duplicates': 1}
+    with pysam.TabixFile(index_path) as index:
+        for line in index.header:
+            for field in line.lstrip('#').split('\t'):
+                key, _, value = field.partition('=')
+                if key in settings:
+                    settings[key] = int(value)
+    return settings['min_mapq'], bool(settings['include_duplicates'])
+
+
+def tag_index_is_current(input_path, index_path, min_mapq=0, include_duplicates=True):
+    """
+    Return whether the index at `index_path` can be used to find clusters in `input_path`.
+
+    The index must have been written after the alignment file at `input_path` and must not skip reads with a MAPQ of
+    at least `min_mapq` or duplicates if `include_duplicates` is True.
+    """
+    if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(input_path):
+        logger.warning("Tag index '%s' is missing or older than '%s', ignoring it.", index_path, input_path)
+        return False
+    index_min_mapq, index_includes_duplicates = read_index_settings(index_path)
+    if index_min_mapq > min_mapq or (include_duplicates and not index_includes_duplicates):
+        logger.warning("Tag index '%s' skips reads with a MAPQ below %d%s, ignoring it.",
+                       index_path,
+                       index_min_mapq,
+                       '' if index_includes_duplicates else ' and duplicates')
+        return False
+    return True
+
+
+def fetch_indexed_reads(alignment_file, index_path, region=None):
+    """Fetch reads listed in the index at `index_path` and yield tuples of (virtual_offset, read)."""
+    with pysam.TabixFile(index_path) as index:
+        try:
+            entries = index.fetch(region=region)
+        except ValueError:
+            # Happens if region is not present in the index, i.e there are no reads to look at
+            return
+        for entry in entries:
+            virtual_offset = int(entry.rsplit('\t', 1)[1])
+            if alignment_file.tell() != virtual_offset:
+                alignment_file.seek(virtual_offset)
+            yield virtual_offset, next(alignment_file)
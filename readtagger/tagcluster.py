@@ -2,7 +2,7 @@
 import logging
 from cached_property import cached_property
 from .dumb_consensus import dumb_consensus
-from .cap3 import Cap3Assembly
+from .assembly import DEFAULT_ASSEMBLER
 from .targetsiteduplication import TargetSiteDuplication
 
 logger = logging.getLogger(__name__)
@@ -17,10 +17,11 @@ class TagCluster(object):
     all sequences pointing into the insertion to assemble the putative inserted sequence, for the left and right side.
     """
 
-    def __init__(self, cluster, shm_dir=None):
-        """Cluster is an iterable of pysam.AlignedSegment objects."""
+    def __init__(self, cluster, shm_dir=None, assembler=None):
+        """Cluster is an iterable of pysam.AlignedSegment objects, inserts are assembled by `assembler`."""
         self.cluster = cluster
         self.shm_dir = shm_dir
+        self.assembler = assembler or DEFAULT_ASSEMBLER
         self.tsd = TargetSiteDuplication(self.cluster)
         self._left_breakpoint_sequence = None
         self._right_breakpoint_sequence = None
@@ -31,7 +32,7 @@ class TagCluster(object):
         """Return insert sequence as assembled from the left side."""
         if self.left_sequences:
             if not hasattr(self, '_left_seq_cap3'):
-                self._left_seq_cap3 = Cap3Assembly(self.left_sequences, shm_dir=self.shm_dir)
+                self._left_seq_cap3 = self.assembler.assemble(self.left_sequences, shm_dir=self.shm_dir, keep=self.split_read_names)
             return self._left_seq_cap3
 
     @cached_property
@@ -39,9 +40,14 @@ class TagCluster(object):
         """Return insert sequence as assembled from the right side."""
         if self.right_sequences:
             if not hasattr(self, '_right_seq_cap3'):
-                self._right_seq_cap3 = Cap3Assembly(self.right_sequences, shm_dir=self.shm_dir)
+                self._right_seq_cap3 = self.assembler.assemble(self.right_sequences, shm_dir=self.shm_dir, keep=self.split_read_names)
             return self._right_seq_cap3
 
+    @property
+    def split_read_names(self):
+        """Return names of reads that have been split between genome and insert, these are always kept when downsampling reads for assembly."""
+        return {r.query_name for r in self.cluster if r.has_tag('AD')}
+
     def find_breakpoint(self):
         """
         Find the breakpoint of a potential insertion.
@@ -1,7 +1,13 @@
-import os
-import shlex
-import subprocess
-import tempfile
+import gzip
+from contextlib import contextmanager
+from heapq import (
+    heappop,
+    heappush
+)
+
+import pysam
+import six
+
 from .instance_lru import lru_cache
 
 COMPLEMENTARY_SEQUENCES = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G', 'N': 'N'}
@@ -13,26 +19,88 @@ def revcom(string):
     return "".join([COMPLEMENTARY_SEQUENCES[s] for s in string[::-1]])
 
 
-def sort(input_path, output_path, sort_cmd="sort -k 1,1 -k4,4n"):
-    """Sort text file at input path."""
-    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(output_path), prefix="sort_")
-    header_lines = []
-    with open(input_path) as gff_in, open(tmp, 'w') as out:
-        for line in gff_in:
-            if line.startswith('#'):
-                header_lines.append(line)
-            else:
-                out.write(line)
-        out.close()
-    with open(output_path, 'w') as out:
-        cmd = shlex.split(sort_cmd)
-        cmd.append(tmp)
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, close_fds=True)
-        # No need to add newlines, those should be present already
-        out.write("".join(header_lines))
-        for line in p.stdout:
-            out.write(line.decode())
-    os.close(fd)
+def open_text(path):
+    """Open the text file at `path` for reading, decompressing it if `path` ends with `.gz`."""
+    if path.endswith('.gz'):
+        return gzip.open(path) if six.PY2 else gzip.open(path, 'rt')
+    return open(path)
+
+
+def data_lines(handle):
+    """Yield lines of `handle` that are neither empty nor header lines."""
+    for line in handle:
+        if line.strip() and not line.startswith('#'):
+            yield line
+
+
+def merge_sorted_lines(paths, output_handle, key):
+    """
+    Write data lines of the sorted text files at `paths` to `output_handle` in the order given by `key`.
+
+    Files are only opened once the output reaches their first line,
+    so that files covering disjoint regions are concatenated without opening all files at once.
+    """
+    pending = []
+    for index, path in enumerate(paths):
+        with open_text(path) as handle:
+            first_line = next(data_lines(handle), None)
+        if first_line is not None:
+            pending.append((key(first_line), index, path))
+    pending.sort(reverse=True)
+    heap = []
+    while heap or pending:
+        if pending and (not heap or pending[-1][0] <= heap[0][0]):
+            # The next file starts before the lowest line we have seen so far
+            _, index, path = pending.pop()
+            handle = open_text(path)
+            lines = data_lines(handle)
+            line = next(lines)
+        else:
+            _, index, line, handle, lines = heappop(heap)
+            output_handle.write(line)
+            line = next(lines, None)
+        if line is None:
+            handle.close()
+        else:
+            heappush(heap, (key(line), index, line, handle, lines))
+
+
+MAX_TBI_REFERENCE_LENGTH = 2 ** 29 - 1
+# Positions beyond this can only be indexed with a CSI index
+
+
+def needs_csi_index(header):
+    """Return whether a reference in `header` is too long to be indexed with a tabix (.tbi) index."""
+    return any(length > MAX_TBI_REFERENCE_LENGTH for length in header.lengths)
+
+
+def files_need_csi_index(bam_files=(), vcf_files=()):
+    """Return whether a reference in the headers of `bam_files` or the contig lines of `vcf_files` is too long for a tabix index."""
+    for path in bam_files:
+        with pysam.AlignmentFile(path) as f:
+            if needs_csi_index(f.header):
+                return True
+    for path in vcf_files:
+        with pysam.VariantFile(path) as f:
+            if any((contig.length or 0) > MAX_TBI_REFERENCE_LENGTH for contig in f.header.contigs.values()):
+                return True
+    return False
+
+
+@contextmanager
+def tabix_output(output_path, preset, csi=False):
+    """
+    Yield the path a coordinate sorted text file should be written to.
+
+    If `output_path` ends with `.gz` the file is bgzip compressed to `output_path` and indexed with tabix
+    (using a CSI index if `csi` is True) after writing it.
+    """
+    if not output_path.endswith('.gz'):
+        yield output_path
+    else:
+        plain_path = output_path[:-3]
+        yield plain_path
+        pysam.tabix_index(plain_path, preset=preset, csi=csi, force=True)
 
 
 def overlap(start1, end1, start2, end2, tolerance=0):
@@ -5,7 +5,11 @@ from string import Template
 import pysam
 import pysam.bcftools
 
-from .utils import sort
+from .utils import (
+    data_lines,
+    merge_sorted_lines,
+    open_text
+)
 
 try:
     from readtagger import VERSION
@@ -97,53 +101,82 @@ def get_vcf_header(header, sample_name):
                                           header_line="%s\t%s\n" % (VCF_HEADER_LINE, sample_name))
 
 
-def write_vcf(output_path, clusters, header, sample_name, **kwargs):
-    """Write clusters as VCF."""
+def get_variant_header(header, sample_name):
+    """Return the VCF header for clusters of `sample_name` as pysam.VariantHeader."""
     header_content = get_vcf_header(header=header, sample_name=sample_name)
     with TemporaryDirectory(prefix="tmp_vcf_header") as temp_dir:
         vcf_header_tmp = os.path.join(temp_dir, 'header.vcf')
         with open(vcf_header_tmp, 'w') as header_out:
             header_out.write(header_content)
         with pysam.VariantFile(vcf_header_tmp) as vcf_sample_file:
-            vcf_header = vcf_sample_file.header
-        with pysam.VariantFile(output_path, 'w', header=vcf_header) as vcf_out:
-            for cluster in clusters:
-                record = vcf_out.new_record()
-                for k, v in cluster.vcf_mandatory.items():
-                    v = getattr(cluster, v)
-                    setattr(record, k, v)
-                for k, v in cluster.vcf_info.items():
-                    record.info[k] = getattr(cluster, v)
-                for k, v in cluster.vcf_sample.items():
-                    if isinstance(v, list):
-                        v = [getattr(cluster, _) for _ in v]
-                    else:
-                        v = getattr(cluster, v)
-                    record.samples[sample_name][k] = v
-                vcf_out.write(record)
+            return vcf_sample_file.header.copy()
+
+
+def vcf_records(vcf_out, clusters, sample_name):
+    """Yield records of `vcf_out` for `clusters`, sorted by reference and position."""
+    for cluster in sorted(clusters, key=lambda c: (c.tid, c.pos)):
+        record = vcf_out.new_record()
+        for k, v in cluster.vcf_mandatory.items():
+            v = getattr(cluster, v)
+            setattr(record, k, v)
+        for k, v in cluster.vcf_info.items():
+            record.info[k] = getattr(cluster, v)
+        for k, v in cluster.vcf_sample.items():
+            if isinstance(v, list):
+                v = [getattr(cluster, _) for _ in v]
+            else:
+                v = getattr(cluster, v)
+            record.samples[sample_name][k] = v
+        yield record
+
+
+def write_vcf(output_path, clusters, header, sample_name, **kwargs):
+    """Write clusters as VCF, sorted by reference (in the order of `header`) and position."""
+    with pysam.VariantFile(output_path, 'w', header=get_variant_header(header, sample_name)) as vcf_out:
+        for record in vcf_records(vcf_out, clusters, sample_name):
+            vcf_out.write(record)
+
+
+def vcf_lines(clusters, header, sample_name):
+    """Return VCF lines of `clusters`, sorted by reference and position."""
+    with pysam.VariantFile(os.devnull, 'w', header=get_variant_header(header, sample_name)) as vcf_out:
+        return [str(record) for record in vcf_records(vcf_out, clusters, sample_name)]
 
 
 def merge_vcf_files(vcf_files, output_path, sort_output=True):
-    """Merge vcf files."""
+    """
+    Merge vcf files.
+
+    If `sort_output` is True the records of the coordinate sorted `vcf_files` are merged in coordinate order,
+    otherwise records are concatenated. Only one file is read at a time unless the files overlap.
+    `vcf_files` may be bgzip compressed. If none of them exist an empty `output_path` is written.
+    """
     # Ideally we'd be able to use
     # pysam.bcftools.merge('-o', output_path, *vcf_files)
     # But this only works for bgzipped vcf files.
-    all_vfs = [pysam.VariantFile(vcf_file) for vcf_file in vcf_files if os.path.exists(vcf_file)]
-    try:
-        header = all_vfs[0].header
-        for vf in all_vfs:
-            header.merge(vf.header)
-        with pysam.VariantFile(output_path, 'w', header=header) as output:
-            for vf in all_vfs:
-                for r in vf:
-                    output.write(r)
-    finally:
-        for vf in all_vfs:
-            vf.close()
-    if sort_output:
-        sort_vcf(input_path=output_path, output_path=output_path)
-
-
-def sort_vcf(input_path, output_path):
-    """Sort VCF."""
-    return sort(input_path=input_path, output_path=output_path, sort_cmd="sort -k 1,1 -k2,2n")
+    vcf_files = [vcf_file for vcf_file in vcf_files if os.path.exists(vcf_file)]
+    header = None
+    for vcf_file in vcf_files:
+        with pysam.VariantFile(vcf_file) as vf:
+            if header is None:
+                header = vf.header.copy()
+            else:
+                header.merge(vf.header)
+    if header is None:
+        # Write an empty file, so that the output exists and can be indexed
+        open(output_path, 'w').close()
+        return
+    contigs = {contig: i for i, contig in enumerate(header.contigs)}
+
+    def key(line):
+        fields = line.split('\t', 2)
+        return contigs.get(fields[0], len(contigs)), int(fields[1])
+
+    with open(output_path, 'w') as output:
+        output.write(str(header))
+        if sort_output:
+            merge_sorted_lines(vcf_files, output, key=key)
+        else:
+            for vcf_file in vcf_files:
+                with open_text(vcf_file) as vf:
+                    output.writelines(data_lines(vf))
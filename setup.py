@@ -13,7 +13,9 @@ ENTRY_POINTS = '''
         annotate_softclipped_reads=readtagger.cli.annotate_softclipped_reads:annotate_softclipped_reads
         confirm_insertions=readtagger.cli.classify_somatic_insertions:confirm_insertions
         findcluster=readtagger.cli.findcluster:findcluster
+        index_tagged_reads=readtagger.cli.index_tagged_reads:index_tagged_reads
         merge_clusterfinder_vcfs=readtagger.cli.merge_findcluster_vcf:merge_findcluster
+        merge_findcluster_shards=readtagger.cli.merge_findcluster_shards:merge_findcluster_shards
         plot_coverage=readtagger.cli.plot_coverage:plot_coverage
         pysamtools_view=readtagger.cli.pysamtools_view_cli:pysamtools_view
         readtagger=readtagger.cli.readtagger_cli:readtagger
@@ -1,5 +1,18 @@
+import random
+import sqlite3
 import subprocess
+from readtagger.assembly import (
+    assemble_sequences,
+    CachedAssembly,
+    downsample_sequences,
+    can_assemble_in_process,
+    IN_PROCESS_MAX_READ_LENGTH,
+    IN_PROCESS_MAX_READS,
+    OverlapAssembly
+)
+from readtagger.assembly_cache import AssemblyCache
 from readtagger.cap3 import Cap3Assembly
+from readtagger.utils import revcom
 
 
 def test_cap3_execption_handling(mocker):  # noqa: D103
@@ -10,3 +23,73 @@ def test_cap3_execption_handling(mocker):  # noqa: D103
 
     mocker.patch('subprocess.check_call', raises_exception)
     assert len(Cap3Assembly(sequences).contigs) == 0
+
+
+def test_overlap_assembly():  # noqa: D103
+    random.seed(42)
+    insert = "".join(random.choice('ACGT') for _ in range(400))
+    reads = {}
+    for i, start in enumerate(range(0, 300, 25)):
+        read = insert[start:start + 100]
+        reads["read%d" % i] = revcom(read) if i % 3 == 0 else read
+    assembly = assemble_sequences(reads, in_process=True)
+    assert isinstance(assembly, OverlapAssembly)
+    assert len(assembly.contigs) == 1
+    assert sorted(assembly.contig_read_names[0]) == sorted(reads)
+    assert assembly.contigs[0].sequence in (insert[:375], revcom(insert[:375]))
+
+
+def test_assemble_sequences_uses_cap3_for_large_sets():  # noqa: D103
+    assert not can_assemble_in_process({i: 'ATGC' for i in range(IN_PROCESS_MAX_READS + 1)})
+    assert not can_assemble_in_process({'long_read': 'A' * (IN_PROCESS_MAX_READ_LENGTH + 1)})
+    assert can_assemble_in_process({i: 'ATGC' for i in range(IN_PROCESS_MAX_READS)})
+
+
+def test_assembly_cache_persistence(tmpdir):  # noqa: D103
+    path = tmpdir.join('assemblies.sqlite').strpath
+    reads = {'read1': 'TAGTTGTAAGCGATTCTTAACTTACCTACCTACATATATATACTTACGTATTTTACTATT',
+             'read4': 'CGATTCTTAACTTACCTACCTACATATATATACTTACGTATTTTACTATTCGAGTCGAACA'}
+    cache = AssemblyCache(path=path)
+    assembly = assemble_sequences(reads, cache=cache, in_process=True)
+    cache.close()
+    cached = assemble_sequences({'a': reads['read1'], 'b': reads['read4']}, cache=AssemblyCache(path=path), in_process=True)
+    assert isinstance(cached, CachedAssembly)
+    assert [c.sequence for c in cached.contigs] == [c.sequence for c in assembly.contigs]
+    assert sorted(cached.contig_read_names[0]) == ['a', 'b']
+
+
+def test_assembly_cache_unavailable_database(tmpdir, monkeypatch):  # noqa: D103
+    monkeypatch.setattr('readtagger.assembly_cache.DATABASE_TIMEOUT', 0.1)
+    path = tmpdir.join('assemblies.sqlite').strpath
+    cache = AssemblyCache(path=path)
+    key = cache.key('OverlapAssembly', ['ATGC'])
+    other_process = sqlite3.connect(path)
+    other_process.execute('BEGIN EXCLUSIVE')
+    # Writing to a locked database discards the assembly instead of failing
+    cache.set(key, [('ATGC', [0, 1])])
+    cache.flush()
+    other_process.rollback()
+    cache.clear()
+    assert cache.get(key) is None
+    cache.set(key, [('ATGC', [0, 1])])
+    cache.close()
+    assert AssemblyCache(path=path).get(key) == [('ATGC', [0, 1])]
+    other_process.close()
+    corrupt_path = tmpdir.join('corrupt.sqlite')
+    corrupt_path.write('not a database')
+    assert AssemblyCache(path=corrupt_path.strpath).get(key) is None
+
+
+def test_downsample_sequences():  # noqa: D103
+    random.seed(1)
+    insert = "".join(random.choice('ACGT') for _ in range(2000))
+    reads = {"read%d" % i: insert[start:start + 100] for i, start in enumerate(random.randint(0, 1900) for _ in range(1000))}
+    downsampled = downsample_sequences(reads, target_reads=50, keep={'read999'})
+    assert len(downsampled) == 50
+    assert 'read999' in downsampled
+    assert downsampled == downsample_sequences(dict(reversed(list(reads.items()))), target_reads=50, keep={'read999'})
+    covered = set()
+    for sequence in downsampled.values():
+        start = insert.index(sequence)
+        covered.update(range(start, start + 100))
+    assert len(covered) > 1500
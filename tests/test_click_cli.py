@@ -3,12 +3,15 @@ from readtagger.cli.add_matesequence import annotate_mate
 from readtagger.cli.annotate_softclipped_reads import annotate_softclipped_reads
 from readtagger.cli.classify_somatic_insertions import confirm_insertions
 from readtagger.cli.findcluster import findcluster
+from readtagger.cli.index_tagged_reads import index_tagged_reads
 from readtagger.cli.merge_findcluster_vcf import merge_findcluster
+from readtagger.cli.merge_findcluster_shards import merge_findcluster_shards
 from readtagger.cli.plot_coverage import plot_coverage
 from readtagger.cli.pysamtools_view_cli import pysamtools_view
 from readtagger.cli.readtagger_cli import readtagger
 from readtagger.cli.update_mapq import update_mapq
 from readtagger.cli.write_supplementary_fastq import write_supplementary_fastq
+from readtagger.findcluster import ClusterFinder
 from readtagger import VERSION
 from click.testing import CliRunner
 import pytest
@@ -20,7 +23,9 @@ command_line_functions = [allow_dovetailing,
                           annotate_softclipped_reads,
                           confirm_insertions,
                           findcluster,
+                          index_tagged_reads,
                           merge_findcluster,
+                          merge_findcluster_shards,
                           plot_coverage,
                           pysamtools_view,
                           update_mapq,
@@ -132,6 +137,45 @@ def test_merge_vcf_cli(datadir_copy, tmpdir):  # noqa: D103
     assert result.exit_code == 0
 
 
+def test_index_tagged_reads_cli(datadir_copy, tmpdir):  # noqa: D103
+    in_path = str(datadir_copy[EXTENDED])
+    out_path = tmpdir.join('out.tag_index.gz').strpath
+    runner = CliRunner()
+    result = runner.invoke(index_tagged_reads, ['-i', in_path, '-o', out_path])
+    assert result.exit_code == 0
+    assert 'Indexed' in result.output
+    assert out_path in result.output
+
+
+def test_merge_findcluster_shards_cli(datadir_copy, tmpdir):  # noqa: D103
+    in_path = str(datadir_copy[EXTENDED])
+    shard_gff = tmpdir.join('shard.gff.gz').strpath
+    shard_vcf = tmpdir.join('shard.vcf.gz').strpath
+    expected_gff = tmpdir.join('expected.gff').strpath
+    ClusterFinder(input_path=in_path, output_gff=shard_gff, output_vcf=shard_vcf, max_proper_pair_size=649)
+    ClusterFinder(input_path=in_path, output_gff=expected_gff, max_proper_pair_size=649)
+    out_gff = tmpdir.join('out.gff.gz').strpath
+    out_vcf = tmpdir.join('out.vcf.gz').strpath
+    runner = CliRunner()
+    result = runner.invoke(merge_findcluster_shards, [shard_gff, shard_vcf, '--output_gff', out_gff, '--output_vcf', out_vcf])
+    assert result.exit_code == 0
+    with open(expected_gff) as expected:
+        assert [str(r) for r in pysam.TabixFile(out_gff).fetch()] == [line.rstrip('\n') for line in expected if not line.startswith('#')]
+    assert len(list(pysam.VariantFile(out_vcf))) == len(list(pysam.VariantFile(shard_vcf)))
+    # The references are short enough for a .tbi index
+    assert tmpdir.join('out.vcf.gz.tbi').check()
+    # Without VCF inputs an empty VCF output is written and indexed
+    empty_vcf = tmpdir.join('empty.vcf.gz').strpath
+    result = runner.invoke(merge_findcluster_shards, [shard_gff, '--output_vcf', empty_vcf])
+    assert result.exit_code == 0
+    assert tmpdir.join('empty.vcf.gz.tbi').check()
+    # BAM and FASTA files are never compressed
+    compressed_bam = tmpdir.join('shard.bam.gz')
+    compressed_bam.write('')
+    result = runner.invoke(merge_findcluster_shards, [compressed_bam.strpath, '--output_bam', tmpdir.join('out.bam').strpath])
+    assert result.exit_code == 2
+
+
 def test_readtagger_multiple(datadir_copy, tmpdir):  # noqa: D103
     A = str(datadir_copy[TEST_BAM_A])
     B = str(datadir_copy[TEST_BAM_B])
@@ -1,10 +1,16 @@
+import json
+import os
 import pytest
+import pysam
 from collections import namedtuple
 from readtagger.findcluster import (
     ClusterFinder,
-    ClusterManager
+    ClusterManager,
+    merge_region_files
 )
+from readtagger.assembly_cache import ASSEMBLY_CACHE
 from readtagger.cli import findcluster
+from readtagger.cluster import Cluster
 
 from .helpers import (  # noqa: F401
     namedtuple_to_argv,
@@ -101,6 +107,98 @@ def test_clusterfinder_split_cluster(datadir_copy, tmpdir):  # noqa: D103
     assert cf.clusters[1] != cf.clusters[2]
 
 
+def test_clusterfinder_split_cluster_threads(datadir_copy, tmpdir):  # noqa: D103
+    input_path = str(datadir_copy[SPLIT_CLUSTER])
+    clusters = []
+    for threads in (1, 4):
+        cf = ClusterFinder(input_path=input_path, output_bam=tmpdir.join('output_%d.bam' % threads).strpath,
+                           include_duplicates=False,
+                           remove_supplementary_without_primary=False,
+                           max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE,
+                           threads=threads)
+        clusters.append([sorted(r.query_name for r in c) for c in cf.clusters])
+    assert len(clusters[0]) == 3
+    assert clusters[0] == clusters[1]
+
+
+def test_clusterfinder_max_clustersupport(datadir_copy, tmpdir):  # noqa: D103
+    input_path = str(datadir_copy[SPLIT_CLUSTER])
+    finder = ClusterFinder(input_path=input_path, output_bam=tmpdir.join('output.bam').strpath,
+                           include_duplicates=False,
+                           remove_supplementary_without_primary=False,
+                           max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE,
+                           max_clustersupport=20)
+    assert [len(c) for c in finder.clusters] == [2, 16, 27]
+    cluster = Cluster(shm_dir=None)
+    with pysam.AlignmentFile(input_path) as reader:
+        reads = [r for r in reader if r.has_tag('BD')]
+    for r in reads:
+        cluster.add_read(r, max_clustersupport=5)
+    assert cluster.capped
+    assert len(cluster.read_index) == 6
+    assert len(cluster) + cluster.capped_reads == len(reads)
+    assert cluster.last_start == reads[-1].reference_start
+    assert cluster.max == max(r.reference_end for r in reads)
+
+
+def test_cluster_add_read_read_index(datadir_copy, monkeypatch):  # noqa: D103
+    input_path = str(datadir_copy[SPLIT_CLUSTER])
+    with pysam.AlignmentFile(input_path) as reader:
+        reads = [r for r in reader if r.has_tag('BD')]
+    read_index = Cluster.read_index
+    calls = []
+
+    def counting_read_index(cluster):
+        calls.append(cluster)
+        return read_index.fget(cluster)
+
+    monkeypatch.setattr(Cluster, 'read_index', property(counting_read_index))
+    cluster = Cluster(shm_dir=None)
+    max_clustersupport = len(set(r.query_name for r in reads)) - 1
+    for r in reads:
+        cluster.add_read(r, max_clustersupport=max_clustersupport)
+    # The read names of a deep cluster are indexed once and then kept up to date
+    assert len(calls) == 1
+    assert cluster.capped
+    assert len(cluster.read_index) == max_clustersupport + 1
+    assert len(cluster) + cluster.capped_reads == len(reads)
+
+
+def test_clusterfinder_profile_report(datadir_copy, tmpdir):  # noqa: D103
+    input_path = str(datadir_copy[SPLIT_CLUSTER])
+    profile_report = tmpdir.join('profile.json').strpath
+    finder = ClusterFinder(input_path=input_path, output_bam=tmpdir.join('output.bam').strpath,
+                           max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE,
+                           profile_report=profile_report)
+    with open(profile_report) as report:
+        report = json.load(report)
+    stages = [stats['stage'] for stats in report['stages']]
+    assert stages == ['find_cluster', 'clean_clusters', 'join_clusters', 'assemble', 'annotate_softclip', 'to_fasta',
+                      'align_bwa', 'collect_evidence', 'annotate_bwa', 'to_bam', 'to_gff', 'to_vcf']
+    assert report['stages'][0]['reads'] == finder.inspected_reads > 0
+    assert report['stages'][-1]['clusters'] == len(finder.clusters)
+    assert len(report['regions']) == 1
+
+
+def test_clusterfinder_compressed_output(datadir_copy, tmpdir):  # noqa: D103
+    input_path = str(datadir_copy[SPLIT_CLUSTER])
+    output_gff = tmpdir.join('output.gff.gz').strpath
+    output_vcf = tmpdir.join('output.vcf.gz').strpath
+    finder = ClusterFinder(input_path=input_path,
+                           output_gff=output_gff,
+                           output_vcf=output_vcf,
+                           max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE)
+    reference_name = finder.clusters[0].reference_name
+    with pysam.TabixFile(output_gff) as gff:
+        starts = [int(line.split('\t')[3]) for line in gff.fetch(reference_name)]
+    assert starts
+    assert starts == sorted(starts)
+    with pysam.VariantFile(output_vcf) as vcf:
+        positions = [record.pos for record in vcf.fetch(reference_name)]
+    assert len(positions) == len(finder.clusters) + len(finder.softclip_finder.clusters)
+    assert positions == sorted(positions)
+
+
 def test_clusterfinder_refine_split(datadir_copy, tmpdir):  # noqa: D103
     input_path = str(datadir_copy[SPLIT_CLUSTER_OPT])
     output_bam = tmpdir.join('output.bam').strpath
@@ -177,6 +275,228 @@ def test_clustermanager_single_core(datadir_copy, tmpdir):  # noqa: D103
                    sample_name='single_core_sample')
 
 
+def test_clustermanager_work_dir(datadir_copy, tmpdir, mocker):  # noqa: D103
+    input_path = str(datadir_copy[EXTENDED])
+    work_dir = tmpdir.join('work_dir').strpath
+    kwds = dict(input_path=input_path,
+                genome_reference_fasta=None,
+                transposon_reference_fasta=None,
+                threads=1,
+                max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE,
+                region='3R:12000001-15000001',
+                work_dir=work_dir)
+    first_gff = tmpdir.join('first.gff').strpath
+    manager = ClusterManager(output_gff=first_gff, output_bam=tmpdir.join('first.bam').strpath, **kwds)
+    with open(tmpdir.join('work_dir', 'manifest.jsonl').strpath) as manifest:
+        regions = [json.loads(line)['region'] for line in manifest]
+    assert regions and sorted(regions) == sorted(kwd['region'] for kwd in manager.process_list)
+    # All regions are complete, so they are not processed again
+    mocker.patch('readtagger.findcluster.ClusterFinder.find_cluster', side_effect=Exception('Region processed again'))
+    second_gff = tmpdir.join('second.gff').strpath
+    ClusterManager(output_gff=second_gff, output_bam=tmpdir.join('second.bam').strpath, **kwds)
+    with open(first_gff) as first, open(second_gff) as second:
+        assert first.read() == second.read()
+    # Changed parameters invalidate the completed regions
+    with pytest.raises(Exception):
+        ClusterManager(output_gff=second_gff, min_mapq=10, **kwds)
+
+
+def test_clustermanager_incremental(datadir_copy, tmpdir):  # noqa: D103
+    input_path = str(datadir_copy[EXTENDED])
+    work_dir = tmpdir.join('work_dir').strpath
+    kwds = dict(genome_reference_fasta=None,
+                transposon_reference_fasta=None,
+                threads=1,
+                max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE,
+                region='3R:12000001-15000001',
+                sample_name='sample',
+                output_gff=tmpdir.join('output.gff').strpath,
+                work_dir=work_dir,
+                incremental=True)
+    ClusterManager(input_path=input_path, **kwds)
+    retagged_path = tmpdir.join('retagged.bam').strpath
+    with pysam.AlignmentFile(input_path) as f, pysam.AlignmentFile(retagged_path, mode='wb', template=f) as out:
+        for r in f:
+            if r.has_tag('BD'):
+                r.set_tag('BD', None)
+                retagged_region = '3R:13000001-14000001'
+            out.write(r)
+    ClusterManager(input_path=retagged_path, **kwds)
+    with open(tmpdir.join('work_dir', 'manifest.jsonl').strpath) as manifest:
+        regions = [json.loads(line)['region'] for line in manifest]
+    # Only the region with changed tags is processed again
+    assert len(regions) == 4
+    assert regions[-1] == retagged_region
+
+
+def test_clustermanager_regions_bed(datadir_copy, tmpdir):  # noqa: D103
+    input_path = str(datadir_copy[EXTENDED])
+    regions_bed = tmpdir.join('regions.bed')
+    regions_bed.write("3R\t13372900\t13373500\n3R\t13373500\t13374800\n3R\t20000000\t20001000\nchrUnknown\t1\t10\n")
+    output_gff = tmpdir.join('output.gff').strpath
+    manager = ClusterManager(input_path=input_path,
+                             genome_reference_fasta=None,
+                             transposon_reference_fasta=None,
+                             output_gff=output_gff,
+                             threads=1,
+                             max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE,
+                             regions_bed=regions_bed.strpath)
+    assert [kwds['region'] for kwds in manager.process_list] == ['3R:13372901-13374800', '3R:20000001-20001000']
+    region_gff = tmpdir.join('region.gff').strpath
+    ClusterFinder(input_path=input_path,
+                  output_gff=region_gff,
+                  max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE,
+                  region='3R:13372901-13374800')
+    with open(output_gff) as output, open(region_gff) as region:
+        assert output.read() == region.read()
+
+
+def test_clustermanager_regions_bed_gap(datadir_copy, tmpdir):  # noqa: D103
+    input_path = str(datadir_copy[EXTENDED])
+    regions_bed = tmpdir.join('regions.bed')
+    # There is a cluster at 3R:13374469-13374778, between the intervals, and an empty interval
+    regions_bed.write("3R\t13374000\t13374100\n3R\t13374200\t13374200\n3R\t13374800\t13375000\n")
+    output_gff = tmpdir.join('output.gff').strpath
+    manager = ClusterManager(input_path=input_path,
+                             genome_reference_fasta=None,
+                             transposon_reference_fasta=None,
+                             output_gff=output_gff,
+                             threads=1,
+                             max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE,
+                             regions_bed=regions_bed.strpath)
+    assert [kwds['region'] for kwds in manager.process_list] == ['3R:13374001-13374100', '3R:13374801-13375000']
+    with open(output_gff) as output:
+        assert not [line for line in output if not line.startswith('#')]
+
+
+def test_clustermanager_regions_bed_without_pending_regions(datadir_copy, tmpdir):  # noqa: D103
+    input_path = str(datadir_copy[EXTENDED])
+    kwds = dict(input_path=input_path,
+                genome_reference_fasta=None,
+                transposon_reference_fasta=None,
+                threads=1,
+                max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE)
+    # No region of the BED file is on a contig of the input
+    unknown_bed = tmpdir.join('unknown.bed')
+    unknown_bed.write("chrUnknown\t1\t10\n")
+    manager = ClusterManager(output_gff=tmpdir.join('unknown.gff').strpath, regions_bed=unknown_bed.strpath, **kwds)
+    assert manager.process_list == []
+    # All regions of the BED file are reused from the work_dir
+    regions_bed = tmpdir.join('regions.bed')
+    regions_bed.write("3R\t13372900\t13374800\n")
+    work_dir = tmpdir.join('work_dir').strpath
+    first_gff = tmpdir.join('first.gff').strpath
+    second_gff = tmpdir.join('second.gff').strpath
+    ClusterManager(output_gff=first_gff, regions_bed=regions_bed.strpath, work_dir=work_dir, **kwds)
+    ClusterManager(output_gff=second_gff, regions_bed=regions_bed.strpath, work_dir=work_dir, **kwds)
+    with open(first_gff) as first, open(second_gff) as second:
+        assert first.read() == second.read()
+
+
+def test_clustermanager_submitted_tasks(datadir_copy, tmpdir, monkeypatch):  # noqa: D103
+    input_path = str(datadir_copy[EXTENDED])
+    regions_bed = tmpdir.join('regions.bed')
+    regions_bed.write("3R\t12000000\t12500000\n3R\t13372900\t13374800\n3R\t14000000\t14500000\n3R\t20000000\t20001000\n")
+    kwds = dict(input_path=input_path,
+                genome_reference_fasta=None,
+                transposon_reference_fasta=None,
+                threads=1,
+                max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE,
+                regions_bed=regions_bed.strpath)
+    all_gff = tmpdir.join('all.gff').strpath
+    ClusterManager(output_gff=all_gff, **kwds)
+    # Each task is only submitted once the records of the previous task have been written
+    monkeypatch.setattr('readtagger.findcluster.SUBMITTED_TASKS_PER_WORKER', 1)
+    sequential_gff = tmpdir.join('sequential.gff').strpath
+    ClusterManager(output_gff=sequential_gff, **kwds)
+    with open(all_gff) as all_records, open(sequential_gff) as sequential_records:
+        assert all_records.read() == sequential_records.read()
+
+
+def test_clustermanager_shards(datadir_copy, tmpdir):  # noqa: D103
+    input_path = str(datadir_copy[EXTENDED])
+    regions_bed = tmpdir.join('regions.bed')
+    regions_bed.write("3R\t13372900\t13374800\n3R\t20000000\t20001000\n")
+    plan = tmpdir.join('plan.txt').strpath
+    kwds = dict(input_path=input_path,
+                genome_reference_fasta=None,
+                transposon_reference_fasta=None,
+                threads=1,
+                max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE,
+                regions_bed=regions_bed.strpath)
+    ClusterManager(plan=plan, **kwds)
+    with open(plan) as f:
+        assert f.read().splitlines() == ['3R:13372901-13374800', '3R:20000001-20001000']
+    shard_gffs = []
+    for shard in ('1/2', '2/2'):
+        shard_gff = tmpdir.join('shard_%s.gff' % shard[0]).strpath
+        manager = ClusterManager(plan=plan, shard=shard, output_gff=shard_gff, **kwds)
+        assert len(manager.process_list) == 1
+        shard_gffs.append(shard_gff)
+    merged_gff = tmpdir.join('merged.gff').strpath
+    merge_region_files(gff_files=shard_gffs, output_gff=merged_gff, remove_inputs=False)
+    output_gff = tmpdir.join('output.gff').strpath
+    ClusterManager(output_gff=output_gff, **kwds)
+    with open(output_gff) as output, open(merged_gff) as merged:
+        assert output.read() == merged.read()
+
+
+class ClusterWithoutEvidence(list):  # noqa: D101
+    evidence_for_five_p = evidence_for_three_p = evidence_against = ()
+
+
+def test_reads_in_coordinate_order_unmapped_last():  # noqa: D103
+    header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': 'chr1', 'LN': 1000}, {'SN': 'chr2', 'LN': 1000}]})
+
+    def read(name, tid, start):
+        r = pysam.AlignedSegment(header)
+        r.query_name = name
+        r.reference_id = tid
+        r.reference_start = start
+        r.flag = 4 if tid < 0 else 0
+        return r
+
+    finder = ClusterFinder.__new__(ClusterFinder)
+    finder.clusters = [ClusterWithoutEvidence([read('unmapped', -1, -1), read('a', 1, 10)]), ClusterWithoutEvidence([read('b', 0, 500)])]
+    finder._cluster_reads = lambda i, cluster, alignment_file: iter(cluster)
+    # Like merge_sorted_bam, unmapped reads without position are written after all placed reads
+    assert [r.query_name for r in finder._reads_in_coordinate_order(alignment_file=None)] == ['b', 'a', 'unmapped']
+
+
+def test_clusterfinder_assembly_settings(datadir_copy, tmpdir):  # noqa: D103
+    input_path = str(datadir_copy[EXTENDED])
+    assembly_cache = tmpdir.join('assemblies.sqlite').strpath
+    finder = ClusterFinder(input_path=input_path,
+                           output_gff=tmpdir.join('output.gff').strpath,
+                           max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE,
+                           region='3R:13373000-13374000',
+                           assembly_cache=assembly_cache,
+                           assembly_target_reads=10,
+                           in_process_assembly=True)
+    assert finder.clusters
+    assert all(cluster.assembler is finder.assembler for cluster in finder.clusters)
+    assert finder.assembler.cache.path == assembly_cache
+    assert finder.assembler.target_reads == 10
+    assert finder.assembler.in_process
+    # Settings of earlier instances don't apply to later instances in the same process
+    default = ClusterFinder(input_path=input_path, max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE, region='3R:13373000-13374000')
+    assert default.assembler.cache is ASSEMBLY_CACHE
+    assert ASSEMBLY_CACHE.path is None
+    assert default.assembler.target_reads is None
+    # cap3 assembles all read sets unless in-process assembly is requested
+    assert not default.assembler.in_process
+
+
+def test_clusterfinder_assembly_exception(datadir_copy, tmpdir, mocker):  # noqa: D103
+    input_path = str(datadir_copy[EXTENDED])
+    mocker.patch('readtagger.cluster.Cluster._make_contigs', side_effect=ValueError('Assembly failed'))
+    with pytest.raises(ValueError):
+        ClusterFinder(input_path=input_path,
+                      output_gff=tmpdir.join('output.gff').strpath,
+                      max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE,
+                      region='3R:13372901-13374800')
+
+
 def test_clustermanager_multiprocessing(datadir_copy, tmpdir, reference_fasta):  # noqa: D103, F811
     input_path = str(datadir_copy[MULTIPROCESSING])
     output_gff = tmpdir.join('output.gff').strpath
@@ -223,6 +543,8 @@ def test_clustermanager_multiprocessing_exception(datadir_copy, tmpdir, referenc
                        threads=2,
                        max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE)
         assert str(excinfo.value) == exception_message
+    # Incomplete outputs are removed
+    assert not os.path.exists(output_gff)
 
     mocker.patch('concurrent.futures.Future.cancel', cancel)
     with pytest.raises(Exception) as excinfo:
@@ -504,6 +826,40 @@ def test_clusterfinder_skip_abnormal(datadir_copy, tmpdir, reference_fasta):  #
     assert clusters.clusters[2].abnormal
 
 
+def test_clusterfinder_decoy_regions(datadir_copy, tmpdir):  # noqa: D103
+    input_path = str(datadir_copy[ARTEFACT_ACCUMULATION])
+    decoy_regions = tmpdir.join('decoy_regions.txt').strpath
+    region = 'X:22432000-22434000'
+    clusters = ClusterFinder(input_path=input_path, region=region, max_proper_pair_size=649, decoy_regions=decoy_regions)
+    assert clusters.is_decoy
+    assert clusters.clusters
+    with open(decoy_regions) as regions:
+        assert regions.read() == "%s\t%s\n" % (region, clusters.sample_name)
+    clusters = ClusterFinder(input_path=input_path, region='X:22432500-22433500', max_proper_pair_size=649, decoy_regions=decoy_regions)
+    assert clusters.is_decoy
+    assert not clusters.clusters
+    # Decoy regions of other samples are not skipped
+    clusters = ClusterFinder(input_path=input_path,
+                             region='X:22432500-22433500',
+                             max_proper_pair_size=649,
+                             decoy_regions=decoy_regions,
+                             sample_name='other_sample')
+    assert clusters.clusters
+    with open(decoy_regions, 'a') as regions:
+        regions.write('X:22432500-22433500\n')
+    with pytest.raises(ValueError):
+        ClusterFinder(input_path=input_path, region='X:22432500-22433500', max_proper_pair_size=649, decoy_regions=decoy_regions)
+
+
+def test_clusterfinder_decoy_window(datadir_copy, monkeypatch):  # noqa: D103
+    input_path = str(datadir_copy[ARTEFACT_ACCUMULATION])
+    monkeypatch.setattr('readtagger.findcluster.DECOY_WINDOW_CLUSTERS', 5)
+    clusters = ClusterFinder(input_path=input_path, region='X:22432000-22434000', max_proper_pair_size=649)
+    # Finding clusters stops once the last 5 clusters are too dense, regardless of the distance to the end of the region
+    assert clusters.is_decoy
+    assert len(clusters.clusters) == 5
+
+
 def test_clusterfinder_start_end_problem(datadir_copy, tmpdir, reference_fasta):  # noqa: D103, F811
     input_path = str(datadir_copy[START_END_PROBLEM])
     output_gff = tmpdir.join('output.gff').strpath
@@ -621,3 +977,45 @@ def test_clusterfinder_vcf(datadir_copy, tmpdir, reference_fasta):  # noqa: D103
                              max_proper_pair_size=649)
     assert len(clusters.softclip_finder.clusters) == 2
     assert len(clusters.clusters[0].feature_args) == 1
+
+
+def test_clusterfinder_buffer_region(datadir_copy, tmpdir):  # noqa: D103
+    input_path = str(datadir_copy[COMPLEX])
+    region = '3R:13373000-13374000'
+    expected = ClusterFinder(input_path=input_path,
+                             output_bam=tmpdir.join('expected.bam').strpath,
+                             region=region,
+                             max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE)
+    buffered = ClusterFinder(input_path=input_path,
+                             output_bam=tmpdir.join('buffered.bam').strpath,
+                             region=region,
+                             max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE,
+                             buffer_region=True)
+    assert buffered.clusters
+    assert [c.nalt for c in buffered.clusters] == [c.nalt for c in expected.clusters]
+    assert [c.nref for c in buffered.clusters] == [c.nref for c in expected.clusters]
+    assert [len(c) for c in buffered.softclip_finder.clusters] == [len(c) for c in expected.softclip_finder.clusters]
+    with pysam.AlignmentFile(tmpdir.join('expected.bam').strpath) as e, pysam.AlignmentFile(tmpdir.join('buffered.bam').strpath) as b:
+        assert [r.to_string() for r in b] == [r.to_string() for r in e]
+
+
+def test_clustermanager_remove_supplementary(datadir_copy, tmpdir):  # noqa: D103
+    input_path = str(datadir_copy[INPUT])
+    single_core_bam = tmpdir.join('single_core.bam').strpath
+    multiprocessing_bam = tmpdir.join('multiprocessing.bam').strpath
+    ClusterFinder(input_path=input_path,
+                  output_bam=single_core_bam,
+                  include_duplicates=True,
+                  remove_supplementary_without_primary=True,
+                  max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE)
+    ClusterManager(input_path=input_path,
+                   genome_reference_fasta=None,
+                   transposon_reference_fasta=None,
+                   output_bam=multiprocessing_bam,
+                   include_duplicates=True,
+                   remove_supplementary_without_primary=True,
+                   region='3R:8000001-10000001',
+                   threads=2,
+                   max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE)
+    with pysam.AlignmentFile(single_core_bam) as s, pysam.AlignmentFile(multiprocessing_bam) as m:
+        assert sorted(r.query_name for r in m) == sorted(r.query_name for r in s)
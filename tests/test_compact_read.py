@@ -0,0 +1,38 @@
+import pysam
+
+from readtagger.bam_io import (
+    fetch_with_offsets,
+    index_bam
+)
+from readtagger.compact_read import CompactRead
+
+EXTENDED = 'extended_annotated_updated_all_reads.bam'
+
+
+def test_compact_read_rehydrate(datadir_copy):  # noqa: D103
+    input_path = str(datadir_copy[EXTENDED])
+    index_bam(input_path)
+    with pysam.AlignmentFile(input_path) as f:
+        reads = [(CompactRead(r, virtual_offset=virtual_offset), r.to_string()) for virtual_offset, r in fetch_with_offsets(f, '3R', 13373000, 13374000)]
+    assert reads
+    assert reads[0][0].virtual_offset is None
+    with pysam.AlignmentFile(input_path) as f:
+        for compact_read, original in reads:
+            assert compact_read.rehydrate(f).to_string() == original
+
+
+def test_compact_read_attributes(datadir_copy):  # noqa: D103
+    input_path = str(datadir_copy[EXTENDED])
+    with pysam.AlignmentFile(input_path) as f:
+        for r in f:
+            if r.is_unmapped:
+                continue
+            compact_read = CompactRead(r)
+            for attr in ('query_name', 'reference_start', 'reference_end', 'is_reverse', 'is_read1', 'is_duplicate', 'mapq', 'cigar', 'qstart', 'qend'):
+                assert getattr(compact_read, attr) == getattr(r, attr)
+            for tag in ('AD', 'BD'):
+                assert compact_read.has_tag(tag) == r.has_tag(tag)
+            if r.has_tag('AD'):
+                assert compact_read.query_sequence == r.query_sequence
+            if r.has_tag('BD') and r.has_tag('MS'):
+                assert compact_read.get_tag('MS') == r.get_tag('MS')
@@ -1,12 +1,18 @@
 import pysam
 
-from readtagger.cluster import evidence_for
+from readtagger.cluster import (
+    collect_evidence,
+    collect_evidence_for_clusters,
+    evidence_for
+)
+from readtagger.findcluster import ClusterFinder
 
 TEST_BAM = 'improve_counting_support.bam'
 GOOD_BREAKPOINT = [13813889, 13813894]
 WRONG_BREAKPOINT = 13813890
 WRONG_BREAKPOINT_SEQS = {'ATATA', 'ATATA'}
 GOOD_BREAKPOINT_SEQS = {'TAAGT', 'GTAAC'}
+DECOY = 'decoy.bam'
 
 
 def test_evidence_for(datadir_copy):  # noqa: D103
@@ -36,3 +42,19 @@ def _breakpoint_and_sequence_combinations(read, breakpoint=0, should_be=False):
     assert evidence_for(read, {GOOD_BREAKPOINT[0]: WRONG_BREAKPOINT_SEQS}) is False, str(read)
     assert evidence_for(read, {WRONG_BREAKPOINT: GOOD_BREAKPOINT_SEQS}) is False, str(read)
     assert evidence_for(read, {GOOD_BREAKPOINT[breakpoint]: GOOD_BREAKPOINT_SEQS}) == should_be, str(read)
+
+
+def test_collect_evidence_for_clusters(datadir_copy):  # noqa: D103
+    input_path = str(datadir_copy[DECOY])
+    # Decoy regions are skipped after finding clusters, so no evidence has been collected yet
+    clusters = ClusterFinder(input_path=input_path, max_proper_pair_size=700).clusters
+    with pysam.AlignmentFile(input_path) as f:
+        for cluster in clusters:
+            collect_evidence(cluster, f)
+    expected = [(c.nref, c.evidence_against, c.evidence_for_five_p, c.evidence_for_three_p) for c in clusters]
+    for cluster in clusters:
+        cluster.evidence_against, cluster.evidence_for_five_p, cluster.evidence_for_three_p = set(), set(), set()
+    with pysam.AlignmentFile(input_path) as f:
+        collect_evidence_for_clusters(clusters, f)
+    assert len(clusters) > 50
+    assert [(c.nref, c.evidence_against, c.evidence_for_five_p, c.evidence_for_three_p) for c in clusters] == expected
@@ -1,5 +1,8 @@
+import os
 import pysam
+import pytest
 import readtagger.bam_io
+from readtagger.region_output import RegionOutputWriter
 
 
 TEST_BAM = 'dm6.bam'
@@ -147,3 +150,66 @@ def return_samtools(arg):  # noqa: D103
         return True
     else:
         return False
+
+
+def test_merge_sorted_bam(datadir_copy, tmpdir):  # noqa: D103
+    in_path = str(datadir_copy[EXTENDED])
+    readtagger.bam_io.sort_bam(inpath=in_path, output=in_path, sort_order='coordinate')
+    with pysam.AlignmentFile(in_path) as f:
+        reads = [r for r in f]
+    # The first two files overlap, the last file starts after the end of the others
+    chunks = [reads[:len(reads) // 2:2], reads[1:len(reads) // 2:2], reads[len(reads) // 2:]]
+    bam_collection = []
+    for i, chunk in enumerate(chunks):
+        path = tmpdir.join('%d.bam' % i).strpath
+        with pysam.AlignmentFile(in_path) as template, pysam.AlignmentFile(path, mode='wb', template=template) as out:
+            for r in chunk:
+                out.write(r)
+        bam_collection.append(path)
+    outfile = tmpdir.join('out.bam').strpath
+    readtagger.bam_io.merge_sorted_bam(bam_collection, output_path=outfile)
+    with pysam.AlignmentFile(outfile) as f:
+        assert f.header['HD']['SO'] == 'coordinate'
+        merged = [(r.reference_id, r.reference_start, r.query_name) for r in f]
+    assert sorted(merged) == sorted((r.reference_id, r.reference_start, r.query_name) for r in reads)
+    assert [m[:2] for m in merged] == [(r.reference_id, r.reference_start) for r in reads]
+
+
+def test_region_output_writer(datadir_copy, tmpdir):  # noqa: D103
+    in_path = str(datadir_copy[EXTENDED])
+    with pysam.AlignmentFile(in_path) as f:
+        header = f.header
+        reads = [r for r in f]
+    split = reads[len(reads) // 2].reference_start
+    # Reads starting up to 50 nucleotides before the second region are divided between both regions
+    overlap = [r.to_string() for r in reads if split - 50 <= r.reference_start < split]
+    first = [r.to_string() for r in reads if r.reference_start < split - 50] + overlap[::2]
+    second = overlap[1::2] + [r.to_string() for r in reads if r.reference_start >= split]
+    regions = ['3R:1-%d' % split, '3R:%d-%d' % (split + 1, split + 10000)]
+    outfile = tmpdir.join('out.bam').strpath
+    fasta = tmpdir.join('out.fasta').strpath
+    with RegionOutputWriter(regions, header=header, sample_name='sample', output_bam=outfile, output_fasta=fasta, padding=100) as writer:
+        writer.add(1, {'output_bam': second, 'output_fasta': ['>b\nA\n']})
+        writer.add(0, {'output_bam': first, 'output_fasta': ['>a\nC\n']})
+    with pysam.AlignmentFile(outfile) as f:
+        assert f.header['HD']['SO'] == 'coordinate'
+        written = [r.reference_start for r in f]
+    assert written == sorted(written)
+    assert len(written) == len(first) + len(second)
+    with open(fasta) as f:
+        assert f.read() == '>a\nC\n>b\nA\n'
+
+
+def test_region_output_writer_exception(datadir_copy, tmpdir):  # noqa: D103
+    in_path = str(datadir_copy[EXTENDED])
+    with pysam.AlignmentFile(in_path) as f:
+        header = f.header
+    outfile = tmpdir.join('out.bam').strpath
+    gff = tmpdir.join('out.gff').strpath
+    with pytest.raises(ValueError):
+        with RegionOutputWriter(['3R'], header=header, sample_name='sample', output_bam=outfile, output_gff=gff) as writer:
+            writer.add(0, {'output_gff': ['3R\t.\t.\t1\t2\n']})
+            raise ValueError('Region failed')
+    # Incomplete outputs are removed
+    assert not os.path.exists(outfile)
+    assert not os.path.exists(gff)
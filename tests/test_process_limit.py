@@ -0,0 +1,30 @@
+import multiprocessing
+import threading
+import time
+
+from readtagger.process_limit import ProcessLimiter
+
+
+def test_process_limiter_caps_concurrency():  # noqa: D103
+    manager = multiprocessing.Manager()
+    limiter = ProcessLimiter.from_manager(manager, size=3)
+    running = []
+    max_running = []
+    lock = threading.Lock()
+
+    def run(threads):
+        with limiter.slots(threads) as acquired:
+            with lock:
+                running.append(acquired)
+                max_running.append(sum(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(acquired)
+
+    workers = [threading.Thread(target=run, args=(threads,)) for threads in (1, 2, 3, 4, 1, 2) * 3]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    manager.shutdown()
+    assert max(max_running) <= 3
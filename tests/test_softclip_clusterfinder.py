@@ -20,3 +20,14 @@ def test_softclip_clusterfinder_multi_h6(datadir_copy, tmpdir):  # noqa: D103, F
     clusterfinder = SoftClipClusterFinder(input_path=input_path, output_gff=gff_out)
     clusters = clusterfinder.clusters
     assert len(clusters) == 8
+
+
+def test_softclip_clusterfinder_clusters_near(datadir_copy, tmpdir):  # noqa: D103, F811
+    input_path = str(datadir_copy[MULTI_H6])
+    gff_out = tmpdir.join('out.gff').strpath
+    clusterfinder = SoftClipClusterFinder(input_path=input_path, output_gff=gff_out)
+    clusters = clusterfinder.clusters
+    for position in [clusters[0].clip_position - 300, clusters[0].clip_position, clusters[3].clip_position + 10, clusters[-1].clip_position + 299]:
+        for window in (1, 20, 300):
+            expected = [c for c in clusters if position - window < c.clip_position < position + window]
+            assert clusterfinder.clusters_near(position, window) == expected
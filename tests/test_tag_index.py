@@ -0,0 +1,31 @@
+from readtagger.findcluster import ClusterFinder
+from readtagger.tag_index import (
+    tag_index_is_current,
+    write_tag_index
+)
+
+EXTENDED = 'extended_annotated_updated_all_reads.bam'
+DEFAULT_MAX_PROPER_PAIR_SIZE = 700
+
+
+def test_clusterfinder_tag_index(datadir_copy, tmpdir):  # noqa: D103
+    input_path = str(datadir_copy[EXTENDED])
+    tag_index = write_tag_index(input_path=input_path, output_path=tmpdir.join('tag_index').strpath)
+    assert 0 < tag_index.indexed_reads < tag_index.total_reads
+    for region in (None, '3R:13373000-13374000'):
+        expected = ClusterFinder(input_path=input_path, region=region, max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE)
+        indexed = ClusterFinder(input_path=input_path, region=region, max_proper_pair_size=DEFAULT_MAX_PROPER_PAIR_SIZE, tag_index=tag_index.path)
+        assert [c.nalt for c in indexed.clusters] == [c.nalt for c in expected.clusters]
+        assert [c.nref for c in indexed.clusters] == [c.nref for c in expected.clusters]
+        assert [len(c) for c in indexed.softclip_finder.clusters] == [len(c) for c in expected.softclip_finder.clusters]
+
+
+def test_tag_index_settings(datadir_copy, tmpdir):  # noqa: D103
+    input_path = str(datadir_copy[EXTENDED])
+    tag_index = write_tag_index(input_path=input_path, output_path=tmpdir.join('tag_index').strpath, min_mapq=20)
+    all_reads = write_tag_index(input_path=input_path, output_path=tmpdir.join('all_reads').strpath, min_mapq=0, include_duplicates=True)
+    assert tag_index.indexed_reads < all_reads.indexed_reads
+    assert tag_index_is_current(input_path, tag_index.path, min_mapq=20, include_duplicates=False)
+    assert not tag_index_is_current(input_path, tag_index.path, min_mapq=4, include_duplicates=False)
+    assert not tag_index_is_current(input_path, tag_index.path, min_mapq=20, include_duplicates=True)
+    assert tag_index_is_current(input_path, all_reads.path, min_mapq=0, include_duplicates=True)
@@ -13,3 +13,24 @@ def test_merge_vcf_files(datadir_copy, tmpdir):  # noqa: D103
     with pysam.VariantFile(output_vcf) as vf:
         merged_count = len(list(vf))
     assert merged_count == 2 * original_count
+
+
+def test_merge_vcf_files_sorted(datadir_copy, tmpdir):  # noqa: D103
+    test_vcf = str(datadir_copy[TEST_VCF_FILE])
+    with open(test_vcf) as vcf:
+        lines = vcf.readlines()
+    header = [line for line in lines if line.startswith('#')]
+    records = [line for line in lines if not line.startswith('#')]
+    # The first file overlaps the second file, the third file starts after the second file
+    pieces = [[records[0], records[2]], [records[1]], [records[2].replace('13689480', '13689500')]]
+    vcf_files = []
+    for i, piece in enumerate(pieces):
+        path = tmpdir.join('%d.vcf' % i).strpath
+        with open(path, 'w') as out:
+            out.writelines(header + piece)
+        vcf_files.append(path)
+    output_vcf = tmpdir.join('output.vcf').strpath
+    merge_vcf_files(vcf_files, output_path=output_vcf)
+    with pysam.VariantFile(output_vcf) as vf:
+        positions = [r.pos for r in vf]
+    assert positions == [13689476, 13689476, 13689480, 13689500]